@@ -0,0 +1,77 @@
+"""
+Setup shared by the benchmarks
+
+Imports the app's modules the way the tests do, through tests/support.py,
+and opens throwaway databases so nothing touches /volume/db. Run a benchmark
+from the repo root, e.g. python benchmarks/task_overhead.py
+"""
+
+import logging
+import os
+import random
+import sys
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tests"))
+
+from support import sample_job_data  # noqa: E402
+
+logging.basicConfig(level=logging.WARNING)
+
+WORDS = (
+    "bin rental dumpster junk removal roll off waste container construction debris "
+    "yard cleanup residential commercial cheap same day weekend near me cost price "
+    "size small large halifax toronto calgary vancouver hire service company best"
+).split()
+
+
+@contextmanager
+def temp_databases():
+    """Yields (db_manager, directory) with empty jobs and keyword_cache databases"""
+    from db import db_manager
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_manager.init_db(os.path.join(directory, "jobs.db"), "jobs")
+        db_manager.init_db(os.path.join(directory, "keyword_cache.db"), "keyword_cache")
+        db_manager.initialize_tables()
+        try:
+            yield db_manager, directory
+        finally:
+            db_manager.close_all_db()
+
+
+def job_data(seeds: List[str] = None) -> Dict[str, Any]:
+    """The tests' sample submission with more seeds and locations"""
+    return sample_job_data(seeds or ["bin rental", "dumpster", "junk removal"], ["CA", "US"])
+
+
+def keyword_payload(
+    seeds: List[str], locations: List[str], per_seed: int = 150, seed: int = 0
+) -> Dict[str, Any]:
+    """
+    A GENERATE_SIMILAR_KEYWORDS result shaped like real Twinword responses:
+    per location, per seed keyword, the similar keywords with their stats
+    """
+    rng = random.Random(seed)
+    similar_kw_dict = {}
+    for location in locations:
+        similar_kw_dict[location] = {}
+        for seed_keyword in seeds:
+            similar_kw_dict[location][seed_keyword] = {
+                " ".join(rng.sample(WORDS, rng.randint(2, 4))): {
+                    "similarity": round(rng.random(), 4),
+                    "search volume": str(rng.choice([10, 20, 50, 90, 170, 320, 880])),
+                    "cpc": f"{rng.random() * 12:.2f}" if rng.random() > 0.2 else "",
+                    "paid competition": f"{rng.random():.2f}",
+                }
+                for _ in range(per_seed)
+            }
+    return {"similar_kw_dict": similar_kw_dict}
+
+
+def percentile(samples: List[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
@@ -0,0 +1,113 @@
+"""
+/heartbeat latency while large task results are being written
+
+Requests go through the real router in-process (httpx's ASGI transport,
+with the login dependency overridden), so what's timed is the route, the
+snapshot read and the event loop, not a network. Each scenario polls the
+heartbeat of one job REQUESTS times:
+
+    idle      nothing else running
+    db thread a task keeps writing full keyword results as new versions
+              through db_manager.run, the way the job runner does
+    on loop   the same writes made directly on the event loop, the way
+              JobManager used to make them
+
+With the writes on the database thread, the heartbeat's p99 should stay
+within a few milliseconds of idle; on the loop, every request that lands
+behind a write waits for all of it.
+"""
+
+import asyncio
+import json
+import statistics
+import time
+
+from common import job_data, keyword_payload, percentile, temp_databases
+
+REQUESTS = 300
+KEYWORDS_PER_SEED = 1000
+
+
+async def writer(db_manager, task_id: str, result_json: str, on_loop: bool, stop):
+    from jobs.db import create_task_version
+
+    writes = 0
+    while not stop.is_set():
+        # A different result each time, otherwise the blob store dedupes them
+        version_json = f'{result_json[:-1]}, "write": {writes}}}'
+        if on_loop:
+            create_task_version(task_id, version_json)
+            await asyncio.sleep(0)
+        else:
+            await db_manager.run(create_task_version, task_id, version_json)
+        writes += 1
+    return writes
+
+
+async def time_heartbeats(db_manager, scenario: str):
+    import httpx
+    from fastapi import FastAPI
+    from jobs import JobManager
+    from web.auth import get_current_user
+    from web.models import User
+    from web.routes import router
+
+    app = FastAPI()
+    app.include_router(router)
+    user = User(email="bench@example.com")
+
+    async def current_user():
+        return user
+
+    app.dependency_overrides[get_current_user] = current_user
+
+    # A manager of its own, since the global one's queue still holds the
+    # tasks of earlier scenarios, whose databases are gone
+    manager = JobManager(db_manager)
+    data = job_data()
+    job_id = await manager.create_job(data)
+    task = manager.ready_tasks.get_nowait()
+    result_json = json.dumps(
+        keyword_payload(data["seedKeywords"], data["locations"], per_seed=KEYWORDS_PER_SEED)
+    )
+
+    stop = asyncio.Event()
+    writes = None
+    if scenario != "idle":
+        writes = asyncio.create_task(
+            writer(db_manager, task["id"], result_json, scenario == "on loop", stop)
+        )
+
+    timings = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for _ in range(REQUESTS):
+            started = time.perf_counter()
+            response = await client.get(f"/heartbeat/{job_id}")
+            timings.append((time.perf_counter() - started) * 1000)
+            assert response.status_code == 200, response.text
+            await asyncio.sleep(0.001)
+
+    stop.set()
+    written = await writes if writes else 0
+    versions = db_manager.execute_query(
+        "jobs", "SELECT COUNT(*) FROM task_versions WHERE task_id = ?", (task["id"],)
+    )[0][0]
+    assert versions == written, "the writes went to another job than the one polled"
+    return timings, written, len(result_json)
+
+
+def main():
+    print(f"{'scenario':>10} {'writes':>7} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for scenario in ("idle", "db thread", "on loop"):
+        with temp_databases() as (db_manager, _):
+            timings, written, size = asyncio.run(time_heartbeats(db_manager, scenario))
+        print(
+            f"{scenario:>10} {written:>7} {statistics.median(timings):>8.2f}"
+            f" {percentile(timings, 99):>8.2f} {max(timings):>8.2f}"
+        )
+    print(f"each write is a {size / 1024:.0f} KiB result")
+
+
+if __name__ == "__main__":
+    main()
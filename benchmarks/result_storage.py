@@ -0,0 +1,148 @@
+"""
+Database growth and write latency of task results, inline against result_blobs
+
+One GENERATE_SIMILAR_KEYWORDS task is rerun RERUNS times. The keyword
+cache means a rerun often gets back exactly what an earlier run did, so
+the results cycle through DISTINCT_RESULTS different keyword payloads.
+
+    inline    the schema from before result_blobs: task_versions and
+              current_task_versions each hold the full JSON, which still
+              carried full_kw_list next to similar_kw_dict
+    migrated  the inline database after create_tables has moved its
+              results into result_blobs and vacuumed
+    blobs     the same reruns written with create_task_version
+
+Growth is what the file put on over its empty schema, after a checkpoint,
+so it includes the WAL's contents but not its preallocated size.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import statistics
+import time
+
+from common import job_data, keyword_payload, percentile, temp_databases
+
+RERUNS = 30
+DISTINCT_RESULTS = 10
+
+LEGACY_SCHEMA = """
+CREATE TABLE task_versions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id TEXT,
+    result JSON,
+    input_hash TEXT,
+    created_at TIMESTAMP
+);
+CREATE TABLE current_task_versions (
+    task_id TEXT PRIMARY KEY,
+    version_id INTEGER,
+    result JSON
+);
+"""
+
+
+def results(data, legacy: bool):
+    """The serialized result of each rerun, with full_kw_list for the inline schema"""
+    for rerun in range(RERUNS):
+        result = keyword_payload(
+            data["seedKeywords"], data["locations"], seed=rerun % DISTINCT_RESULTS
+        )
+        if legacy:
+            result["full_kw_list"] = list(
+                {
+                    kw
+                    for by_seed in result["similar_kw_dict"].values()
+                    for similar in by_seed.values()
+                    for kw in similar
+                }
+            )
+        yield json.dumps(result)
+
+
+def file_size(conn: sqlite3.Connection, path: str) -> int:
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return os.path.getsize(path)
+
+
+def time_inline(directory: str):
+    from jobs.db import create_tables
+
+    path = os.path.join(directory, "inline.db")
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(LEGACY_SCHEMA)
+    empty = file_size(conn, path)
+
+    timings = []
+    for result_json in results(job_data(), legacy=True):
+        started = time.perf_counter()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO task_versions (task_id, result, created_at) VALUES (?, ?, ?)",
+                ("task", result_json, "now"),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO current_task_versions VALUES (?, ?, ?)",
+                ("task", cursor.lastrowid, result_json),
+            )
+        timings.append((time.perf_counter() - started) * 1000)
+    inline = file_size(conn, path) - empty
+
+    started = time.perf_counter()
+    create_tables(conn)
+    migration = time.perf_counter() - started
+    migrated = file_size(conn, path) - empty
+    conn.close()
+    return timings, inline, migrated, migration
+
+
+def time_blobs(db_manager):
+    from jobs import JobManager
+    from jobs.db import create_task_version
+
+    data = job_data()
+    asyncio.run(JobManager(db_manager).create_job(data))
+    path = db_manager.pools["jobs"].db_path
+    with db_manager.get_db("jobs") as conn:
+        (task_id,) = conn.execute(
+            "SELECT id FROM job_tasks WHERE task_type = 'GENERATE_SIMILAR_KEYWORDS'"
+        ).fetchone()
+        empty = file_size(conn, path)
+
+    timings = []
+    for result_json in results(data, legacy=False):
+        started = time.perf_counter()
+        create_task_version(task_id, result_json)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    with db_manager.get_db("jobs") as conn:
+        blobs = conn.execute("SELECT COUNT(*) FROM result_blobs").fetchone()[0]
+        assert blobs == DISTINCT_RESULTS, blobs
+        return timings, file_size(conn, path) - empty
+
+
+def main():
+    with temp_databases() as (db_manager, directory):
+        inline_timings, inline, migrated, migration = time_inline(directory)
+        blob_timings, blobs = time_blobs(db_manager)
+
+    print(f"{RERUNS} reruns, {DISTINCT_RESULTS} distinct results")
+    print(f"{'storage':>9} {'growth KiB':>11} {'mean ms':>8} {'p95 ms':>8}")
+    for name, size, timings in (
+        ("inline", inline, inline_timings),
+        ("migrated", migrated, None),
+        ("blobs", blobs, blob_timings),
+    ):
+        if timings:
+            latency = f"{statistics.mean(timings):>8.2f} {percentile(timings, 95):>8.2f}"
+        else:
+            latency = f"{'-':>8} {'-':>8}"
+        print(f"{name:>9} {size / 1024:>11.0f} {latency}")
+    print(f"migration took {migration * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
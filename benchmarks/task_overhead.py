@@ -0,0 +1,81 @@
+"""
+Per-task overhead of the job runner against the size of the job's history
+
+Each job gets VERSIONS earlier versions of a full keyword result on every
+task, like a job that's been rerun that many times. Then one task is run
+over and over with a handler that returns straight away, so what's timed
+is everything run_task does around the handler: the lease, the input hash,
+the memo lookup, writing the result, queueing dependents and the events.
+
+Nothing on that path reads the job's whole state any more, so the time per
+task should stay flat however many versions the job has piled up.
+"""
+
+import asyncio
+import json
+import statistics
+import time
+
+from common import job_data, keyword_payload, percentile, temp_databases
+
+VERSIONS = (0, 10, 100)
+RUNS = 50
+
+
+async def time_task_runs(db_manager, versions: int):
+    from jobs import JobManager
+    from jobs.db import create_task_version
+
+    manager = JobManager(db_manager)
+    data = job_data()
+    job_id = await manager.create_job(data)
+    task = manager.ready_tasks.get_nowait()
+
+    task_ids = [
+        row["id"]
+        for row in await db_manager.run(
+            lambda: db_manager.execute_query(
+                "jobs", "SELECT id FROM job_tasks WHERE job_id = ?", (job_id,)
+            ),
+            readonly=True,
+        )
+    ]
+    for version in range(versions):
+        payload = keyword_payload(data["seedKeywords"], data["locations"], seed=version)
+        for task_id in task_ids:
+            await db_manager.run(create_task_version, task_id, json.dumps(payload))
+
+    async def handler(job_id, task_id):
+        return {"company_string": "Acme", "page_strings": ["Bins"]}
+
+    manager.handle_process_initial_input = handler
+
+    timings = []
+    for _ in range(RUNS):
+        db_manager.execute_query(
+            "jobs", "UPDATE job_tasks SET status = 'queued' WHERE id = ?", (task["id"],)
+        )
+        started = time.perf_counter()
+        # force skips reuse and the memo, so the handler runs every time
+        await manager.run_task({**task, "force": True})
+        timings.append((time.perf_counter() - started) * 1000)
+
+    written = db_manager.execute_query(
+        "jobs", "SELECT COUNT(*) FROM task_versions WHERE task_id = ?", (task["id"],)
+    )[0][0]
+    assert written == versions + RUNS, "a run failed instead of completing the task"
+    return timings
+
+
+def main():
+    print(f"{'versions per task':>18} {'mean ms':>9} {'p95 ms':>9}")
+    for versions in VERSIONS:
+        with temp_databases() as (db_manager, _):
+            timings = asyncio.run(time_task_runs(db_manager, versions))
+        print(
+            f"{versions:>18} {statistics.mean(timings):>9.2f} {percentile(timings, 95):>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
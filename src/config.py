@@ -21,6 +21,10 @@ if ENVIRONMENT == "development":
 KEYWORD_CACHE_PATH = os.getenv("KEYWORD_CACHE_PATH", "/volume/db/keyword_cache.db")
 JOBS_DB_PATH = os.getenv("CLIENT_JOBS_PATH", "/volume/db/client_jobs.db")
 OAUTH_DB_PATH = os.getenv("OAUTH_DB_PATH", "/volume/db/oauth.db")
+# Read-only connections per database, on top of its one writer
+DB_READER_CONNECTIONS = int(os.getenv("DB_READER_CONNECTIONS", "4"))
+# How long a query waits for a free connection before giving up
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
 
 # OAuth
 GOOGLE_OAUTH_CLIENT_ID = os.getenv("GOOGLE_OAUTH_CLIENT_ID")
@@ -45,6 +49,37 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 # Job Settings
 MAX_JOBS_PER_USER = int(os.getenv("MAX_JOBS_PER_USER", "5"))
 JOB_TIMEOUT_SECONDS = int(os.getenv("JOB_TIMEOUT_SECONDS", "3600"))  # 1 hour default
+# Tasks from different jobs run in parallel up to this many at a time
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Fraction of jobs whose task events are logged (failures are always logged)
+JOB_EVENT_SAMPLE_RATE = float(os.getenv("JOB_EVENT_SAMPLE_RATE", "1.0"))
+# A running task's lease is renewed every third of TASK_LEASE_SECONDS. If the
+# process dies, the task goes back to the workers once its lease runs out, up
+# to TASK_MAX_ATTEMPTS leases in all before its job is failed.
+TASK_LEASE_SECONDS = int(os.getenv("TASK_LEASE_SECONDS", "60"))
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "3"))
+
+# Deterministic task results are reused across jobs with the same inputs.
+# Entries unused for this many days, or the least recently used past the size
+# budget (measured as result JSON size), are evicted every TASK_MEMO_EVICT_SECONDS.
+TASK_MEMO_MAX_AGE_DAYS = float(os.getenv("TASK_MEMO_MAX_AGE_DAYS", "30"))
+TASK_MEMO_MAX_BYTES = int(os.getenv("TASK_MEMO_MAX_BYTES", str(256 * 1024 * 1024)))
+TASK_MEMO_EVICT_SECONDS = int(os.getenv("TASK_MEMO_EVICT_SECONDS", "3600"))
+
+# Embeddings
+# Memory budget for the in-process embedding cache (bge-micro vectors are 1.5 KiB each)
+EMBEDDING_CACHE_BYTES = int(os.getenv("EMBEDDING_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+# Most keywords held in the keyword similarity index, the most recently cached
+# ones winning (bge-micro vectors are 1.5 KiB each, so 50k is about 75 MiB)
+KEYWORD_INDEX_MAX_KEYWORDS = int(os.getenv("KEYWORD_INDEX_MAX_KEYWORDS", "50000"))
+# How often newly cached keywords are embedded and added to the index
+KEYWORD_INDEX_FLUSH_SECONDS = float(os.getenv("KEYWORD_INDEX_FLUSH_SECONDS", "10"))
+
+# Budget for parsed similar keyword searches kept in memory, measured as JSON text size
+SIMILAR_SEARCH_CACHE_BYTES = int(
+    os.getenv("SIMILAR_SEARCH_CACHE_BYTES", str(16 * 1024 * 1024))
+)
 
 # Rate Limiting
 RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", "60"))
@@ -1,33 +1,179 @@
+"""
+SQLite connection pools, one per database
+
+Each database gets one writer connection and DB_READER_CONNECTIONS reader
+connections. WAL lets the readers run alongside the writer, while writes
+still go through the single writer connection one at a time. Connections are
+checked out of a queue, so callers wait their turn instead of sharing a
+connection across threads.
+
+get_db(name) checks out the writer and commits when the block exits.
+get_db(name, readonly=True) checks out a reader, which is opened with
+query_only so a write through it fails loudly instead of racing the writer.
+
+Async code goes through run(), which calls a function that does its own
+get_db on a database thread and awaits the result, so queries never block
+the event loop. Writes all go to one thread, where they queue up behind each
+other rather than tying up several threads waiting on the writer connection.
+Reads go to a pool of DB_READER_CONNECTIONS threads.
+
+A thread that already holds a connection to a database gets that same
+connection back from a nested get_db instead of waiting on itself. A reader
+request from a thread holding the writer also gets the writer, so it sees
+its own uncommitted writes.
+"""
+
+import asyncio
+import logging
+import queue
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Any, Dict
+from functools import partial
+from typing import Any, Callable, Dict
+
+from config import DB_POOL_TIMEOUT_SECONDS, DB_READER_CONNECTIONS
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = {
+    "busy_timeout": 5000,
+    # Safe with WAL: a power loss can drop the last commits but can't corrupt the db
+    "synchronous": "NORMAL",
+    # Negative means KiB, so 16 MiB of page cache per connection
+    "cache_size": -16000,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+
+class ConnectionPool:
+    def __init__(self, db_path: str, db_name: str, readers: int = DB_READER_CONNECTIONS):
+        self.db_path = db_path
+        self.db_name = db_name
+        self.queries = 0
+        self.checkouts = {"writer": 0, "reader": 0}
+        self.wait_seconds = {"writer": 0.0, "reader": 0.0}
+        self.max_wait_seconds = {"writer": 0.0, "reader": 0.0}
+        self.held = threading.local()
+
+        self.writer_queue: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self.reader_queue: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self.all_connections = []
+
+        writer = self._connect()
+        with writer:
+            writer.execute("PRAGMA journal_mode=WAL;")
+        self.writer_queue.put(writer)
+        for _ in range(readers):
+            reader = self._connect()
+            reader.execute("PRAGMA query_only=ON;")
+            self.reader_queue.put(reader)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma, value in PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma}={value};")
+        conn.set_trace_callback(self._count_query)
+        self.all_connections.append(conn)
+        return conn
+
+    def _count_query(self, statement: str):
+        self.queries += 1
+
+    def _checkout(self, kind: str, pool: "queue.Queue[sqlite3.Connection]") -> sqlite3.Connection:
+        started = time.perf_counter()
+        try:
+            conn = pool.get(timeout=DB_POOL_TIMEOUT_SECONDS)
+        except queue.Empty:
+            raise sqlite3.OperationalError(
+                f"Timed out after {DB_POOL_TIMEOUT_SECONDS}s waiting for a "
+                f"{kind} connection to '{self.db_name}'"
+            )
+        waited = time.perf_counter() - started
+        self.checkouts[kind] += 1
+        self.wait_seconds[kind] += waited
+        self.max_wait_seconds[kind] = max(self.max_wait_seconds[kind], waited)
+        return conn
+
+    @contextmanager
+    def connection(self, readonly: bool = False):
+        held = getattr(self.held, "conn", None)
+        if held is not None:
+            # Nested use on this thread, the outer block commits or rolls back
+            if not readonly and held[1] == "reader":
+                raise sqlite3.OperationalError(
+                    f"Can't write to '{self.db_name}' while this thread holds a reader"
+                )
+            yield held[0]
+            return
+
+        kind = "reader" if readonly else "writer"
+        pool = self.reader_queue if readonly else self.writer_queue
+        conn = self._checkout(kind, pool)
+        self.held.conn = (conn, kind)
+        try:
+            yield conn
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        else:
+            if not readonly:
+                conn.commit()
+        finally:
+            if conn.in_transaction:
+                # Whatever raised out of the block left a transaction open
+                conn.rollback()
+            self.held.conn = None
+            pool.put(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queries": self.queries,
+            "readers": len(self.all_connections) - 1,
+            "readers_idle": self.reader_queue.qsize(),
+            "writer_idle": self.writer_queue.qsize() == 1,
+            "checkouts": dict(self.checkouts),
+            "wait_seconds": {k: round(v, 4) for k, v in self.wait_seconds.items()},
+            "max_wait_seconds": {k: round(v, 4) for k, v in self.max_wait_seconds.items()},
+        }
+
+    def close(self):
+        for conn in self.all_connections:
+            conn.close()
+        self.all_connections.clear()
 
 
 class DBManager:
     def __init__(self):
-        self.connections: Dict[str, sqlite3.Connection] = {}
+        self.pools: Dict[str, ConnectionPool] = {}
+        self.write_executor: ThreadPoolExecutor = None
+        self.read_executor: ThreadPoolExecutor = None
 
     def initialize_connections(self):
         self.init_db("/volume/db/keyword_cache.db", "keyword_cache")
         self.init_db("/volume/db/jobs.db", "jobs")
 
     def init_db(self, db_path: str, db_name: str):
-        """Initialize a new database connection."""
-        if db_name in self.connections:
+        """Opens the connection pool for a database"""
+        if db_name in self.pools:
             raise ValueError(f"Database '{db_name}' is already initialized.")
+        self.pools[db_name] = ConnectionPool(db_path, db_name)
 
-        conn = sqlite3.connect(db_path, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        self.connections[db_name] = conn
-
-        # Enable WAL mode
-        with conn:
-            conn.execute("PRAGMA journal_mode=WAL;")
+    def is_initialized(self, db_name: str) -> bool:
+        return db_name in self.pools
 
     def initialize_tables(self):
         """Initialize all tables across all modules."""
         from jobs.db import create_tables as create_job_tables
-        from keywords.db import create_similar_keywords_table
+        from keywords.db import (
+            create_embeddings_table,
+            create_rate_limits_table,
+            create_similar_keywords_table,
+        )
         from keywords.db import create_table as create_keyword_table
 
         # Jobs module tables
@@ -38,35 +184,56 @@ class DBManager:
         with self.get_db("keyword_cache") as conn:
             create_keyword_table(conn)
             create_similar_keywords_table(conn)
+            create_embeddings_table(conn)
+            create_rate_limits_table(conn)
 
     def close_db(self, db_name: str):
-        """Close a specific database connection."""
-        if db_name in self.connections:
-            self.connections[db_name].close()
-            del self.connections[db_name]
+        """Close a specific database's connections."""
+        if db_name in self.pools:
+            self.pools.pop(db_name).close()
 
     def close_all_db(self):
         """Close all database connections."""
-        for conn in self.connections.values():
-            conn.close()
-        self.connections.clear()
+        for executor in (self.write_executor, self.read_executor):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self.write_executor = self.read_executor = None
+        for pool in self.pools.values():
+            pool.close()
+        self.pools.clear()
 
-    @contextmanager
-    def get_db(self, db_name: str):
-        if db_name not in self.connections:
-            self.connections[db_name] = sqlite3.connect(
-                f"/path/to/{db_name}.db", check_same_thread=False
-            )
-            self.connections[db_name].row_factory = sqlite3.Row
+    async def run(self, fn: Callable, *args, readonly: bool = False, **kwargs):
+        """
+        Runs fn(*args, **kwargs) on a database thread and waits for it
+        without blocking the event loop. fn opens its own connection with
+        get_db; pass readonly=True if it only reads, so it can run alongside
+        other reads instead of queueing behind writes.
+        """
+        if readonly:
+            if self.read_executor is None:
+                self.read_executor = ThreadPoolExecutor(
+                    max_workers=DB_READER_CONNECTIONS, thread_name_prefix="db-reader"
+                )
+            executor = self.read_executor
+        else:
+            if self.write_executor is None:
+                self.write_executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="db-writer"
+                )
+            executor = self.write_executor
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, partial(fn, *args, **kwargs))
 
-        conn = self.connections[db_name]
-        try:
+    @contextmanager
+    def get_db(self, db_name: str, readonly: bool = False):
+        pool = self.pools.get(db_name)
+        if pool is None:
+            raise ValueError(f"Database '{db_name}' is not initialized.")
+        with pool.connection(readonly=readonly) as conn:
             yield conn
-        except sqlite3.Error:
-            conn.rollback()
-            raise
-        else:
-            conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        return {name: pool.stats() for name, pool in self.pools.items()}
 
     def execute_query(self, db_name: str, query: str, params: Any = None):
         """Execute a query on a specific database."""
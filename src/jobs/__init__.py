@@ -37,20 +37,65 @@ of prompt strings with their I/O variables (similar to HDL?) and then go through
 import asyncio
 import json
 import logging
+import os
+import socket
+import time
+import zlib
+from collections import defaultdict, deque
 from datetime import datetime, timezone
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 from uuid import uuid4
 
+import numpy as np
 from pydantic import BaseModel
 from tenacity import retry, stop_after_attempt, wait_exponential
 
 import keywords
+from config import (
+    JOB_TIMEOUT_SECONDS,
+    JOB_WORKERS,
+    MAX_JOBS_PER_USER,
+    TASK_LEASE_SECONDS,
+    TASK_MAX_ATTEMPTS,
+    TASK_MEMO_EVICT_SECONDS,
+    TASK_MEMO_MAX_AGE_DAYS,
+    TASK_MEMO_MAX_BYTES,
+)
 from db import db_manager
-from keywords.embedding import embedding_service
+from keywords.embedding import embedding_service, normalize_text
+from keywords.embedding.executors import cluster_in_process, run_embedding_task
+from .db import (
+    ACTIVE_USER_JOBS_SQL,
+    AFFECTED_TASKS_SQL,
+    INCOMPLETE_TASK_COUNT_SQL,
+    RECOVER_PENDING_TASKS_SQL,
+    LeaseLostError,
+    add_job_task_dependencies,
+    claim_ready_tasks,
+    create_task_version,
+    decode_result,
+    evict_task_memo,
+    find_stored_version,
+    finish_leased_task,
+    lease_task,
+    load_job_snapshot,
+    recall_task_result,
+    reclaim_expired_leases,
+    renew_task_lease,
+    touch_task_memo,
+    use_task_version,
+)
+from .events import emit_job_event, summarize_result
 from .tasks import TaskType
 
 logger = logging.getLogger(__name__)
 
+# Keywords in the keyword index (cached from any earlier search) at least this
+# similar to a seed are added to the ones the provider suggested for it. It's
+# the same cutoff SELECT_BEST_KEYWORDS keeps keywords at.
+DISCOVERED_KEYWORD_THRESHOLD = 0.69
+DISCOVERED_KEYWORDS_PER_SEED = 50
+
 
 def serialize_job_data(data: dict) -> dict:
     """Recursively convert Pydantic Url objects to strings."""
@@ -59,93 +104,164 @@ def serialize_job_data(data: dict) -> dict:
             data[key] = serialize_job_data(value.dict())
         elif isinstance(value, dict):
             data[key] = serialize_job_data(value)
+        elif isinstance(value, list):
+            data[key] = [
+                serialize_job_data(item) if isinstance(item, dict) else str(item)
+                for item in value
+            ]
         elif hasattr(value, "__str__"):  # This will catch Url objects
             data[key] = str(value)
     return data
 
 
+def job_pages(job_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The pages a job generates content for: current_page, then any additional_pages"""
+    return [job_data["current_page"], *job_data.get("additional_pages", [])]
+
+
+def page_strings(initial_input_data: Dict[str, Any]) -> List[str]:
+    """PROCESS_INITIAL_INPUT's page strings, including from results stored before multi-page jobs"""
+    if "page_strings" in initial_input_data:
+        return initial_input_data["page_strings"]
+    return [initial_input_data["page_string"]]
+
+
+def add_discovered_keywords(
+    similar: Dict[str, Dict[str, Any]], discovered: Dict[str, List[Tuple[str, float]]]
+) -> Dict[str, Dict[str, Any]]:
+    """
+    One location's provider results with each seed's discovered keywords
+    added after the provider's own, scored by "index similarity". Keywords
+    the provider already returned (in any case) aren't repeated. The
+    provider results are copied, not changed, since they can be the cached
+    search itself.
+    """
+    combined = {}
+    for seed, results in similar.items():
+        results = dict(results)
+        known = {normalize_text(kw) for kw in results}
+        for kw, score in discovered.get(seed, []):
+            if kw not in known:
+                results[kw] = {"index similarity": round(score, 4)}
+        combined[seed] = results
+    return combined
+
+
+def full_keyword_list(similar_kw_dict: Dict[str, Dict[str, List[str]]]) -> List[str]:
+    """
+    Every similar keyword across locations and seeds, without duplicates, in
+    the order they were found so reruns embed and cluster the same list
+    """
+    return list(
+        dict.fromkeys(
+            kw
+            for results in similar_kw_dict.values()
+            for similar in results.values()
+            for kw in similar
+        )
+    )
+
+
 class VersionManager:
     def __init__(self, db_manager):
         self.db_manager = db_manager
 
-    async def create_version(self, task_id: str, result: Any) -> int:
+    async def create_version(
+        self,
+        task_id: str,
+        result: Any,
+        task_status: str = None,
+        result_json: str = None,
+        input_hash: str = None,
+        memo_key: tuple = None,
+        lease: tuple = None,
+    ) -> int:
+        """
+        Stores result as a new version and makes it the task's current one
+
+        If task_status is given the task's status is updated too. It all
+        happens in one transaction with the result serialized once, so a
+        completed task costs a single commit. Pass result_json if the caller
+        has already serialized result, input_hash to record what the result
+        was computed from, memo_key to memoize it for other jobs, and lease
+        to only store it if the task is still leased to this worker.
+        """
         logger.debug(f"Creating version for task {task_id}")
-        with self.db_manager.get_db("jobs") as conn:
-            cursor = conn.cursor()
-            try:
-                cursor.execute(
-                    """
-                    INSERT INTO task_versions (task_id, result, created_at)
-                    VALUES (?, ?, ?)
-                """,
-                    (task_id, json.dumps(result), datetime.now(timezone.utc).isoformat()),
-                )
-                version_id = cursor.lastrowid
-
-                cursor.execute(
-                    """
-                    INSERT OR REPLACE INTO current_task_versions (task_id, version_id, result)
-                    VALUES (?, ?, ?)
-                """,
-                    (task_id, version_id, json.dumps(result)),
-                )
-
-                conn.commit()
-                logger.info(f"Successfully created version {version_id} for task {task_id}")
-                return version_id
-            except Exception as e:
-                logger.error(f"Error creating version for task {task_id}: {str(e)}")
-                conn.rollback()
-                raise
+        if result_json is None:
+            result_json = json.dumps(result)
+        try:
+            version_id = await self.db_manager.run(
+                create_task_version,
+                task_id,
+                result_json,
+                task_status,
+                input_hash,
+                memo_key,
+                lease,
+            )
+        except Exception as e:
+            logger.error(f"Error creating version for task {task_id}: {str(e)}")
+            raise
+        logger.debug(f"Created version {version_id} for task {task_id}")
+        return version_id
 
     async def get_version(self, task_id: str, version_id: int = None) -> Any:
         logger.debug(f"Getting version for task {task_id}, version_id: {version_id}")
-        with self.db_manager.get_db("jobs") as conn:
-            if version_id is None:
-                row = conn.execute(
-                    """
-                    SELECT result
-                    FROM current_task_versions
-                    WHERE task_id = ?
-                """,
-                    (task_id,),
-                ).fetchone()
-            else:
-                row = conn.execute(
-                    """
-                    SELECT result
-                    FROM task_versions
-                    WHERE id = ? AND task_id = ?
-                """,
-                    (version_id, task_id),
-                ).fetchone()
 
-            if row is None or row["result"] is None:
-                logger.warning(f"No result found for task {task_id}, version_id: {version_id}")
-                return None
+        def read():
+            with self.db_manager.get_db("jobs", readonly=True) as conn:
+                if version_id is None:
+                    row = conn.execute(
+                        """
+                        SELECT rb.data
+                        FROM current_task_versions ctv
+                        JOIN result_blobs rb ON rb.hash = ctv.result_hash
+                        WHERE ctv.task_id = ?
+                    """,
+                        (task_id,),
+                    ).fetchone()
+                else:
+                    row = conn.execute(
+                        """
+                        SELECT rb.data
+                        FROM task_versions tv
+                        JOIN result_blobs rb ON rb.hash = tv.result_hash
+                        WHERE tv.id = ? AND tv.task_id = ?
+                    """,
+                        (version_id, task_id),
+                    ).fetchone()
 
-            try:
-                return json.loads(row["result"])
-            except json.JSONDecodeError:
-                logger.error(f"Failed to decode JSON for task {task_id}, version_id: {version_id}")
-                return None
+                if row is None:
+                    logger.warning(f"No result found for task {task_id}, version_id: {version_id}")
+                    return None
+
+                try:
+                    return decode_result(row["data"])
+                except (json.JSONDecodeError, zlib.error):
+                    logger.error(f"Failed to decode JSON for task {task_id}, version_id: {version_id}")
+                    return None
+
+        return await self.db_manager.run(read, readonly=True)
 
     async def list_versions(self, task_id: str) -> List[Dict[str, Any]]:
         logger.debug(f"Listing versions for task {task_id}")
-        with self.db_manager.get_db("jobs") as conn:
-            rows = conn.execute(
-                """
-                SELECT id, task_id, created_at
-                FROM task_versions
-                WHERE task_id = ?
-                ORDER BY id
-            """,
-                (task_id,),
-            ).fetchall()
 
-        versions = [dict(row) for row in rows]
-        logger.debug(f"Versions for task {task_id}: {json.dumps(versions, indent=2)}")
-        return versions
+        def read():
+            with self.db_manager.get_db("jobs", readonly=True) as conn:
+                rows = conn.execute(
+                    """
+                    SELECT id, task_id, created_at
+                    FROM task_versions
+                    WHERE task_id = ?
+                    ORDER BY id
+                """,
+                    (task_id,),
+                ).fetchall()
+            return rows
+
+        rows = await self.db_manager.run(read, readonly=True)
+
+        return [dict(row) for row in rows]
 
     async def compare_versions(
         self, task_id: str, version_id1: int, version_id2: int
@@ -168,318 +284,861 @@ class VersionManager:
         return differences
 
     async def get_latest_version(self, task_id: str) -> Dict[str, Any]:
-        with self.db_manager.get_db("jobs") as conn:
-            row = conn.execute(
-                """
-                SELECT tv.*
-                FROM task_versions tv
-                JOIN current_task_versions ctv ON tv.id = ctv.version_id
-                WHERE ctv.task_id = ?
-                """,
-                (task_id,)
-            ).fetchone()
-            return dict(row) if row else None
+        def read():
+            with self.db_manager.get_db("jobs", readonly=True) as conn:
+                row = conn.execute(
+                    """
+                    SELECT tv.id, tv.task_id, tv.result_hash, tv.created_at, rb.data
+                    FROM task_versions tv
+                    JOIN current_task_versions ctv ON tv.id = ctv.version_id
+                    LEFT JOIN result_blobs rb ON rb.hash = tv.result_hash
+                    WHERE ctv.task_id = ?
+                    """,
+                    (task_id,)
+                ).fetchone()
+                if row is None:
+                    return None
+                latest = dict(row)
+                latest["result"] = decode_result(latest.pop("data"))
+                return latest
+
+        return await self.db_manager.run(read, readonly=True)
+
+
+class JobLimitError(Exception):
+    """Raised when a user already has MAX_JOBS_PER_USER jobs in progress"""
+
+
+class JobInProgressError(Exception):
+    """Raised when rerunning a job that hasn't finished yet"""
+
+
+class JobEditError(Exception):
+    """Raised when an edit to a job's data can't be applied by rerunning it"""
 
 
 class JobManager:
-    def __init__(self, db_manager):
+    def __init__(self, db_manager, worker_count: int = JOB_WORKERS):
         self.db_manager = db_manager
-        self.task_types = [
-            TaskType.PROCESS_INITIAL_INPUT,
-            TaskType.GENERATE_SIMILAR_KEYWORDS,
-            TaskType.SELECT_BEST_KEYWORDS,
-            TaskType.GENERATE_CLUSTERS,
-            TaskType.SELECT_BEST_CLUSTER,
-            TaskType.GENERATE_HTML,
-        ]
+        # Every job gets one of each, or one per page for per_page types. The
+        # order they run in comes from their depends_on, not from this list.
+        self.task_types = list(TaskType)
         self.version_manager = VersionManager(db_manager)
         self.latest_versions = {}
-
-    async def create_job(self, job_data: Dict[str, Any]) -> str:
+        # Tasks whose inputs are ready. create_job and task completion put
+        # tasks here, so process_tasks only touches the database at startup.
+        self.ready_tasks: asyncio.Queue = asyncio.Queue()
+        self.worker_count = worker_count
+        # Per task type: how many are running, and tasks held back by the
+        # type's max_concurrency until one of those finishes
+        self.running_by_type: Dict[str, int] = defaultdict(int)
+        self.held_by_type: Dict[str, deque] = defaultdict(deque)
+        # Jobs being rerun: when the rerun started, how long the previous run
+        # took, how many tasks were executed or reused, and the task it was
+        # asked to rerun. Logged at the end.
+        self.reruns: Dict[str, Dict[str, Any]] = {}
+        # Task memo lookups by task type since startup, for /metrics
+        self.memo_hits: Dict[str, int] = defaultdict(int)
+        self.memo_misses: Dict[str, int] = defaultdict(int)
+        self.memo_evictions = 0
+        # Who running tasks' leases belong to. The host and pid come first so
+        # recover_pending_tasks can tell which leases a process on this
+        # machine left behind when it exited, see lease_owner_gone.
+        self.lease_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+    async def create_job(self, job_data: Dict[str, Any], user_email: str = None) -> str:
+        """
+        Raises JobLimitError if user_email already has MAX_JOBS_PER_USER unfinished jobs
+        """
         job_id = str(uuid4())
         logger.info(f"Creating new job with ID: {job_id}")
-        
-        with self.db_manager.get_db("jobs") as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                INSERT INTO jobs (id, status, data, created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (
-                    job_id,
-                    "pending",
-                    json.dumps(job_data),
-                    datetime.now(timezone.utc).isoformat(),
-                    datetime.now(timezone.utc).isoformat(),
-                ),
-            )
-        
-        await self.create_tasks_for_job(job_id, job_data)
-        
-        logger.info(f"Job {job_id} created successfully")
-        return job_id
+        created_at = datetime.now(timezone.utc).isoformat()
 
-    async def create_tasks_for_job(self, job_id: str, job_data: Dict[str, Any]):
-        for order, task_type in enumerate(self.task_types):
-            task_id = str(uuid4())
+        def write():
             with self.db_manager.get_db("jobs") as conn:
                 cursor = conn.cursor()
+                if user_email:
+                    active_jobs = cursor.execute(
+                        ACTIVE_USER_JOBS_SQL, (user_email,)
+                    ).fetchone()[0]
+                    if active_jobs >= MAX_JOBS_PER_USER:
+                        raise JobLimitError(
+                            f"{user_email} already has {active_jobs} jobs in progress "
+                            f"(limit {MAX_JOBS_PER_USER})"
+                        )
                 cursor.execute(
                     """
-                    INSERT INTO job_tasks (id, job_id, task_type, task_order, status, created_at, updated_at)
+                    INSERT INTO jobs (id, status, data, user_email, created_at, started_at, updated_at)
                     VALUES (?, ?, ?, ?, ?, ?, ?)
                     """,
                     (
-                        task_id,
                         job_id,
-                        task_type.name,
-                        order,
                         "pending",
-                        datetime.now(timezone.utc).isoformat(),
-                        datetime.now(timezone.utc).isoformat(),
+                        json.dumps(job_data),
+                        user_email,
+                        created_at,
+                        created_at,
+                        created_at,
                     ),
                 )
-            logger.debug(f"Created task: {task_id} of type {task_type.name} for job {job_id}")
+                return self.create_tasks_for_job(conn, job_id, job_data)
+
+        # The job and its tasks commit together, so a failure part way can't
+        # leave a pending job with no tasks counting against the user's limit
+        ready = await self.db_manager.run(write)
+        for task in ready:
+            self.ready_tasks.put_nowait({**task, "job_started_at": created_at})
+
+        logger.info(f"Job {job_id} created successfully")
+        return job_id
+
+    def create_tasks_for_job(
+        self, conn, job_id: str, job_data: Dict[str, Any]
+    ) -> List[Dict[str, Any]]:
+        """
+        Creates the job's tasks and their dependencies on conn, and returns
+        the ones that can start straight away (already marked queued)
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        page_count = len(job_pages(job_data))
+        tasks = []
+        for task_type in self.task_types:
+            pages = range(page_count) if task_type.value.per_page else [None]
+            for page_index in pages:
+                tasks.append((str(uuid4()), task_type.name, len(tasks), page_index))
+
+        conn.executemany(
+            """
+            INSERT INTO job_tasks (id, job_id, task_type, task_order, page_index, status, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (task_id, job_id, task_type, order, page_index, "pending", now, now)
+                for task_id, task_type, order, page_index in tasks
+            ],
+        )
+        add_job_task_dependencies(conn, job_id)
+        ready = claim_ready_tasks(conn, job_id)
+        logger.debug(f"Created {len(tasks)} tasks for job {job_id} ({page_count} pages)")
+        return ready
 
     async def process_tasks(self):
-        logger.info("Starting task processing loop")
+        """
+        Runs worker_count workers pulling from ready_tasks, reclaims expired
+        task leases every TASK_LEASE_SECONDS, and evicts stale task memo
+        entries every TASK_MEMO_EVICT_SECONDS
+
+        A task is queued as soon as every task it depends on has completed,
+        so a job's independent tasks (and each page's branch of a multi-page
+        job) run in parallel with each other as well as with other jobs.
+        """
+        logger.info(f"Starting task processing with {self.worker_count} workers")
+        await self.recover_pending_tasks()
+        workers = [
+            asyncio.create_task(self.task_worker(i)) for i in range(self.worker_count)
+        ]
+        workers.append(asyncio.create_task(self.reclaim_expired_leases_periodically()))
+        workers.append(asyncio.create_task(self.evict_task_memo_periodically()))
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def task_worker(self, worker_id: int):
         while True:
+            task = await self.ready_tasks.get()
             try:
-                task = await self.get_next_pending_task()
-                if not task:
-                    await asyncio.sleep(1)
+                if not self.claim_type_slot(task):
                     continue
-
-                logger.info(f"Processing task: {task['id']} of type {task['task_type']} for job {task['job_id']}")
-                await self.log_job_state(task['job_id'])
                 try:
-                    result = await self.execute_task(task)
-                    await self.update_task_result(task, result)
-
-                    if task["task_type"] != self.task_types[-1].name:
-                        await self.prepare_next_task(task)
-                    else:
-                        await self.check_job_completion(task["job_id"])
-                except Exception as e:
-                    logger.exception(f"Error processing task: {str(e)}")
-                    await self.update_task_status(task["job_id"], task["id"], "failed")
-                    # Continue with the next task instead of sleeping
-                    continue
+                    await self.run_task(task)
+                finally:
+                    self.release_type_slot(task["task_type"])
+            except Exception as e:
+                logger.exception(f"Unexpected error in task worker {worker_id}: {str(e)}")
+            finally:
+                self.ready_tasks.task_done()
+
+    def claim_type_slot(self, task) -> bool:
+        """
+        Takes a slot under the task type's max_concurrency, or holds the task
+        back until release_type_slot frees one. Holding it here rather than
+        waiting keeps the worker free for other task types.
+        """
+        task_type = task["task_type"]
+        limit = TaskType[task_type].value.max_concurrency
+        if limit and self.running_by_type[task_type] >= limit:
+            self.held_by_type[task_type].append(task)
+            return False
+        self.running_by_type[task_type] += 1
+        return True
+
+    def release_type_slot(self, task_type: str):
+        self.running_by_type[task_type] -= 1
+        if self.held_by_type[task_type]:
+            self.ready_tasks.put_nowait(self.held_by_type[task_type].popleft())
+
+    async def run_task(self, task):
+        attempt = await self.db_manager.run(
+            lease_task, task["id"], self.lease_owner, TASK_LEASE_SECONDS
+        )
+        if attempt is None:
+            logger.debug(f"Task {task['id']} was no longer queued, skipping it")
+            return
+        task["lease"] = (self.lease_owner, attempt)
+        heartbeat = asyncio.create_task(self.renew_lease_periodically(task))
+
+        started = time.perf_counter()
+        emit_job_event(
+            "task_started",
+            task["job_id"],
+            task_id=task["id"],
+            task_type=task["task_type"],
+            **({"attempt": attempt} if attempt > 1 else {}),
+        )
+        deadline = None
+        try:
+            job_age = datetime.now(timezone.utc) - datetime.fromisoformat(
+                task["job_started_at"]
+            )
+            time_left = JOB_TIMEOUT_SECONDS - job_age.total_seconds()
+            if time_left <= 0:
+                raise asyncio.TimeoutError()
+            deadline = time.monotonic() + time_left
+            rerun = self.reruns.get(task["job_id"])
+            if rerun is not None and rerun["forced"] == task["id"]:
+                # The task the rerun was asked for, whether it was ready
+                # straight away or only once what it waits on had finished
+                task["force"] = True
+            reused = await self.reuse_stored_version(task, started)
+            if not reused:
+                result = await asyncio.wait_for(self.execute_task(task), time_left)
+                await self.complete_task(task, result, started=started)
+            if task["job_id"] in self.reruns:
+                self.reruns[task["job_id"]]["reused" if reused else "executed"] += 1
+
+            await self.queue_ready_tasks(task["job_id"], task["job_started_at"])
+        except asyncio.TimeoutError as e:
+            if deadline is not None and time.monotonic() < deadline:
+                # asyncio.TimeoutError is the builtin one, so this came from
+                # the task itself (a socket timeout, say), not the job's deadline
+                logger.exception(f"Error processing task: {str(e)}")
+                await self.fail_task(task, type(e).__name__, started)
+                return
+            logger.error(
+                f"Job {task['job_id']} exceeded JOB_TIMEOUT_SECONDS ({JOB_TIMEOUT_SECONDS}s) "
+                f"during task {task['id']}"
+            )
+            await self.fail_task(task, "TimeoutError", started)
+        except LeaseLostError as e:
+            # Whoever holds the task now finishes it
+            logger.warning(f"Discarding the result of task {task['id']}: {str(e)}")
+        except Exception as e:
+            logger.exception(f"Error processing task: {str(e)}")
+            await self.fail_task(task, type(e).__name__, started)
+        finally:
+            heartbeat.cancel()
+
+    async def renew_lease_periodically(self, task):
+        """Keeps a running task's lease from expiring until run_task cancels this"""
+        while True:
+            await asyncio.sleep(TASK_LEASE_SECONDS / 3)
+            try:
+                renewed = await self.db_manager.run(
+                    renew_task_lease, task["id"], task["lease"], TASK_LEASE_SECONDS
+                )
+            except Exception as e:
+                logger.exception(f"Error renewing the lease on task {task['id']}: {str(e)}")
+                continue
+            if not renewed:
+                logger.warning(
+                    f"Lost the lease on task {task['id']}, its result won't be stored"
+                )
+                return
+
+    async def fail_task(self, task, error: str, started: float):
+        def write():
+            with self.db_manager.get_db("jobs") as conn:
+                finish_leased_task(conn, task["id"], task["lease"], "failed")
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', updated_at = ? WHERE id = ?",
+                    (datetime.now(timezone.utc).isoformat(), task["job_id"]),
+                )
 
+        try:
+            await self.db_manager.run(write)
+        except LeaseLostError as e:
+            logger.warning(f"Not failing job {task['job_id']}: {str(e)}")
+            return
+        self.reruns.pop(task["job_id"], None)
+        emit_job_event(
+            "task_failed",
+            task["job_id"],
+            task_id=task["id"],
+            task_type=task["task_type"],
+            duration_ms=round((time.perf_counter() - started) * 1000, 1),
+            error=error,
+        )
+        emit_job_event("job_failed", task["job_id"], task_type=task["task_type"])
+
+    async def evict_task_memo_periodically(self):
+        while True:
+            try:
+                self.memo_evictions += await self.db_manager.run(
+                    evict_task_memo, TASK_MEMO_MAX_AGE_DAYS, TASK_MEMO_MAX_BYTES
+                )
             except Exception as e:
-                logger.exception(f"Unexpected error in process_tasks: {str(e)}")
-                await asyncio.sleep(5)
+                logger.exception(f"Error evicting task memo entries: {str(e)}")
+            await asyncio.sleep(TASK_MEMO_EVICT_SECONDS)
+
+    async def recover_pending_tasks(self):
+        """
+        Queues every task of an unfinished job that isn't waiting on another,
+        including the ones that were running when the process stopped
+
+        Runs once at startup to resume jobs that were in progress. Only the
+        tasks that hadn't completed run again, and the keyword searches and
+        embeddings they'd already got through come out of the keyword cache.
+        After that, tasks are queued as the ones they depend on complete.
+        """
+
+        def write():
+            with self.db_manager.get_db("jobs") as conn:
+                unfinished = conn.execute(
+                    "SELECT id FROM jobs WHERE status NOT IN ('completed', 'failed')"
+                ).fetchall()
+                # Jobs from before dependencies were recorded
+                for job in unfinished:
+                    add_job_task_dependencies(conn, job["id"])
+                # Leases held by a process on this machine that has exited
+                # are taken back without waiting for them to expire. Ones a
+                # live worker holds are left to expire like any other.
+                _, exhausted = reclaim_expired_leases(
+                    conn,
+                    TASK_MAX_ATTEMPTS,
+                    f"{socket.gethostname()}:*",
+                    self.lease_owner_gone,
+                )
+                rows = conn.execute(RECOVER_PENDING_TASKS_SQL).fetchall()
+                conn.executemany(
+                    "UPDATE job_tasks SET status = 'queued' WHERE id = ?",
+                    [(row["id"],) for row in rows],
+                )
+                return rows, exhausted
+
+        rows, exhausted = await self.db_manager.run(write)
+
+        self.fail_exhausted_tasks(exhausted)
+        for row in rows:
+            self.ready_tasks.put_nowait(dict(row))
+        if rows:
+            logger.info(f"Recovered {len(rows)} pending tasks")
+
+    def lease_owner_gone(self, owner: str) -> bool:
+        """
+        True if the process on this machine that a lease owner names
+        (host:pid:token) has exited. Our own pid under another token is an
+        earlier process whose pid was reused, as with pid 1 in a container.
+        """
+        try:
+            _, pid, _ = owner.split(":")
+            pid = int(pid)
+        except ValueError:
+            return False
+        if pid == os.getpid():
+            return owner != self.lease_owner
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # Running, as another user
+            return False
+        return False
+
+    async def reclaim_expired_leases_periodically(self):
+        """
+        Queues running tasks again once their lease expires, which only
+        happens if the worker running them stopped renewing it
+        """
+
+        def write():
+            with self.db_manager.get_db("jobs") as conn:
+                return reclaim_expired_leases(conn, TASK_MAX_ATTEMPTS)
+
+        while True:
+            await asyncio.sleep(TASK_LEASE_SECONDS)
+            try:
+                requeued, exhausted = await self.db_manager.run(write)
+            except Exception as e:
+                logger.exception(f"Error reclaiming expired task leases: {str(e)}")
+                continue
+            self.fail_exhausted_tasks(exhausted)
+            for row in requeued:
+                logger.warning(
+                    f"Lease on task {row['id']} held by {row['lease_owner']} expired, "
+                    f"queueing it again"
+                )
+                self.ready_tasks.put_nowait(row)
+
+    def fail_exhausted_tasks(self, exhausted):
+        """Reports tasks reclaim_expired_leases failed after TASK_MAX_ATTEMPTS leases"""
+        for row in exhausted:
+            logger.error(
+                f"Task {row['id']} of job {row['job_id']} was leased {row['attempts']} "
+                f"times without finishing, failing the job"
+            )
+            self.reruns.pop(row["job_id"], None)
+            emit_job_event(
+                "task_failed",
+                row["job_id"],
+                task_id=row["id"],
+                task_type=row["task_type"],
+                error="LeaseExpired",
+            )
+            emit_job_event("job_failed", row["job_id"], task_type=row["task_type"])
 
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
     async def execute_task(self, task):
-        logger.info(f"Executing task: {json.dumps(task, indent=2)}")
+        """
+        Runs the task's handler, unless it's deterministic and some job
+        already ran it on the same inputs, in which case that result is used
+        """
         task_type = TaskType[task["task_type"]]
         handler = getattr(self, f"handle_{task_type.name.lower()}", None)
         if not handler:
             raise ValueError(f"No handler for task type: {task['task_type']}")
 
-        result = await handler(task["job_id"], task["id"])
-        version_id = await self.version_manager.create_version(task["id"], result)
+        memo_key = self.memo_key(task)
+        if memo_key is not None and not task.get("force"):
+            memoized = await self.db_manager.run(recall_task_result, memo_key, readonly=True)
+            if memoized is not None:
+                self.memo_hits[task_type.name] += 1
+                await self.db_manager.run(touch_task_memo, memoized["rowid"])
+                task["memoized"] = True
+                return memoized["result"]
+            self.memo_misses[task_type.name] += 1
+
+        if task_type.value.per_page:
+            return await handler(task["job_id"], task["id"], task["page_index"])
+        return await handler(task["job_id"], task["id"])
+
+    def memo_key(self, task):
+        """
+        What a deterministic task's result is memoized under: its type, the
+        handler's version, its input hash and the embedding model (which the
+        keyword tasks' results depend on). None for other tasks.
+        """
+        spec = TaskType[task["task_type"]].value
+        if not spec.is_deterministic or not task.get("input_hash"):
+            return None
+        return (
+            task["task_type"],
+            spec.handler_version,
+            task["input_hash"],
+            embedding_service.model_name,
+        )
+
+    def memo_stats(self) -> Dict[str, Any]:
+        by_type = {}
+        for task_type in sorted(set(self.memo_hits) | set(self.memo_misses)):
+            hits, misses = self.memo_hits[task_type], self.memo_misses[task_type]
+            by_type[task_type] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses),
+            }
+        return {"by_task_type": by_type, "evictions": self.memo_evictions}
+
+    async def complete_task(self, task, result, started: float = None) -> int:
+        """
+        The one place a task's result is written: a new version, the current
+        version pointer and the completed status, in a single transaction
+        """
+        result_json = json.dumps(result)
+        memoized = task.get("memoized", False)
+        version_id = await self.version_manager.create_version(
+            task["id"],
+            result,
+            task_status="completed",
+            result_json=result_json,
+            input_hash=task.get("input_hash"),
+            memo_key=None if memoized else self.memo_key(task),
+            lease=task.get("lease"),
+        )
         self.latest_versions[task["id"]] = version_id
-        await self.update_task_status(task["job_id"], task["id"], "completed")
-        await self.update_task_current_version(task["id"], version_id)
+        emit_job_event(
+            "task_completed",
+            task["job_id"],
+            task_id=task["id"],
+            task_type=task["task_type"],
+            page=task.get("page_index"),
+            version_id=version_id,
+            result_bytes=len(result_json),
+            summary=summarize_result(result),
+            duration_ms=None
+            if started is None
+            else round((time.perf_counter() - started) * 1000, 1),
+            **({"memoized": True} if memoized else {}),
+        )
+        return version_id
 
-        # Log the full job state
-        try:
-            full_job_state = await self.get_job_with_tasks_and_versions(task["job_id"])
-            logger.info(f"Full job state after task {task['id']} completion: {json.dumps(full_job_state, indent=2)}")
-        except Exception as e:
-            logger.error(f"Failed to get full job state: {str(e)}")
+    async def reuse_stored_version(self, task, started: float) -> bool:
+        """
+        Completes the task with a version it already has if that version was
+        computed from the same inputs the task has now. Returns whether it did.
+
+        The current version is kept whenever the task's inputs haven't changed
+        since it was computed, which is how a rerun skips the tasks an edit
+        didn't reach. An older version is only brought back for deterministic
+        tasks, since another run of a non-deterministic one could come out
+        differently. A task rerun on purpose (task["force"]) always runs.
+        """
+        input_hash, stored = await self.db_manager.run(
+            find_stored_version,
+            task["id"],
+            task["job_id"],
+            task["task_type"],
+            task.get("page_index"),
+            readonly=True,
+        )
+        task["input_hash"] = input_hash
+        if stored is None or task.get("force"):
+            return False
+        if not stored["is_current"] and not TaskType[task["task_type"]].value.is_deterministic:
+            return False
+
+        await self.db_manager.run(
+            use_task_version, task["id"], stored["id"], lease=task.get("lease")
+        )
+        self.latest_versions[task["id"]] = stored["id"]
+        emit_job_event(
+            "task_completed",
+            task["job_id"],
+            task_id=task["id"],
+            task_type=task["task_type"],
+            page=task.get("page_index"),
+            version_id=stored["id"],
+            result_bytes=stored["size"],
+            reused=True,
+            duration_ms=round((time.perf_counter() - started) * 1000, 1),
+        )
+        return True
 
-        return result
+    async def queue_ready_tasks(self, job_id: str, job_started_at: str):
+        """
+        Queues the job's tasks that were only waiting on tasks that have now
+        completed, or finishes the job if nothing is left to run
+        """
 
-    async def update_task_result(self, task, result):
-        version_id = await self.version_manager.create_version(task["id"], result)
-        self.latest_versions[task["id"]] = version_id
-        await self.update_task_status(task["job_id"], task["id"], "completed")
-        await self.update_task_current_version(task["id"], version_id)
+        def write():
+            with self.db_manager.get_db("jobs") as conn:
+                return claim_ready_tasks(conn, job_id)
 
-    async def prepare_next_task(self, current_task):
-        next_task = await self.get_next_task(current_task["job_id"], current_task["task_order"])
-        if next_task:
-            await self.update_task_status(next_task["job_id"], next_task["id"], "pending")
+        ready = await self.db_manager.run(write)
+        for task in ready:
+            self.ready_tasks.put_nowait({**task, "job_started_at": job_started_at})
+        if not ready:
+            await self.check_job_completion(job_id)
 
     async def rollback_job(self, job_id):
-        with db_manager.get_db("jobs") as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM job_tasks WHERE job_id = ?", (job_id,))
-            cursor.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        def write():
+            with db_manager.get_db("jobs") as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM job_tasks WHERE job_id = ?", (job_id,))
+                cursor.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+        await self.db_manager.run(write)
         logger.info(f"Rolled back job {job_id} due to disk full error")
 
     async def get_job_data(self, job_id: str) -> Dict[str, Any]:
-        with db_manager.get_db("jobs") as conn:
-            job = conn.execute(
-                "SELECT data FROM jobs WHERE id = ?", (job_id,)
-            ).fetchone()
-            return json.loads(job["data"]) if job else None
-
-    async def get_next_pending_task(self):
-        logger.debug("Fetching next pending task")
-        with self.db_manager.get_db("jobs") as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT id, job_id, task_type, task_order
-                FROM job_tasks
-                WHERE status = 'pending'
-                ORDER BY created_at ASC
-                LIMIT 1
-                """
-            )
-            task = cursor.fetchone()
-            
-        if task:
-            logger.debug(f"Found pending task: {task[0]}")
-            return {
-                "id": task[0],
-                "job_id": task[1],
-                "task_type": task[2],
-                "task_order": task[3],
-            }
-        else:
-            logger.debug("No pending tasks found")
-            return None
+        def read():
+            with db_manager.get_db("jobs", readonly=True) as conn:
+                job = conn.execute(
+                    "SELECT data FROM jobs WHERE id = ?", (job_id,)
+                ).fetchone()
+                return json.loads(job["data"]) if job else None
 
-    async def get_next_task(self, job_id: str, current_task_order: int):
-        with db_manager.get_db("jobs") as conn:
-            return conn.execute(
-                """
-                SELECT * FROM job_tasks
-                WHERE job_id = ? AND task_order = ?
-            """,
-                (job_id, current_task_order + 1),
-            ).fetchone()
+        return await self.db_manager.run(read, readonly=True)
 
     async def update_task_status(self, job_id: str, task_id: str, status: str):
-        with self.db_manager.get_db("jobs") as conn:
-            conn.execute(
-                """
-                UPDATE job_tasks
-                SET status = ?, updated_at = ?
-                WHERE id = ?
-                """,
-                (status, datetime.now(timezone.utc).isoformat(), task_id),
-            )
-            conn.commit()
+        def write():
+            with self.db_manager.get_db("jobs") as conn:
+                conn.execute(
+                    """
+                    UPDATE job_tasks
+                    SET status = ?, updated_at = ?
+                    WHERE id = ?
+                    """,
+                    (status, datetime.now(timezone.utc).isoformat(), task_id),
+                )
+                conn.commit()
 
-    async def check_job_completion(self, job_id: str):
-        with db_manager.get_db("jobs") as conn:
-            incomplete_tasks = conn.execute(
-                """
-                SELECT COUNT(*) FROM job_tasks
-                WHERE job_id = ? AND status != 'completed'
-            """,
-                (job_id,),
-            ).fetchone()[0]
+        await self.db_manager.run(write)
 
-            if incomplete_tasks == 0:
+    async def update_job_status(self, job_id: str, status: str):
+        def write():
+            with self.db_manager.get_db("jobs") as conn:
                 conn.execute(
                     """
                     UPDATE jobs
-                    SET status = 'completed', updated_at = ?
+                    SET status = ?, updated_at = ?
                     WHERE id = ?
-                """,
-                    (datetime.now(timezone.utc).isoformat(), job_id),
+                    """,
+                    (status, datetime.now(timezone.utc).isoformat(), job_id),
+                )
+
+        await self.db_manager.run(write)
+
+    async def check_job_completion(self, job_id: str):
+        """
+        Marks the job completed if all its tasks are. If some aren't but none
+        is queued or running either, nothing is left that could start them,
+        so the job is failed instead of staying pending for good.
+        """
+
+        def write():
+            with db_manager.get_db("jobs") as conn:
+                incomplete, in_progress = conn.execute(
+                    INCOMPLETE_TASK_COUNT_SQL, (job_id,)
+                ).fetchone()
+                now = datetime.now(timezone.utc).isoformat()
+
+                if incomplete == 0:
+                    conn.execute(
+                        """
+                        UPDATE jobs
+                        SET status = 'completed', updated_at = ?
+                        WHERE id = ?
+                    """,
+                        (now, job_id),
+                    )
+                    return True, None
+                if in_progress == 0:
+                    stuck = conn.execute(
+                        """
+                        SELECT task_type FROM job_tasks
+                        WHERE job_id = ? AND status != 'completed'
+                        ORDER BY task_order LIMIT 1
+                        """,
+                        (job_id,),
+                    ).fetchone()
+                    failed = conn.execute(
+                        """
+                        UPDATE jobs
+                        SET status = 'failed', updated_at = ?
+                        WHERE id = ? AND status != 'failed'
+                        """,
+                        (now, job_id),
+                    ).rowcount
+                    if failed:
+                        return False, stuck["task_type"]
+                return False, None
+
+        completed, stuck = await self.db_manager.run(write)
+        if stuck is not None:
+            logger.error(f"Job {job_id} has no task left that can run, failing it at {stuck}")
+            self.reruns.pop(job_id, None)
+            emit_job_event("job_failed", job_id, task_type=stuck)
+            return
+        if completed:
+            logger.info(f"Job {job_id} completed")
+            rerun = self.reruns.pop(job_id, None)
+            if rerun is None:
+                emit_job_event("job_completed", job_id)
+                return
+
+            rerun.pop("forced")
+            elapsed = time.perf_counter() - rerun.pop("started")
+            rerun["seconds"] = round(elapsed, 3)
+            message = (
+                f"Rerun of job {job_id} finished in {elapsed:.2f}s: executed "
+                f"{rerun['executed']} of {rerun['affected']} tasks, reused {rerun['reused']}"
+            )
+            if rerun["previous_seconds"]:
+                rerun["speedup"] = round(rerun["previous_seconds"] / elapsed, 1)
+                message += (
+                    f", against {rerun['previous_seconds']:.2f}s for the previous "
+                    f"run ({rerun['speedup']}x)"
                 )
-                logger.info(f"Job {job_id} completed")
+            logger.info(message)
+            emit_job_event("job_completed", job_id, rerun=rerun)
 
     async def get_detailed_job_status(self, job_id: str) -> Dict[str, Any]:
-        with db_manager.get_db("jobs") as conn:
-            job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
-            if not job:
-                logger.warning(f"No job found with id {job_id}")
-                return None
-
-            tasks = conn.execute(
-                """
-                SELECT jt.id, jt.task_type, jt.status, tv.result
-                FROM job_tasks jt
-                LEFT JOIN current_task_versions ctv ON jt.id = ctv.task_id
-                LEFT JOIN task_versions tv ON ctv.version_id = tv.id
-                WHERE jt.job_id = ?
-                ORDER BY jt.task_order
-            """,
-                (job_id,),
-            ).fetchall()
+        snapshot = await self.db_manager.run(
+            load_job_snapshot, job_id, results=True, readonly=True
+        )
+        if snapshot is None:
+            logger.warning(f"No job found with id {job_id}")
+            return None
+        return snapshot.status_dict(include_data=True)
+
+    async def get_job_progress(self, job_id: str) -> Dict[str, Any]:
+        """Job and task statuses only, without reading any results"""
+        snapshot = await self.db_manager.run(load_job_snapshot, job_id, readonly=True)
+        return snapshot.status_dict() if snapshot else None
+
+    async def get_job_snapshot(self, job_id: str, results=False, with_versions=False):
+        return await self.db_manager.run(
+            load_job_snapshot,
+            job_id,
+            results=results,
+            with_versions=with_versions,
+            readonly=True,
+        )
 
-        logger.debug(f"Raw tasks data for job {job_id}: {json.dumps([dict(t) for t in tasks], indent=2)}")
+    async def rerun_task(self, task_id: str) -> List[Dict[str, Any]]:
+        """
+        Runs a task again along with whatever depends on it. The task itself
+        is always executed, its dependents only if its result changes.
+        """
 
-        return {
-            "job_id": job_id,
-            "status": job["status"],
-            "tasks": [
-                {
-                    "id": t["id"],
-                    "type": t["task_type"],
-                    "status": t["status"],
-                    "data": json.loads(t["result"]) if t["result"] else None,
-                }
-                for t in tasks
-            ],
-        }
+        def read():
+            with db_manager.get_db("jobs", readonly=True) as conn:
+                task = conn.execute(
+                    "SELECT job_id FROM job_tasks WHERE id = ?", (task_id,)
+                ).fetchone()
+            return task
 
-    async def rerun_task(self, task_id: str):
-        with db_manager.get_db("jobs") as conn:
-            task = conn.execute(
-                "SELECT * FROM job_tasks WHERE id = ?", (task_id,)
-            ).fetchone()
+        task = await self.db_manager.run(read, readonly=True)
 
         if not task:
             raise ValueError(f"No task found with id: {task_id}")
 
-        handler = getattr(self, f"handle_{task['task_type']}", None)
-        if not handler:
-            raise ValueError(f"No handler for task type: {task['task_type']}")
+        return await self.start_rerun(task["job_id"], task_id=task_id)
 
-        result = await handler(task["job_id"], task["id"])
-        version_id = await self.version_manager.create_version(task["id"], result)
-        self.latest_versions[task["id"]] = version_id
-        await self.update_task_status(task["job_id"], task["id"], "completed")
-        await self.update_task_current_version(task["id"], version_id)
-
-    async def update_task_current_version(self, task_id: str, version_id: int):
-        with db_manager.get_db("jobs") as conn:
-            conn.execute(
-                """
-                INSERT OR REPLACE INTO current_task_versions (task_id, version_id)
-                VALUES (?, ?)
-            """,
-                (task_id, version_id),
+    async def edit_job(self, job_id: str, changes: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Updates a finished job's data with changes and reruns it. Only tasks
+        whose inputs come out different are executed again.
+        """
+        return await self.start_rerun(job_id, changes=changes)
+
+    async def start_rerun(
+        self, job_id: str, task_id: str = None, changes: Dict[str, Any] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Sets a finished job running again from task_id, or from the start if
+        there isn't one, after merging changes into the job's data
+
+        Only that task, the tasks downstream of it and any the last run
+        didn't complete are reset to pending. When each comes up,
+        reuse_stored_version skips it if its inputs are the same as last
+        time, so only the part of the job a change actually reaches is
+        executed. Returns the tasks that were reset.
+
+        Raises JobInProgressError if the job hasn't finished, and JobEditError
+        if changes would change how many pages it has, since its per-page
+        tasks were created for the pages it was submitted with.
+        """
+        started_at = datetime.now(timezone.utc).isoformat()
+
+        def write():
+            with self.db_manager.get_db("jobs") as conn:
+                job = conn.execute(
+                    "SELECT status, data, created_at, started_at, updated_at FROM jobs WHERE id = ?",
+                    (job_id,),
+                ).fetchone()
+                if job is None:
+                    raise ValueError(f"No job found with id: {job_id}")
+                if job["status"] not in ("completed", "failed"):
+                    raise JobInProgressError(f"Job {job_id} is still {job['status']}")
+
+                add_job_task_dependencies(conn, job_id)
+                if task_id is None:
+                    tasks = conn.execute(
+                        """
+                        SELECT id, job_id, task_type, task_order, page_index FROM job_tasks
+                        WHERE job_id = ?
+                        ORDER BY task_order
+                        """,
+                        (job_id,),
+                    ).fetchall()
+                else:
+                    tasks = conn.execute(AFFECTED_TASKS_SQL, (task_id, job_id)).fetchall()
+
+                job_data = json.loads(job["data"])
+                for key, value in (changes or {}).items():
+                    if isinstance(value, dict) and isinstance(job_data.get(key), dict):
+                        value = {**job_data[key], **value}
+                    job_data[key] = value
+                page_count = len(job_pages(json.loads(job["data"])))
+                if len(job_pages(job_data)) != page_count:
+                    raise JobEditError(
+                        f"Job {job_id} has {page_count} pages, an edit can change "
+                        f"them but not add or remove any"
+                    )
+
+                # A task still running from the failed run loses its lease,
+                # so it can't finish over the top of this one
+                conn.executemany(
+                    """
+                    UPDATE job_tasks
+                    SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL,
+                        attempts = 0, updated_at = ?
+                    WHERE id = ?
+                    """,
+                    [(started_at, task["id"]) for task in tasks],
+                )
+                conn.execute(
+                    """
+                    UPDATE jobs
+                    SET status = 'pending', data = ?, started_at = ?, updated_at = ?
+                    WHERE id = ?
+                    """,
+                    (json.dumps(job_data), started_at, started_at, job_id),
+                )
+                ready = claim_ready_tasks(conn, job_id)
+                return dict(job), [dict(task) for task in tasks], ready
+
+        job, tasks, ready = await self.db_manager.run(write)
+
+        previous_seconds = None
+        if job["status"] == "completed":
+            previous_run = datetime.fromisoformat(job["updated_at"]) - datetime.fromisoformat(
+                job["started_at"] or job["created_at"]
             )
-        logger.info(f"Updated current version for task {task_id} to {version_id}")
+            previous_seconds = previous_run.total_seconds()
+        self.reruns[job_id] = {
+            "started": time.perf_counter(),
+            "previous_seconds": previous_seconds,
+            "affected": len(tasks),
+            "executed": 0,
+            "reused": 0,
+            # Executed even if its inputs haven't changed, see run_task
+            "forced": task_id,
+        }
+
+        logger.info(f"Rerunning {len(tasks)} tasks of job {job_id}")
+        for task in ready:
+            self.ready_tasks.put_nowait({**task, "job_started_at": started_at})
+        if not ready:
+            await self.check_job_completion(job_id)
+        return tasks
 
     async def get_task_current_version(self, task_id: str):
         return self.latest_versions.get(task_id)
 
-    async def get_previous_task_data(self, job_id: str, task_type: str):
-        logger.info(f"Attempting to get previous task data for job {job_id}, task type {task_type}")
-        detailed_status = await self.get_detailed_job_status(job_id)
-        for task in detailed_status['tasks']:
-            if task['type'] == task_type:
-                logger.info(f"Found previous task {task['id']} with status {task['status']}")
-                if task['status'] == 'completed':
-                    versions = await self.version_manager.list_versions(task['id'])
-                    logger.info(f"Versions for task {task['id']}: {versions}")
-                    if versions:
-                        latest_version = max(versions, key=lambda v: v['id'])
-                        result = await self.version_manager.get_version(task['id'], latest_version['id'])
-                        if result is not None:
-                            logger.info(f"Retrieved result for task {task['id']}, version {latest_version['id']}")
-                            return result
-                        else:
-                            logger.warning(f"No result found for task {task['id']}, version {latest_version['id']}")
-                    else:
-                        logger.warning(f"No versions found for completed task {task['id']}")
-                else:
-                    logger.warning(f"Previous task {task['id']} of type {task_type} for job {job_id} has status: {task['status']}")
-        logger.error(f"No completed task of type {task_type} found for job {job_id}")
-        return None
+    async def get_previous_task_data(self, job_id: str, task_type: str, page_index: int = None):
+        """
+        The current result of the job's task_type task (page_index's, for a
+        per-page task), or None if it isn't completed
+        """
+        snapshot = await self.db_manager.run(
+            load_job_snapshot, job_id, results=[task_type], readonly=True
+        )
+        task = snapshot.task(task_type, page_index) if snapshot else None
+        if task is None:
+            logger.error(f"No task of type {task_type} found for job {job_id}")
+            return None
+        if task.status != "completed":
+            logger.warning(f"Previous task {task.id} of type {task_type} for job {job_id} has status: {task.status}")
+            return None
+        if not task.has_result:
+            logger.warning(f"No result found for completed task {task.id}")
+            return None
+        return task.result
 
     # Handler methods
 
@@ -501,18 +1160,15 @@ class JobManager:
             # Process the input data
             processed_data = {
                 "company_string": f"Basic company profile: \n Name: {job_data['companyName']}\n Description: {job_data['companyDescription']}\n Website: {job_data['companyUrl']}",
-                "page_string": f"Page to generate:\n URL: {job_data['current_page']['url']}\n Title: {job_data['current_page']['title']}\n Info: {job_data['current_page']['info']}\n USP: {job_data['current_page']['usp']}\n Is New Page: {job_data['current_page']['is_new']}",
+                "page_strings": [
+                    f"Page to generate:\n URL: {page['url']}\n Title: {page['title']}\n Info: {page['info']}\n USP: {page['usp']}\n Is New Page: {page['is_new']}"
+                    for page in job_pages(job_data)
+                ],
                 "locations": parse_json_or_list(job_data["locations"]),
                 "seed_keywords": parse_json_or_list(job_data["seedKeywords"]),
                 "page_type": job_data["pageType"],
             }
-            
-            logger.info(f"Processed data for job {job_id}: {processed_data}")
-            
-            # Store the processed data
-            version_id = await self.version_manager.create_version(task_id, processed_data)
-            logger.info(f"Stored processed data for task {task_id}, version {version_id}")
-            
+
             return processed_data
         except Exception as e:
             logger.error(f"Error in handle_process_initial_input for job {job_id}: {str(e)}")
@@ -520,7 +1176,6 @@ class JobManager:
 
     async def handle_generate_similar_keywords(self, job_id: str, task_id: str):
         try:
-            logger.info(f"Starting handle_generate_similar_keywords for job {job_id}")
             previous_task_data = await self.get_previous_task_data(job_id, TaskType.PROCESS_INITIAL_INPUT.name)
             if not previous_task_data:
                 logger.error(f"Previous task data not found for job {job_id}")
@@ -533,30 +1188,31 @@ class JobManager:
                 logger.error(f"Invalid previous task data for job {job_id}: locations or seed_keywords missing")
                 raise ValueError("Invalid previous task data")
 
-            logger.info(f"Generating similar keywords for job {job_id}")
-            logger.info(f"Locations: {locations}")
-            logger.info(f"Seed keywords: {seed_keywords}")
+            logger.debug(
+                f"Generating similar keywords for job {job_id}: "
+                f"{len(seed_keywords)} seeds in {len(locations)} locations"
+            )
 
             similar_kw_dict = {}
-            full_kw_list = []
-
-            for loc in locations:
-                results = await keywords.get_similar_multi(seed_keywords, loc)
-                similar_kw_dict[loc] = results
-                for kw in results:
-                    full_kw_list.extend(results[kw])
 
-            # Remove duplicates
-            full_kw_list = list(set(full_kw_list))
-
-            result = {
-                "similar_kw_dict": similar_kw_dict,
-                "full_kw_list": full_kw_list,
-            }
+            # Locations are fetched concurrently; the rate limiter only holds
+            # back the requests that actually go out to the provider
+            location_results = await asyncio.gather(
+                *(keywords.get_similar_multi(seed_keywords, loc) for loc in locations)
+            )
+            # Searched on the embedding thread like every other use of the model
+            discovered = await run_embedding_task(
+                embedding_service.discover_keywords,
+                seed_keywords,
+                DISCOVERED_KEYWORD_THRESHOLD,
+                DISCOVERED_KEYWORDS_PER_SEED,
+            )
+            for loc, results in zip(locations, location_results):
+                similar_kw_dict[loc] = add_discovered_keywords(results, discovered)
 
-            logger.info(f"Generated similar keywords for job {job_id}")
-            await self.version_manager.create_version(task_id, result)
-            logger.info(f"Stored similar keywords for task {task_id}")
+            # The deduplicated list is derived by the tasks that need it
+            # rather than stored, it was most of this result's size
+            result = {"similar_kw_dict": similar_kw_dict}
 
             return result
         except Exception as e:
@@ -567,22 +1223,19 @@ class JobManager:
         previous_data = await self.get_previous_task_data(job_id, TaskType.GENERATE_SIMILAR_KEYWORDS.name)
         if not previous_data:
             raise ValueError("Previous task data not found")
-        full_kw_list = previous_data["full_kw_list"]
+        full_kw_list = full_keyword_list(previous_data["similar_kw_dict"])
         initial_input_data = await self.get_previous_task_data(job_id, TaskType.PROCESS_INITIAL_INPUT.name)
         if not initial_input_data:
             raise ValueError("Initial input data not found")
         seed_keywords = initial_input_data["seed_keywords"]
 
-        bucketed = {}
-        for kw in seed_keywords:
-            bucketed[kw] = embedding_service.bucket_cosine(
-                kw, full_kw_list, center_type="keyword"
-            )
+        def bucket_keywords():
+            seed_embeddings = embedding_service.get_embedding_matrix(seed_keywords)
+            centers = dict(zip(seed_keywords, seed_embeddings))
+            centers["seed centroid"] = np.mean(seed_embeddings, axis=0)
+            return embedding_service.bucket_cosine_many(centers, full_kw_list)
 
-        centroid = embedding_service.get_centroid(seed_keywords)
-        bucketed["seed centroid"] = embedding_service.bucket_cosine(
-            centroid, full_kw_list, center_type="embedding"
-        )
+        bucketed = await run_embedding_task(bucket_keywords)
 
         best_keywords = {}
         for page in bucketed:
@@ -592,31 +1245,32 @@ class JobManager:
                     temp.extend(kw_list)
             best_keywords[page] = temp
 
-        await self.version_manager.create_version(task_id, best_keywords)
         return best_keywords
 
     async def handle_generate_clusters(self, job_id: str, task_id: str) -> List[Dict[str, Any]]:
         previous_data = await self.get_previous_task_data(job_id, TaskType.GENERATE_SIMILAR_KEYWORDS.name)
         if not previous_data:
             raise ValueError("Previous task data not found")
-        full_kw_list = previous_data["full_kw_list"]
+        full_kw_list = full_keyword_list(previous_data["similar_kw_dict"])
         initial_input_data = await self.get_previous_task_data(job_id, TaskType.PROCESS_INITIAL_INPUT.name)
         if not initial_input_data:
             raise ValueError("Initial input data not found")
         seed_keywords = initial_input_data["seed_keywords"]
 
-        clustered = embedding_service.hierarchical_clustering(
-            full_kw_list, len(seed_keywords)
+        n_clusters = len(seed_keywords)
+        embeddings = await run_embedding_task(
+            embedding_service.get_embedding_matrix, full_kw_list
         )
+        labels = await cluster_in_process(embeddings, n_clusters)
+        clustered = embedding_service.group_by_label(full_kw_list, labels, n_clusters)
 
         clusters = [
             {"cluster_id": i, "keywords": cluster}
-            for i, cluster in enumerate(clustered)
+            for i, cluster in clustered.items()
         ]
-        await self.version_manager.create_version(task_id, clusters)
         return clusters
 
-    async def handle_select_best_cluster(self, job_id: str, task_id: str):
+    async def handle_select_best_cluster(self, job_id: str, task_id: str, page_index: int):
         previous_data = await self.get_previous_task_data(job_id, TaskType.GENERATE_CLUSTERS.name)
         if not previous_data:
             raise ValueError("Previous task data not found")
@@ -624,24 +1278,35 @@ class JobManager:
         initial_input_data = await self.get_previous_task_data(job_id, TaskType.PROCESS_INITIAL_INPUT.name)
         if not initial_input_data:
             raise ValueError("Initial input data not found")
-        page_string = initial_input_data["page_string"]
+        page_string = page_strings(initial_input_data)[page_index]
 
         # Here, you might want to implement a more sophisticated cluster selection method
         # For now, we'll just select the cluster with the highest similarity to the page_string
-        best_cluster = max(clusters, key=lambda c: embedding_service.cosine_similarity(page_string, " ".join(c["keywords"])))
+        # Neither the page string nor the joined clusters will be embedded
+        # again, so they're kept out of the persistent embedding store
+        def score_clusters():
+            return embedding_service.similarity_scores(
+                embedding_service.get_embedding(page_string, persist=False),
+                [" ".join(c["keywords"]) for c in clusters],
+                persist=False,
+            )
+
+        scores = await run_embedding_task(score_clusters)
+        best_cluster = clusters[int(np.argmax(scores))]
         result = {"best_cluster": best_cluster}
-        await self.version_manager.create_version(task_id, result)
         return result
 
-    async def handle_generate_html(self, job_id: str, task_id: str):
-        best_cluster = await self.get_previous_task_data(job_id, TaskType.SELECT_BEST_CLUSTER.name)
+    async def handle_generate_html(self, job_id: str, task_id: str, page_index: int):
+        best_cluster = await self.get_previous_task_data(
+            job_id, TaskType.SELECT_BEST_CLUSTER.name, page_index
+        )
         if not best_cluster:
             raise ValueError("Best cluster data not found")
         initial_data = await self.get_previous_task_data(job_id, TaskType.PROCESS_INITIAL_INPUT.name)
         if not initial_data:
             raise ValueError("Initial data not found")
         company_info = initial_data.get("company_string", "")
-        page_info = initial_data.get("page_string", "")
+        page_info = page_strings(initial_data)[page_index]
 
         # Here, you might want to use a language model to generate the HTML content
         # For now, we'll create a simple HTML structure
@@ -665,57 +1330,48 @@ class JobManager:
         """
 
         result = {"generated_html": html}
-        await self.version_manager.create_version(task_id, result)
         return result
 
     async def get_job_with_tasks_and_versions(self, job_id: str) -> Dict[str, Any]:
-        job_data = await self.get_job_data(job_id)
-        if not job_data:
+        snapshot = await self.get_job_snapshot(job_id, with_versions=True)
+        if snapshot is None:
             logger.warning(f"No job data found for job {job_id}")
             return None
 
-        detailed_status = await self.get_detailed_job_status(job_id)
-        logger.debug(f"Detailed status for job {job_id}: {json.dumps(detailed_status, indent=2)}")
-        
-        tasks_with_versions = []
-        for task in detailed_status['tasks']:
-            logger.debug(f"Processing task in get_job_with_tasks_and_versions: {json.dumps(task, indent=2)}")
-            task_versions = await self.version_manager.list_versions(task['id'])
-            logger.debug(f"Versions for task {task['id']}: {json.dumps(task_versions, indent=2)}")
-            task_with_versions = {
-                'id': task['id'],
-                'type': task['type'],
-                'status': task['status'],
-                'versions': []
-            }
-            for version in task_versions:
-                version_result = await self.version_manager.get_version(task['id'], version['id'])
-                if version_result is not None:
-                    task_with_versions['versions'].append({
-                        'id': version['id'],
-                        'created_at': version['created_at'],
-                        'result': version_result
-                    })
-                else:
-                    logger.warning(f"No result found for task {task['id']}, version {version['id']}")
-            tasks_with_versions.append(task_with_versions)
-
         return {
             'job_id': job_id,
-            'status': detailed_status['status'],
-            'data': job_data,
-            'tasks': tasks_with_versions
+            'status': snapshot.status,
+            'data': snapshot.data,
+            'tasks': [
+                {
+                    'id': task.id,
+                    'type': task.task_type,
+                    'page': task.page_index,
+                    'status': task.status,
+                    'versions': [
+                        {
+                            'id': version.id,
+                            'created_at': version.created_at,
+                            'result': version.result,
+                        }
+                        for version in task.versions
+                    ],
+                }
+                for task in snapshot.tasks
+            ],
         }
 
-    async def log_job_state(self, job_id: str):
-        job_data = await self.get_job_data(job_id)
-        detailed_status = await self.get_detailed_job_status(job_id)
+    async def log_job_state(self, job_id: str) -> Dict[str, Any]:
+        """
+        Logs and returns everything stored for a job, every version included
+
+        This is expensive on a job with a lot of versions, so it's only called
+        from the /debug/job/{job_id} route, never while tasks are running.
+        """
         full_job_state = await self.get_job_with_tasks_and_versions(job_id)
-        
-        logger.info(f"Current state of job {job_id}:")
-        logger.info(f"Job data: {json.dumps(job_data, indent=2)}")
-        logger.info(f"Detailed status: {json.dumps(detailed_status, indent=2)}")
-        logger.info(f"Full job state: {json.dumps(full_job_state, indent=2)}")
+        if full_job_state is not None:
+            logger.info(f"Full job state: {json.dumps(full_job_state, indent=2)}")
+        return full_job_state
 
 
 job_manager = JobManager(db_manager)
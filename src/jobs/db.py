@@ -1,16 +1,19 @@
+import hashlib
 import json
 import logging
 import sqlite3
-from datetime import datetime, timezone
-from typing import Any, Dict, List
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 from db import db_manager
+from .tasks import TaskType
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
 def create_tables(conn: sqlite3.Connection):
+    add_missing_columns(conn)
     with conn:
         cursor = conn.cursor()
         cursor.executescript("""
@@ -18,7 +21,10 @@ def create_tables(conn: sqlite3.Connection):
             id TEXT PRIMARY KEY,
             status TEXT,
             data JSON,
+            user_email TEXT,
             created_at TIMESTAMP,
+            -- When the job was last queued to run, either created or rerun
+            started_at TIMESTAMP,
             updated_at TIMESTAMP
         );
 
@@ -27,26 +33,63 @@ def create_tables(conn: sqlite3.Connection):
             job_id TEXT,
             task_type TEXT,
             task_order INTEGER,
+            -- Which page of the job a per-page task is for, NULL for the others
+            page_index INTEGER,
+            -- pending, queued once its dependencies are done, running while a
+            -- worker holds the lease on it, then completed or failed
             status TEXT,
+            -- Which process holds a running task and until when, see lease_task
+            lease_owner TEXT,
+            lease_expires_at TIMESTAMP,
+            -- How many times the task has been leased since it was last reset
+            attempts INTEGER DEFAULT 0,
             created_at TIMESTAMP,
             updated_at TIMESTAMP,
             FOREIGN KEY (job_id) REFERENCES jobs(id)
         );
 
+        -- Task results, zlib compressed and keyed by the sha256 of their
+        -- JSON, so a rerun that produces the same result stores nothing new
+        CREATE TABLE IF NOT EXISTS result_blobs (
+            hash TEXT PRIMARY KEY,
+            data BLOB,
+            size INTEGER,
+            created_at TIMESTAMP
+        );
+
         CREATE TABLE IF NOT EXISTS task_versions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             task_id TEXT,
-            result JSON,
+            result_hash TEXT,
+            -- Hash of the inputs the result was computed from, see task_input_hash
+            input_hash TEXT,
             created_at TIMESTAMP,
-            FOREIGN KEY (task_id) REFERENCES job_tasks(id)
+            FOREIGN KEY (task_id) REFERENCES job_tasks(id),
+            FOREIGN KEY (result_hash) REFERENCES result_blobs(hash)
         );
 
         CREATE TABLE IF NOT EXISTS current_task_versions (
             task_id TEXT PRIMARY KEY,
             version_id INTEGER,
-            result JSON,
+            result_hash TEXT,
             FOREIGN KEY (task_id) REFERENCES job_tasks(id),
-            FOREIGN KEY (version_id) REFERENCES task_versions(id)
+            FOREIGN KEY (version_id) REFERENCES task_versions(id),
+            FOREIGN KEY (result_hash) REFERENCES result_blobs(hash)
+        );
+
+        -- Results of deterministic tasks by what they were computed from, so
+        -- another job with the same inputs can reuse them. See recall_task_result.
+        CREATE TABLE IF NOT EXISTS task_memo (
+            task_type TEXT,
+            handler_version INTEGER,
+            input_hash TEXT,
+            embedding_model TEXT,
+            result_hash TEXT,
+            hits INTEGER DEFAULT 0,
+            created_at TIMESTAMP,
+            last_used_at TIMESTAMP,
+            PRIMARY KEY (task_type, handler_version, input_hash, embedding_model),
+            FOREIGN KEY (result_hash) REFERENCES result_blobs(hash)
         );
 
         CREATE TABLE IF NOT EXISTS task_dependencies (
@@ -57,12 +100,264 @@ def create_tables(conn: sqlite3.Connection):
             FOREIGN KEY (dependency_task_id) REFERENCES job_tasks(id)
         );
 
-        CREATE INDEX IF NOT EXISTS idx_job_tasks_job_id ON job_tasks(job_id);
-        CREATE INDEX IF NOT EXISTS idx_task_versions_task_id ON task_versions(task_id);
+        -- Job snapshots and reruns, which list a job's tasks by task_order
+        CREATE INDEX IF NOT EXISTS idx_job_tasks_job_order ON job_tasks(job_id, task_order);
+        -- check_job_completion counts a job's unfinished tasks
+        CREATE INDEX IF NOT EXISTS idx_job_tasks_job_status ON job_tasks(job_id, status);
+        -- recover_pending_tasks only ever looks at tasks waiting to run, oldest first
+        CREATE INDEX IF NOT EXISTS idx_job_tasks_waiting ON job_tasks(created_at)
+            WHERE status IN ('pending', 'queued');
+        -- reclaim_expired_leases only looks at running tasks
+        CREATE INDEX IF NOT EXISTS idx_job_tasks_running ON job_tasks(lease_expires_at)
+            WHERE status = 'running';
+        CREATE INDEX IF NOT EXISTS idx_jobs_user_status ON jobs(user_email, status);
+        -- Finding a task's stored version for a given input hash
+        CREATE INDEX IF NOT EXISTS idx_task_versions_task_input ON task_versions(task_id, input_hash);
         CREATE INDEX IF NOT EXISTS idx_task_versions_created_at ON task_versions(created_at);
         CREATE INDEX IF NOT EXISTS idx_task_dependencies_dependent ON task_dependencies(dependent_task_id);
         CREATE INDEX IF NOT EXISTS idx_task_dependencies_dependency ON task_dependencies(dependency_task_id);
+        -- evict_task_memo goes through entries least recently used first
+        CREATE INDEX IF NOT EXISTS idx_task_memo_last_used ON task_memo(last_used_at);
         """)
+        # Each of these is the first column of a composite index above, so
+        # they only cost writes
+        cursor.execute("DROP INDEX IF EXISTS idx_job_tasks_job_id")
+        cursor.execute("DROP INDEX IF EXISTS idx_task_versions_task_id")
+        # Replaced by idx_job_tasks_waiting once tasks could be queued
+        cursor.execute("DROP INDEX IF EXISTS idx_job_tasks_pending")
+    if move_results_to_blobs(conn):
+        # Reclaims the space the inline results took up
+        conn.execute("VACUUM")
+    conn.execute("PRAGMA optimize")
+
+
+RESULT_COMPRESSION_LEVEL = 6
+
+
+def encode_result(result_json: str) -> Tuple[str, bytes]:
+    """Returns (hash, compressed bytes) for a serialized result"""
+    raw = result_json.encode()
+    return hashlib.sha256(raw).hexdigest(), zlib.compress(raw, RESULT_COMPRESSION_LEVEL)
+
+
+def decode_result(data: Optional[bytes]) -> Any:
+    return None if data is None else json.loads(zlib.decompress(data))
+
+
+def store_result_blob(conn: sqlite3.Connection, result_json: str) -> str:
+    """Stores the result unless an identical one already is, and returns its hash"""
+    result_hash, data = encode_result(result_json)
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO result_blobs (hash, data, size, created_at)
+        VALUES (?, ?, ?, ?)
+        """,
+        (result_hash, data, len(result_json), datetime.now(timezone.utc).isoformat()),
+    )
+    return result_hash
+
+
+def move_results_to_blobs(conn: sqlite3.Connection) -> int:
+    """
+    Migrates databases from before result_blobs, where task_versions and
+    current_task_versions each held the full result JSON inline
+
+    Every inline result goes into result_blobs (current versions are the same
+    text as one of the task's versions, so they dedupe to the same blob) and
+    the result columns are dropped. Returns how many rows were moved.
+    """
+    tables = ("task_versions", "current_task_versions")
+    key_columns = {"task_versions": "id", "current_task_versions": "task_id"}
+    legacy = [
+        table
+        for table in tables
+        if "result" in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    ]
+    if not legacy:
+        return 0
+
+    moved = 0
+    with conn:
+        for table in legacy:
+            key = key_columns[table]
+            rows = conn.execute(
+                f"SELECT {key}, result FROM {table} WHERE result IS NOT NULL"
+            ).fetchall()
+            for row in rows:
+                result_hash = store_result_blob(conn, row[1])
+                conn.execute(
+                    f"UPDATE {table} SET result_hash = ? WHERE {key} = ?",
+                    (result_hash, row[0]),
+                )
+            moved += len(rows)
+
+            if sqlite3.sqlite_version_info >= (3, 35, 0):
+                conn.execute(f"ALTER TABLE {table} DROP COLUMN result")
+            else:
+                conn.execute(f"UPDATE {table} SET result = NULL")
+    logger.info(f"Moved {moved} inline task results into result_blobs")
+    return moved
+
+
+# The queries the scheduler runs on every task. check_query_plans makes sure
+# each of them is answered from an index.
+
+RECOVER_PENDING_TASKS_SQL = """
+    SELECT jt.id, jt.job_id, jt.task_type, jt.task_order, jt.page_index,
+           COALESCE(j.started_at, j.created_at) AS job_started_at
+    FROM job_tasks jt
+    JOIN jobs j ON j.id = jt.job_id
+    WHERE jt.status IN ('pending', 'queued')
+      AND j.status NOT IN ('completed', 'failed')
+      AND NOT EXISTS (
+          SELECT 1 FROM task_dependencies td
+          JOIN job_tasks dep ON dep.id = td.dependency_task_id
+          WHERE td.dependent_task_id = jt.id AND dep.status != 'completed'
+      )
+    ORDER BY jt.created_at ASC
+"""
+
+# A job's pending tasks with nothing left to wait for, see claim_ready_tasks
+READY_TASKS_SQL = """
+    SELECT jt.id, jt.job_id, jt.task_type, jt.task_order, jt.page_index
+    FROM job_tasks jt
+    WHERE jt.job_id = ? AND jt.status = 'pending'
+      AND NOT EXISTS (
+          SELECT 1 FROM task_dependencies td
+          JOIN job_tasks dep ON dep.id = td.dependency_task_id
+          WHERE td.dependent_task_id = jt.id AND dep.status != 'completed'
+      )
+    ORDER BY jt.task_order
+"""
+
+# Running tasks whose lease has run out, or that are held by owners matching
+# a pattern, see reclaim_expired_leases
+EXPIRED_LEASES_SQL = """
+    SELECT jt.id, jt.job_id, jt.task_type, jt.task_order, jt.page_index, jt.attempts,
+           jt.lease_owner, jt.lease_expires_at,
+           COALESCE(j.started_at, j.created_at) AS job_started_at
+    FROM job_tasks jt
+    JOIN jobs j ON j.id = jt.job_id
+    WHERE jt.status = 'running' AND (jt.lease_expires_at < ? OR jt.lease_owner GLOB ?)
+"""
+
+# How many of a job's tasks aren't completed, and how many of those are
+# queued or running, see check_job_completion
+INCOMPLETE_TASK_COUNT_SQL = """
+    SELECT COUNT(*) AS incomplete,
+           COALESCE(SUM(status IN ('queued', 'running')), 0) AS in_progress
+    FROM job_tasks
+    WHERE job_id = ? AND status != 'completed'
+"""
+
+ACTIVE_USER_JOBS_SQL = """
+    SELECT COUNT(*) FROM jobs
+    WHERE user_email = ? AND status NOT IN ('completed', 'failed')
+"""
+
+TASK_INPUTS_SQL = """
+    SELECT jt.task_type, ctv.result_hash, rb.data
+    FROM task_dependencies td
+    JOIN job_tasks jt ON jt.id = td.dependency_task_id
+    LEFT JOIN current_task_versions ctv ON ctv.task_id = jt.id
+    LEFT JOIN result_blobs rb ON rb.hash = ctv.result_hash
+    WHERE td.dependent_task_id = ?
+"""
+
+# The current version first, so an unchanged task keeps the version it has
+STORED_VERSION_SQL = """
+    SELECT tv.id, tv.result_hash, rb.size, tv.id = ctv.version_id AS is_current
+    FROM task_versions tv
+    LEFT JOIN current_task_versions ctv ON ctv.task_id = tv.task_id
+    LEFT JOIN result_blobs rb ON rb.hash = tv.result_hash
+    WHERE tv.task_id = ? AND tv.input_hash = ?
+    ORDER BY is_current DESC, tv.id DESC
+    LIMIT 1
+"""
+
+JOB_SNAPSHOT_SQL = """
+    SELECT j.status AS job_status, j.data AS job_data,
+           j.user_email AS job_user_email,
+           j.created_at AS job_created_at, j.updated_at AS job_updated_at,
+           jt.id, jt.task_type, jt.task_order, jt.page_index, jt.status, jt.updated_at,
+           ctv.version_id, {result_column} AS result
+    FROM jobs j
+    LEFT JOIN job_tasks jt ON jt.job_id = j.id
+    LEFT JOIN current_task_versions ctv ON ctv.task_id = jt.id
+    LEFT JOIN result_blobs rb ON rb.hash = ctv.result_hash
+    WHERE j.id = ?
+    ORDER BY jt.task_order
+"""
+
+JOB_VERSIONS_SQL = """
+    SELECT tv.id, tv.task_id, tv.created_at, rb.data AS result
+    FROM task_versions tv
+    JOIN job_tasks jt ON jt.id = tv.task_id
+    LEFT JOIN result_blobs rb ON rb.hash = tv.result_hash
+    WHERE jt.job_id = ?
+    ORDER BY tv.id
+"""
+
+HOT_QUERIES = {
+    "recover_pending_tasks": (RECOVER_PENDING_TASKS_SQL, ()),
+    "ready_tasks": (READY_TASKS_SQL, ("",)),
+    "expired_leases": (EXPIRED_LEASES_SQL, ("", "")),
+    "incomplete_task_count": (INCOMPLETE_TASK_COUNT_SQL, ("",)),
+    "active_user_jobs": (ACTIVE_USER_JOBS_SQL, ("",)),
+    "task_inputs": (TASK_INPUTS_SQL, ("",)),
+    "stored_version": (STORED_VERSION_SQL, ("", "")),
+    "job_snapshot": (JOB_SNAPSHOT_SQL.format(result_column="rb.data"), ("",)),
+    "job_versions": (JOB_VERSIONS_SQL, ("",)),
+}
+
+
+def check_query_plans(conn: sqlite3.Connection) -> Dict[str, List[str]]:
+    """
+    Runs EXPLAIN QUERY PLAN on each of HOT_QUERIES and logs a warning for
+    any that scans a whole table instead of using an index
+
+    Returns the full scans found, by query name. Run at startup so a schema
+    change that drops an index the scheduler relies on shows up in the logs
+    straight away rather than as slow jobs later.
+    """
+    full_scans = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        scans = [step for step in plan if step.startswith("SCAN ") and " USING " not in step]
+        if scans:
+            full_scans[name] = scans
+            logger.warning(f"Query {name} does a full table scan: {'; '.join(plan)}")
+    return full_scans
+
+
+def add_missing_columns(conn: sqlite3.Connection):
+    """
+    Adds columns introduced after a database was first created
+
+    CREATE TABLE IF NOT EXISTS leaves existing tables alone, so new columns
+    need an ALTER TABLE on databases that predate them.
+    """
+    columns = {
+        "jobs": {"user_email": "TEXT", "started_at": "TIMESTAMP"},
+        "job_tasks": {
+            "page_index": "INTEGER",
+            "lease_owner": "TEXT",
+            "lease_expires_at": "TIMESTAMP",
+            "attempts": "INTEGER DEFAULT 0",
+        },
+        "task_versions": {"result_hash": "TEXT", "input_hash": "TEXT"},
+        "current_task_versions": {"result_hash": "TEXT"},
+    }
+    with conn:
+        for table, table_columns in columns.items():
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if not existing:
+                # Table doesn't exist yet and will be created with every column
+                continue
+            for column, declaration in table_columns.items():
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+                    logger.info(f"Added column {table}.{column}")
 
 
 def execute_query(conn: sqlite3.Connection, query: str, params: Any = None):
@@ -80,14 +375,187 @@ def execute_query(conn: sqlite3.Connection, query: str, params: Any = None):
         raise
 
 
+class VersionSnapshot:
+    """One stored version of a task. The result is only decoded when read."""
+
+    __slots__ = ("id", "created_at", "_result_data", "_result")
+
+    def __init__(self, id: int, created_at: str, result_data: Optional[bytes]):
+        self.id = id
+        self.created_at = created_at
+        self._result_data = result_data
+        self._result = None
+
+    @property
+    def result(self) -> Any:
+        if self._result is None and self._result_data is not None:
+            self._result = decode_result(self._result_data)
+        return self._result
+
+
+class TaskSnapshot:
+    __slots__ = (
+        "id",
+        "task_type",
+        "task_order",
+        "page_index",
+        "status",
+        "updated_at",
+        "current_version_id",
+        "versions",
+        "_result_data",
+        "_result",
+    )
+
+    def __init__(self, row: sqlite3.Row):
+        self.id = row["id"]
+        self.task_type = row["task_type"]
+        self.task_order = row["task_order"]
+        self.page_index = row["page_index"]
+        self.status = row["status"]
+        self.updated_at = row["updated_at"]
+        self.current_version_id = row["version_id"]
+        self.versions: List[VersionSnapshot] = []
+        self._result_data = row["result"]
+        self._result = None
+
+    @property
+    def has_result(self) -> bool:
+        return self._result_data is not None
+
+    @property
+    def result(self) -> Any:
+        """The current version's result, if it was loaded"""
+        if self._result is None and self._result_data is not None:
+            self._result = decode_result(self._result_data)
+        return self._result
+
+
+class JobSnapshot:
+    """
+    A job, its tasks and (optionally) their results and version history as
+    of one read. Results stay compressed and the job data stays as text
+    until they're accessed, so callers only pay to decode what they use.
+    """
+
+    def __init__(self, job_id: str, row: sqlite3.Row):
+        self.id = job_id
+        self.status = row["job_status"]
+        self.user_email = row["job_user_email"]
+        self.created_at = row["job_created_at"]
+        self.updated_at = row["job_updated_at"]
+        self.tasks: List[TaskSnapshot] = []
+        self._data_json = row["job_data"]
+        self._data = None
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        if self._data is None and self._data_json is not None:
+            self._data = json.loads(self._data_json)
+        return self._data
+
+    def task(self, task_type: str, page_index: int = None) -> Optional[TaskSnapshot]:
+        """The job's task_type task, for page_index if it's a per-page task"""
+        for task in self.tasks:
+            if task.task_type == task_type and (
+                page_index is None or task.page_index == page_index
+            ):
+                return task
+        return None
+
+    @property
+    def etag(self) -> str:
+        """
+        Changes whenever the job's status or any task's status or current
+        version does, without reading a single result
+        """
+        state = [self.status, self.updated_at]
+        state.extend((t.id, t.status, t.current_version_id) for t in self.tasks)
+        return hashlib.sha1(json.dumps(state).encode()).hexdigest()[:20]
+
+    def status_dict(self, include_data: bool = False) -> Dict[str, Any]:
+        """
+        Job and task statuses. include_data adds each task's current result,
+        which must have been loaded with results=True.
+        """
+        tasks = []
+        for t in self.tasks:
+            task = {
+                "id": t.id,
+                "type": t.task_type,
+                "order": t.task_order,
+                "page": t.page_index,
+                "status": t.status,
+                "version_id": t.current_version_id,
+            }
+            if include_data:
+                task["data"] = t.result
+            tasks.append(task)
+
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "updated_at": self.updated_at,
+            "tasks": tasks,
+        }
+
+
+def load_job_snapshot(
+    job_id: str,
+    results: Union[bool, Iterable[str]] = False,
+    with_versions: bool = False,
+) -> Optional[JobSnapshot]:
+    """
+    Loads a job and its tasks in one query, and every version of every task
+    in a second one if with_versions is set
+
+    results - True for every task's current result, or the task types whose
+        current results are wanted. Results not asked for are never read
+        off disk.
+
+    Returns None if the job doesn't exist.
+    """
+    if results is True:
+        result_column = "rb.data"
+        params: List[Any] = []
+    else:
+        task_types = list(results or [])
+        if task_types:
+            placeholders = ", ".join("?" for _ in task_types)
+            result_column = f"CASE WHEN jt.task_type IN ({placeholders}) THEN rb.data END"
+        else:
+            result_column = "NULL"
+        params = task_types
+
+    with db_manager.get_db("jobs", readonly=True) as conn:
+        rows = conn.execute(
+            JOB_SNAPSHOT_SQL.format(result_column=result_column), (*params, job_id)
+        ).fetchall()
+        if not rows:
+            return None
+
+        snapshot = JobSnapshot(job_id, rows[0])
+        snapshot.tasks = [TaskSnapshot(row) for row in rows if row["id"] is not None]
+
+        if with_versions and snapshot.tasks:
+            by_id = {task.id: task for task in snapshot.tasks}
+            versions = conn.execute(JOB_VERSIONS_SQL, (job_id,)).fetchall()
+            for row in versions:
+                by_id[row["task_id"]].versions.append(
+                    VersionSnapshot(row["id"], row["created_at"], row["result"])
+                )
+
+    return snapshot
+
+
 def get_job(job_id: str) -> Dict[str, Any]:
-    with db_manager.get_db("jobs") as conn:
+    with db_manager.get_db("jobs", readonly=True) as conn:
         row = execute_query(conn, "SELECT * FROM jobs WHERE id = ?", (job_id,))
         return dict(row[0]) if row else None
 
 
 def get_job_tasks(job_id: str) -> List[Dict[str, Any]]:
-    with db_manager.get_db("jobs") as conn:
+    with db_manager.get_db("jobs", readonly=True) as conn:
         rows = execute_query(
             conn,
             "SELECT * FROM job_tasks WHERE job_id = ? ORDER BY task_order",
@@ -97,25 +565,54 @@ def get_job_tasks(job_id: str) -> List[Dict[str, Any]]:
 
 
 def get_task_versions(task_id: str) -> List[Dict[str, Any]]:
-    with db_manager.get_db("jobs") as conn:
+    with db_manager.get_db("jobs", readonly=True) as conn:
         rows = execute_query(
             conn,
-            "SELECT * FROM task_versions WHERE task_id = ? ORDER BY id",
+            """
+            SELECT tv.id, tv.task_id, tv.created_at, tv.result_hash, rb.data
+            FROM task_versions tv
+            LEFT JOIN result_blobs rb ON rb.hash = tv.result_hash
+            WHERE tv.task_id = ?
+            ORDER BY tv.id
+        """,
             (task_id,),
         )
-        return [dict(row) for row in rows]
+        return [
+            {
+                "id": row["id"],
+                "task_id": row["task_id"],
+                "created_at": row["created_at"],
+                "result_hash": row["result_hash"],
+                "result": decode_result(row["data"]),
+            }
+            for row in rows
+        ]
 
 
 def get_current_task_version(task_id: str) -> Dict[str, Any]:
-    with db_manager.get_db("jobs") as conn:
+    with db_manager.get_db("jobs", readonly=True) as conn:
         row = execute_query(
-            conn, "SELECT * FROM current_task_versions WHERE task_id = ?", (task_id,)
+            conn,
+            """
+            SELECT ctv.task_id, ctv.version_id, ctv.result_hash, rb.data
+            FROM current_task_versions ctv
+            LEFT JOIN result_blobs rb ON rb.hash = ctv.result_hash
+            WHERE ctv.task_id = ?
+        """,
+            (task_id,),
         )
-        return dict(row[0]) if row else None
+        if not row:
+            return None
+        return {
+            "task_id": row[0]["task_id"],
+            "version_id": row[0]["version_id"],
+            "result_hash": row[0]["result_hash"],
+            "result": decode_result(row[0]["data"]),
+        }
 
 
 def get_task_dependencies(task_id: str) -> List[str]:
-    with db_manager.get_db("jobs") as conn:
+    with db_manager.get_db("jobs", readonly=True) as conn:
         rows = execute_query(
             conn,
             "SELECT dependency_task_id FROM task_dependencies WHERE dependent_task_id = ?",
@@ -125,7 +622,7 @@ def get_task_dependencies(task_id: str) -> List[str]:
 
 
 def get_task_dependents(task_id: str) -> List[str]:
-    with db_manager.get_db("jobs") as conn:
+    with db_manager.get_db("jobs", readonly=True) as conn:
         rows = execute_query(
             conn,
             "SELECT dependent_task_id FROM task_dependencies WHERE dependency_task_id = ?",
@@ -146,6 +643,270 @@ def add_task_dependency(dependent_task_id: str, dependency_task_id: str):
         )
 
 
+# A task and everything downstream of it, plus whatever else in its job
+# didn't complete last time. Leaving a failed task out would leave the tasks
+# waiting on it pending for good.
+AFFECTED_TASKS_SQL = """
+    WITH RECURSIVE affected(id) AS (
+        VALUES (?)
+        UNION
+        SELECT td.dependent_task_id
+        FROM task_dependencies td
+        JOIN affected a ON a.id = td.dependency_task_id
+    )
+    SELECT jt.id, jt.job_id, jt.task_type, jt.task_order, jt.page_index
+    FROM job_tasks jt
+    WHERE jt.id IN (SELECT id FROM affected)
+       OR (jt.job_id = ? AND jt.status != 'completed')
+    ORDER BY jt.task_order
+"""
+
+
+def add_job_task_dependencies(conn: sqlite3.Connection, job_id: str):
+    """
+    Records which of the job's tasks depend on which, following each task
+    type's depends_on. A per-page task depends on the per-page tasks for its
+    own page. Safe to repeat, so jobs created before dependencies were
+    recorded get theirs when they're rerun or recovered.
+    """
+    conn.executemany(
+        """
+        INSERT OR IGNORE INTO task_dependencies (dependent_task_id, dependency_task_id)
+        SELECT dependent.id, dependency.id
+        FROM job_tasks dependent
+        JOIN job_tasks dependency ON dependency.job_id = dependent.job_id
+        WHERE dependent.job_id = ? AND dependent.task_type = ? AND dependency.task_type = ?
+          AND (dependency.page_index IS NULL OR dependency.page_index = dependent.page_index)
+        """,
+        [
+            (job_id, task_type.name, dependency)
+            for task_type in TaskType
+            for dependency in task_type.value.depends_on
+        ],
+    )
+
+
+def claim_ready_tasks(conn: sqlite3.Connection, job_id: str) -> List[Dict[str, Any]]:
+    """
+    Marks the job's pending tasks whose dependencies have all completed as
+    queued, and returns them. Must run on the writer: that's what stops two
+    tasks finishing at the same time from both queueing a task that was
+    waiting on the pair of them.
+    """
+    ready = [dict(row) for row in conn.execute(READY_TASKS_SQL, (job_id,))]
+    if ready:
+        now = datetime.now(timezone.utc).isoformat()
+        conn.executemany(
+            "UPDATE job_tasks SET status = 'queued', updated_at = ? WHERE id = ?",
+            [(now, task["id"]) for task in ready],
+        )
+    return ready
+
+
+class LeaseLostError(Exception):
+    """
+    Raised when finishing a task whose lease ran out and was reclaimed, or
+    that a rerun reset, while it was running. Its result is thrown away.
+    """
+
+
+def lease_expiry(lease_seconds: float) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=lease_seconds)).isoformat()
+
+
+def lease_task(task_id: str, owner: str, lease_seconds: float) -> Optional[int]:
+    """
+    Marks a queued task running, held by owner for lease_seconds, and
+    returns which attempt at it this is. Returns None if the task isn't
+    queued any more (another worker has it, or its job has failed).
+
+    The attempt number goes with the owner everywhere the lease is checked,
+    so a worker whose lease was reclaimed can't finish the task out from
+    under the worker that took it over, even in the same process.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    with db_manager.get_db("jobs") as conn:
+        leased = conn.execute(
+            """
+            UPDATE job_tasks
+            SET status = 'running', lease_owner = ?, lease_expires_at = ?,
+                attempts = COALESCE(attempts, 0) + 1, updated_at = ?
+            WHERE id = ? AND status = 'queued'
+              AND job_id NOT IN (SELECT id FROM jobs WHERE status = 'failed')
+        """,
+            (owner, lease_expiry(lease_seconds), now, task_id),
+        ).rowcount
+        if not leased:
+            return None
+        return conn.execute(
+            "SELECT attempts FROM job_tasks WHERE id = ?", (task_id,)
+        ).fetchone()["attempts"]
+
+
+def renew_task_lease(task_id: str, lease: Tuple[str, int], lease_seconds: float) -> bool:
+    """Pushes back the expiry of a lease that's still held. Returns whether it was."""
+    with db_manager.get_db("jobs") as conn:
+        return bool(
+            conn.execute(
+                """
+                UPDATE job_tasks SET lease_expires_at = ?
+                WHERE id = ? AND status = 'running' AND lease_owner = ? AND attempts = ?
+            """,
+                (lease_expiry(lease_seconds), task_id, *lease),
+            ).rowcount
+        )
+
+
+def finish_leased_task(conn: sqlite3.Connection, task_id: str, lease: Tuple[str, int], status: str):
+    """
+    Sets a running task's final status and drops its lease, or raises
+    LeaseLostError if (owner, attempt) doesn't hold it any more. Raising
+    rolls back the rest of the caller's transaction along with it.
+    """
+    finished = conn.execute(
+        """
+        UPDATE job_tasks
+        SET status = ?, lease_owner = NULL, lease_expires_at = NULL, updated_at = ?
+        WHERE id = ? AND status = 'running' AND lease_owner = ? AND attempts = ?
+    """,
+        (status, datetime.now(timezone.utc).isoformat(), task_id, *lease),
+    ).rowcount
+    if not finished:
+        raise LeaseLostError(f"Task {task_id} is no longer leased to {lease[0]} (attempt {lease[1]})")
+
+
+def reclaim_expired_leases(
+    conn: sqlite3.Connection,
+    max_attempts: int,
+    owner_pattern: str = "",
+    owner_gone: Callable[[str], bool] = lambda owner: True,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Takes back running tasks whose lease has expired, along with any held by
+    an owner matching owner_pattern (a GLOB) that owner_gone says has
+    stopped, whatever their expiry.
+
+    Tasks with attempts left are queued again and returned first. Tasks that
+    have been leased max_attempts times are failed along with their jobs and
+    returned second, so a task that keeps taking the process down with it
+    doesn't do so forever.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    rows = [
+        dict(row)
+        for row in conn.execute(EXPIRED_LEASES_SQL, (now, owner_pattern))
+        if (row["lease_expires_at"] or "") < now or owner_gone(row["lease_owner"])
+    ]
+    requeued = [row for row in rows if (row["attempts"] or 0) < max_attempts]
+    exhausted = [row for row in rows if (row["attempts"] or 0) >= max_attempts]
+    conn.executemany(
+        """
+        UPDATE job_tasks
+        SET status = ?, lease_owner = NULL, lease_expires_at = NULL, updated_at = ?
+        WHERE id = ?
+    """,
+        [("queued", now, row["id"]) for row in requeued]
+        + [("failed", now, row["id"]) for row in exhausted],
+    )
+    conn.executemany(
+        "UPDATE jobs SET status = 'failed', updated_at = ? WHERE id = ?",
+        [(now, job_id) for job_id in {row["job_id"] for row in exhausted}],
+    )
+    return requeued, exhausted
+
+
+def read_fields(result: Dict[str, Any], fields: Iterable[str], page_index: int = None):
+    """The given keys of a dependency's result, as the task's handler sees them"""
+    inputs = {}
+    for field in fields:
+        if field == "page_strings" and page_index is not None:
+            # Results from before page_strings have a single page_string
+            pages = result.get("page_strings") or [result.get("page_string")]
+            inputs["page_string"] = pages[page_index] if page_index < len(pages) else None
+        else:
+            inputs[field] = result.get(field)
+    return inputs
+
+
+def task_input_hash(
+    conn: sqlite3.Connection,
+    task_id: str,
+    job_id: str,
+    task_type: str,
+    page_index: int = None,
+) -> str:
+    """
+    Hashes everything the task's handler reads: the current result of each
+    task it depends on (just the keys in the task type's input_fields, where
+    it has some), or the job's data for a task with no dependencies, plus
+    the page for a per-page task
+
+    Results are hashed by their result hash and anything decoded is hashed
+    as canonical JSON, so two tasks given the same inputs get the same input
+    hash, in the same job or not. A per-page task only reads its own page of
+    page_strings, so editing one page doesn't rerun the other pages' tasks.
+    """
+    input_fields = TaskType[task_type].value.input_fields
+    inputs = []
+    for row in conn.execute(TASK_INPUTS_SQL, (task_id,)):
+        fields = input_fields.get(row["task_type"])
+        if fields and row["data"] is not None:
+            result = decode_result(row["data"])
+            inputs.append((row["task_type"], read_fields(result, fields, page_index)))
+        else:
+            inputs.append((row["task_type"], row["result_hash"]))
+    if not inputs:
+        job = conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        inputs.append(("job", json.loads(job["data"]) if job else None))
+    if page_index is not None:
+        inputs.append(("page", page_index))
+    canonical = sorted(json.dumps(item, sort_keys=True, separators=(",", ":")) for item in inputs)
+    return hashlib.sha256("\n".join(canonical).encode()).hexdigest()
+
+
+def find_stored_version(
+    task_id: str, job_id: str, task_type: str, page_index: int = None
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Returns the task's input hash and the stored version that was computed
+    from the same inputs, or None if there isn't one. The current version
+    wins if it qualifies.
+    """
+    with db_manager.get_db("jobs", readonly=True) as conn:
+        input_hash = task_input_hash(conn, task_id, job_id, task_type, page_index)
+        row = conn.execute(STORED_VERSION_SQL, (task_id, input_hash)).fetchone()
+    return input_hash, dict(row) if row else None
+
+
+def use_task_version(
+    task_id: str, version_id: int, task_status: str = "completed", lease: Tuple[str, int] = None
+):
+    """
+    Makes a stored version the task's current one instead of computing a new
+    one. With a lease, only if it's still held, see finish_leased_task.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    with db_manager.get_db("jobs") as conn:
+        if lease is not None:
+            finish_leased_task(conn, task_id, lease, task_status)
+        else:
+            conn.execute(
+                """
+                UPDATE job_tasks
+                SET status = ?, updated_at = ?
+                WHERE id = ?
+            """,
+                (task_status, now, task_id),
+            )
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO current_task_versions (task_id, version_id, result_hash)
+            SELECT task_id, id, result_hash FROM task_versions WHERE id = ? AND task_id = ?
+        """,
+            (version_id, task_id),
+        )
+
+
 def update_job_status(job_id: str, status: str):
     with db_manager.get_db("jobs") as conn:
         execute_query(
@@ -172,25 +933,130 @@ def update_task_status(task_id: str, status: str):
         )
 
 
-def create_task_version(task_id: str, result: Any) -> int:
+def create_task_version(
+    task_id: str,
+    result_json: str,
+    task_status: str = None,
+    input_hash: str = None,
+    memo_key: Tuple = None,
+    lease: Tuple[str, int] = None,
+) -> int:
+    """
+    Stores a serialized result as a new version of the task and makes it
+    the current one, optionally setting the task's status, in one transaction
+
+    memo_key - (task type, handler version, input hash, embedding model) to
+        memoize the result under, for deterministic tasks
+    lease - (owner, attempt) the task is running under. Nothing is stored
+        unless it still holds the task, see finish_leased_task.
+    """
+    now = datetime.now(timezone.utc).isoformat()
     with db_manager.get_db("jobs") as conn:
+        if lease is not None:
+            finish_leased_task(conn, task_id, lease, task_status or "completed")
+        result_hash = store_result_blob(conn, result_json)
         cursor = conn.cursor()
         cursor.execute(
             """
-            INSERT INTO task_versions (task_id, result, created_at)
-            VALUES (?, ?, ?)
+            INSERT INTO task_versions (task_id, result_hash, input_hash, created_at)
+            VALUES (?, ?, ?, ?)
         """,
-            (task_id, json.dumps(result), datetime.now(timezone.utc).isoformat()),
+            (task_id, result_hash, input_hash, now),
         )
         version_id = cursor.lastrowid
 
         cursor.execute(
             """
-            INSERT OR REPLACE INTO current_task_versions (task_id, version_id, result)
+            INSERT OR REPLACE INTO current_task_versions (task_id, version_id, result_hash)
             VALUES (?, ?, ?)
         """,
-            (task_id, version_id, json.dumps(result)),
+            (task_id, version_id, result_hash),
         )
 
+        if task_status is not None and lease is None:
+            cursor.execute(
+                """
+                UPDATE job_tasks
+                SET status = ?, updated_at = ?
+                WHERE id = ?
+            """,
+                (task_status, now, task_id),
+            )
+
+        if memo_key is not None:
+            cursor.execute(
+                """
+                INSERT INTO task_memo (task_type, handler_version, input_hash, embedding_model,
+                                       result_hash, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (task_type, handler_version, input_hash, embedding_model)
+                DO UPDATE SET result_hash = excluded.result_hash, last_used_at = excluded.last_used_at
+            """,
+                (*memo_key, result_hash, now, now),
+            )
+
         conn.commit()
         return version_id
+
+
+def recall_task_result(memo_key: Tuple) -> Optional[Dict[str, Any]]:
+    """
+    Looks up a memoized result by (task type, handler version, input hash,
+    embedding model). Returns {"rowid", "result"} or None if there isn't one.
+    """
+    with db_manager.get_db("jobs", readonly=True) as conn:
+        row = conn.execute(
+            """
+            SELECT m.rowid, rb.data
+            FROM task_memo m
+            JOIN result_blobs rb ON rb.hash = m.result_hash
+            WHERE m.task_type = ? AND m.handler_version = ?
+              AND m.input_hash = ? AND m.embedding_model = ?
+        """,
+            memo_key,
+        ).fetchone()
+    if row is None:
+        return None
+    return {"rowid": row["rowid"], "result": decode_result(row["data"])}
+
+
+def touch_task_memo(rowid: int):
+    """Counts a hit on a memo entry, which also keeps it from being evicted for a while"""
+    with db_manager.get_db("jobs") as conn:
+        conn.execute(
+            "UPDATE task_memo SET hits = hits + 1, last_used_at = ? WHERE rowid = ?",
+            (datetime.now(timezone.utc).isoformat(), rowid),
+        )
+
+
+def evict_task_memo(max_age_days: float, max_bytes: int) -> int:
+    """
+    Drops memo entries unused for max_age_days, then the least recently used
+    ones until the results left add up to max_bytes of JSON. Returns how many
+    were dropped. The results themselves stay in result_blobs as long as a
+    task version still points at them.
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=max_age_days)).isoformat()
+    with db_manager.get_db("jobs") as conn:
+        expired = conn.execute(
+            "DELETE FROM task_memo WHERE last_used_at < ?", (cutoff,)
+        ).rowcount
+        over_budget = conn.execute(
+            """
+            DELETE FROM task_memo WHERE rowid IN (
+                SELECT id FROM (
+                    SELECT m.rowid AS id,
+                           SUM(rb.size) OVER (ORDER BY m.last_used_at DESC, m.rowid DESC) AS total
+                    FROM task_memo m
+                    JOIN result_blobs rb ON rb.hash = m.result_hash
+                )
+                WHERE total > ?
+            )
+        """,
+            (max_bytes,),
+        ).rowcount
+    if expired or over_budget:
+        logger.info(
+            f"Evicted {expired} expired and {over_budget} least recently used task memo entries"
+        )
+    return expired + over_budget
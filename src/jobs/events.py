@@ -0,0 +1,101 @@
+"""
+Structured job events
+
+Every event goes to two places:
+
+    - Clients watching the job through /progress/{job_id}. job_progress
+      hands each event to their queues as it happens, so they don't need to
+      poll the database.
+    - One line of JSON on the "jobs.events" logger, so they can be filtered
+      and aggregated instead of read. Log lines are sampled per job (a job
+      is either logged in full or not at all) using JOB_EVENT_SAMPLE_RATE.
+      Failures are always logged.
+
+Events only ever carry a summary of a task's result. The full result is
+fetched separately when a client wants it, and the full state of a job is
+never logged from the task path. Use the /debug/job/{job_id} route when you
+actually need to look at one.
+"""
+
+import asyncio
+import json
+import logging
+import zlib
+from collections import defaultdict
+from typing import Any, Dict, Set
+
+from config import JOB_EVENT_SAMPLE_RATE
+
+event_logger = logging.getLogger("jobs.events")
+
+ALWAYS_LOGGED = {"task_failed", "job_failed"}
+# Events after which nothing else happens to a job
+FINAL_EVENTS = {"job_completed", "job_failed"}
+
+
+class JobProgress:
+    """Fans job events out to the clients subscribed to each job"""
+
+    def __init__(self):
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self.subscribers[job_id].add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(job_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[job_id]
+
+    def publish(self, event: Dict[str, Any]):
+        for queue in self.subscribers.get(event["job_id"], ()):
+            queue.put_nowait(event)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "jobs_watched": len(self.subscribers),
+            "subscribers": sum(len(q) for q in self.subscribers.values()),
+        }
+
+
+job_progress = JobProgress()
+
+
+def summarize_result(result: Any) -> Any:
+    """
+    A small, fixed size description of a task result: collections become
+    their length and long strings their character count, one level down
+    """
+
+    def size(value):
+        if isinstance(value, (list, dict)):
+            return len(value)
+        if isinstance(value, str) and len(value) > 80:
+            return len(value)
+        return value
+
+    if isinstance(result, dict):
+        return {key: size(value) for key, value in result.items()}
+    return size(result)
+
+
+def is_sampled(job_id: str) -> bool:
+    if JOB_EVENT_SAMPLE_RATE >= 1:
+        return True
+    return zlib.crc32(job_id.encode()) % 10000 < JOB_EVENT_SAMPLE_RATE * 10000
+
+
+def emit_job_event(event: str, job_id: str, **fields):
+    payload = {"event": event, "job_id": job_id, **fields}
+    job_progress.publish(payload)
+
+    if event not in ALWAYS_LOGGED and not is_sampled(job_id):
+        return
+    if not event_logger.isEnabledFor(logging.INFO):
+        return
+    event_logger.info(json.dumps(payload))
@@ -7,6 +7,21 @@ class TaskSpec(NamedTuple):
     input_schema: dict
     output_schema: dict
     is_deterministic: bool
+    # Most tasks of this type allowed to run at once across all jobs, 0 for no limit
+    max_concurrency: int = 0
+    # Task types whose results the handler reads. A task without any reads
+    # the job's data instead.
+    depends_on: tuple = ()
+    # For dependencies the handler only reads some keys of, those keys. Only
+    # they go into the task's input hash, so a change to the other keys
+    # doesn't count as a change to this task's inputs.
+    input_fields: dict = {}
+    # Bump when a change to the handler changes its output for the same
+    # inputs, so memoized results from the old handler aren't used
+    handler_version: int = 1
+    # One task per page of the job rather than one per job. The handler gets
+    # a page_index, and depends on the per-page tasks for the same page.
+    per_page: bool = False
 
 
 class TaskType(Enum):
@@ -37,6 +52,7 @@ class TaskType(Enum):
             "type": "object",
             "properties": {
                 "company_string": {"type": "string"},
+                "page_strings": {"type": "array", "items": {"type": "string"}},
                 "locations": {"type": "array", "items": {"type": "string"}},
                 "client_provided_keywords": {
                     "type": "array",
@@ -45,6 +61,8 @@ class TaskType(Enum):
             },
         },
         is_deterministic=True,
+        # 2: one page_string per page, in page_strings
+        handler_version=2,
     )
     GENERATE_SIMILAR_KEYWORDS = TaskSpec(
         description="Generate similar keywords for each location",
@@ -71,10 +89,15 @@ class TaskType(Enum):
                         },
                     },
                 },
-                "full_kw_list": {"type": "array", "items": {"type": "string"}},
             },
         },
         is_deterministic=False,
+        # Provider calls are already spaced out by the shared rate limiter, so
+        # this only stops rate-limited jobs from filling every worker. Two
+        # slots lets a job with cached keywords through while another waits.
+        max_concurrency=2,
+        depends_on=("PROCESS_INITIAL_INPUT",),
+        input_fields={"PROCESS_INITIAL_INPUT": ("locations", "seed_keywords")},
     )
     SELECT_BEST_KEYWORDS = TaskSpec(
         description="Select best keywords based on relevance",
@@ -90,6 +113,8 @@ class TaskType(Enum):
             "additionalProperties": {"type": "array", "items": {"type": "string"}},
         },
         is_deterministic=True,
+        depends_on=("PROCESS_INITIAL_INPUT", "GENERATE_SIMILAR_KEYWORDS"),
+        input_fields={"PROCESS_INITIAL_INPUT": ("seed_keywords",)},
     )
     GENERATE_CLUSTERS = TaskSpec(
         description="Cluster keywords into groups",
@@ -114,6 +139,8 @@ class TaskType(Enum):
             },
         },
         is_deterministic=True,
+        depends_on=("PROCESS_INITIAL_INPUT", "GENERATE_SIMILAR_KEYWORDS"),
+        input_fields={"PROCESS_INITIAL_INPUT": ("seed_keywords",)},
     )
     SELECT_BEST_CLUSTER = TaskSpec(
         description="Select the best cluster based on relevance",
@@ -140,6 +167,9 @@ class TaskType(Enum):
             },
         },
         is_deterministic=True,
+        depends_on=("PROCESS_INITIAL_INPUT", "GENERATE_CLUSTERS"),
+        input_fields={"PROCESS_INITIAL_INPUT": ("page_strings",)},
+        per_page=True,
     )
     GENERATE_HTML = TaskSpec(
         description="Generate HTML content based on selected keywords",
@@ -154,11 +184,14 @@ class TaskType(Enum):
                     },
                 },
                 "company_string": {"type": "string"},
-                "page_string": {"type": "string"},
+                "page_strings": {"type": "array", "items": {"type": "string"}},
             },
         },
         output_schema={"type": "string"},
         is_deterministic=False,
+        depends_on=("PROCESS_INITIAL_INPUT", "SELECT_BEST_CLUSTER"),
+        input_fields={"PROCESS_INITIAL_INPUT": ("company_string", "page_strings", "page_type")},
+        per_page=True,
     )
 
 
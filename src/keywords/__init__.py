@@ -7,13 +7,22 @@ This module handles rate limiting, with individual provider modules
 providing the rate limit value for their API.
 """
 
+import asyncio
 import json
 import logging
+import sqlite3
+import threading
 import time
-from typing import Any, Dict, List
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
 
 import keywords.db as db
+from config import SIMILAR_SEARCH_CACHE_BYTES
+from db import db_manager
 from keywords.embedding import embedding_service
+from keywords.embedding.executors import run_embedding_task
 
 from .providers import twinword
 
@@ -28,35 +37,124 @@ logger = logging.getLogger(__name__)
 
 class RateLimiter:
     """
-    Generic, dead simple rate limiter class
+    Rate limiter shared by every process using the keyword cache
     Limiting is done on a requests/minute basis
 
-    Cannot handle multiple separate clients using the same provider simultaneously
+    Each call reserves the next free slot for the provider in the
+    rate_limits table (see db.reserve_rate_limit_slot) and then sleeps until
+    it. Callers are served in the order they reserved, nobody polls or
+    retries, and the sleep doesn't block the event loop.
+
+    If the database can't be reached it falls back to spacing calls within
+    this process only.
 
     TODO: Maybe at some point I could implement exponential backoff
     """
 
-    def __init__(self, calls_per_minute):
-        self.calls_per_minute = calls_per_minute
-        self.last_call_time = 0
+    def __init__(self, provider, calls_per_minute, burst=1):
+        self.provider = provider
+        self.interval = 60 / calls_per_minute
+        self.burst = burst
+        self.local_next_slot = 0
+
+    def reserve(self) -> float:
+        try:
+            return db.reserve_rate_limit_slot(self.provider, self.interval, self.burst)
+        except sqlite3.Error as e:
+            logger.error(f"Shared rate limit unavailable for '{self.provider}': {e}")
+            slot = max(time.time(), self.local_next_slot)
+            self.local_next_slot = slot + self.interval
+            return slot
 
-    def wait(self):
-        current_time = time.time()
-        time_since_last_call = current_time - self.last_call_time
-        time_to_wait = 60 / self.calls_per_minute - time_since_last_call
+    async def wait(self):
+        delay = await db_manager.run(self.reserve) - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
 
-        if time_to_wait > 0:
-            time.sleep(time_to_wait)
 
-        self.last_call_time = time.time()
+twinword_rate_limiter = RateLimiter(
+    "twinword", calls_per_minute=twinword.TWINWORD_RATE_LIMIT
+)
 
+class SearchCache:
+    """
+    In-process LRU of parsed similar keyword searches, keyed by (keyword, location)
 
-twinword_rate_limiter = RateLimiter(calls_per_minute=twinword.TWINWORD_RATE_LIMIT)
+    Sits in front of db.get_similar_keyword_search so repeated lookups within
+    a job (or across reruns) skip the query and the json.loads. Entries
+    expire at the same point the database row would and the size budget is
+    measured in bytes of the response JSON. The returned dicts are shared,
+    so callers should treat them as read-only.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Tuple[str, str], Tuple[Dict[str, Any], int, float]]" = (
+            OrderedDict()
+        )
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # cache_data invalidates entries from a database thread
+        self.lock = threading.RLock()
+
+    def get(self, keyword: str, location: str) -> Optional[Dict[str, Any]]:
+        key = (keyword, location)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] <= time.time():
+                self.invalidate(keyword, location)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, keyword: str, location: str, data: Dict[str, Any], size: int, expires_at: float):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.invalidate(keyword, location)
+            self.entries[(keyword, location)] = (data, size, expires_at)
+            self.bytes_used += size
+            while self.bytes_used > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.bytes_used -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, keyword: str, location: str):
+        with self.lock:
+            entry = self.entries.pop((keyword, location), None)
+            if entry is not None:
+                self.bytes_used -= entry[1]
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes_used": self.bytes_used,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+search_cache = SearchCache(SIMILAR_SEARCH_CACHE_BYTES)
+
+# Provider fetches currently in progress, so concurrent requests for the same
+# keyword and location share one API call
+_in_flight: Dict[Tuple[str, str], asyncio.Task] = {}
 
 PROVIDER_TO_USE = "twinword"
 
 
-def get_similar(keyword, location="CA") -> Dict[str, Any]:
+async def get_similar(keyword, location="CA") -> Dict[str, Any]:
     """Gets related search keywords to the provided keyword
 
     keyword: str    - The keyword to get similar keywords for
@@ -80,20 +178,57 @@ def get_similar(keyword, location="CA") -> Dict[str, Any]:
     }
     """
 
-    cached_data = db.get_similar_keyword_search(keyword, location)
-    data = None
+    data = search_cache.get(keyword, location)
+    if data is not None:
+        return data
+
+    cached_data = await db_manager.run(
+        db.get_similar_keyword_search, keyword, location, readonly=True
+    )
     if cached_data:
         # logging.info(f"Using cached data for keyword '{keyword}'")
         data = json.loads(cached_data["response_json"])
-    elif PROVIDER_TO_USE == "twinword":
-        twinword_rate_limiter.wait()
-        data = twinword.get_similar(keyword, location)
+        fetched = datetime.fromisoformat(cached_data["timestamp"]).replace(
+            tzinfo=timezone.utc
+        )
+        search_cache.put(
+            keyword,
+            location,
+            data,
+            len(cached_data["response_json"]),
+            (fetched + db.SIMILAR_SEARCH_TTL).timestamp(),
+        )
+        return data
+
+    key = (keyword, location)
+    if key not in _in_flight:
+        _in_flight[key] = asyncio.ensure_future(_fetch_similar(keyword, location))
+        _in_flight[key].add_done_callback(partial(_fetch_done, key))
+    return await asyncio.shield(_in_flight[key])
+
+
+def _fetch_done(key: Tuple[str, str], fetch: asyncio.Task):
+    """
+    Forgets a finished fetch. If every caller waiting on it was cancelled
+    (by a job timeout, say), nobody else sees its error, so it's logged here.
+    """
+    _in_flight.pop(key, None)
+    if not fetch.cancelled() and fetch.exception() is not None:
+        logger.error(
+            f"Fetching similar keywords for '{key[0]}' ({key[1]}) failed: {fetch.exception()!r}"
+        )
+
+
+async def _fetch_similar(keyword, location) -> Dict[str, Any]:
+    if PROVIDER_TO_USE == "twinword":
+        await twinword_rate_limiter.wait()
+        data = await twinword.get_similar_async(keyword, location)
         if not data:
             logger.error(
                 f"Error getting similar keywords for '{keyword}: No data returned'"
             )
             data = {}
-        if not cache_data(keyword, data, location):
+        if not await db_manager.run(cache_data, keyword, data, location):
             logger.error(f"Failed to cache data for '{keyword}'")
     else:
         if not PROVIDER_TO_USE or PROVIDER_TO_USE.isspace():
@@ -105,19 +240,22 @@ def get_similar(keyword, location="CA") -> Dict[str, Any]:
     return data
 
 
-def get_similar_multi(keywords: List, location: str = "CA") -> Dict[str, Any]:
+async def get_similar_multi(keywords: List, location: str = "CA") -> Dict[str, Any]:
     """
     ### Get keywords for multiple keywords with rate limiting
     returns: {
         "keyword1": get_similar(keyword1, location) (get_similar() returns a dictionary),
         "keyword2": { ... },
     }
+
+    All lookups run concurrently. Cached keywords come back straight away and
+    only the ones that need an API call wait on the rate limiter.
     """
 
-    results = {}
-    for keyword in keywords:
-        results[keyword] = get_similar(keyword, location)
-    return results
+    results = await asyncio.gather(
+        *(get_similar(keyword, location) for keyword in keywords)
+    )
+    return dict(zip(keywords, results))
 
 
 def cache_data(keyword: str, keywords: Dict[str, Any], location: str = "CA"):
@@ -131,19 +269,21 @@ def cache_data(keyword: str, keywords: Dict[str, Any], location: str = "CA"):
     Different providers will return data differently, but for twinword
     this is supposed to take the "keywords" field from the json response
 
-    FIXME: How should I handle errors here?
+    The search and all of its keywords are written in one transaction.
+    Keywords that fail validation are logged and skipped.
     """
 
-    if not db.insert_similar_keyword_search(keyword, keywords, location):
-        logger.error(f"Failed to cache similar keyword search for '{keyword}'")
+    search_cache.invalidate(keyword, location)
+    try:
+        failures = db.insert_keywords(keywords, location, search_keyword=keyword)
+    except Exception as e:
+        logger.error(f"Failed to cache similar keyword search for '{keyword}': {e}")
         return False
 
-    for kw, data in keywords.items():
-        try:
-            db.insert_keyword(kw, data, location)
-        except Exception as e:
-            logger.error(f"Error caching keyword data for '{kw}': {str(e)}")
+    for kw, error in failures.items():
+        logger.error(f"Error caching keyword data for '{kw}': {error}")
 
+    embedding_service.index.add_pending(kw for kw in keywords if kw not in failures)
     return True
 
 
@@ -162,19 +302,20 @@ def filter_similar_keywords(
     return list(similar_keywords)
 
 
-def get_and_filter_similar(
+async def get_and_filter_similar(
     seed_keywords: List[str], location: str = "CA", similarity_threshold: float = 0.5
 ) -> Dict[str, Any]:
     """
     Get similar keywords for multiple seed keywords and filter based on similarity.
+    The filtering runs the model, so it goes on the embedding thread.
     """
-    all_similar = get_similar_multi(seed_keywords, location)
+    all_similar = await get_similar_multi(seed_keywords, location)
     filtered_results = {}
 
     for seed, similar_data in all_similar.items():
         potential_keywords = list(similar_data.keys())
-        filtered_keywords = filter_similar_keywords(
-            [seed], potential_keywords, similarity_threshold
+        filtered_keywords = await run_embedding_task(
+            filter_similar_keywords, [seed], potential_keywords, similarity_threshold
         )
         filtered_results[seed] = {kw: similar_data[kw] for kw in filtered_keywords}
 
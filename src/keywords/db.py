@@ -20,8 +20,9 @@ import json
 import logging
 import sqlite3
 import sys
+import time
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict
+from typing import Any, Dict, List, Tuple
 
 from db import db_manager
 
@@ -34,6 +35,9 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# How long a provider response is reused before it's fetched again
+SIMILAR_SEARCH_TTL = timedelta(days=90)
+
 
 def create_table(conn: sqlite3.Connection):
     """
@@ -100,6 +104,87 @@ def create_similar_keywords_table(conn: sqlite3.Connection):
         logger.error(f"Failed to initialize similar_keyword_searched table: {e}")
 
 
+def create_embeddings_table(conn: sqlite3.Connection):
+    """
+    Creates the embeddings table in the database if it does not already exist
+
+    Vectors are stored as raw float32 bytes, keyed by the model that produced
+    them and the normalized keyword text
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model_name TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    dim INTEGER NOT NULL,
+                    vector BLOB NOT NULL,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (model_name, text)
+                ) WITHOUT ROWID;
+            """)
+            logger.info("embeddings table initialized successfully")
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Failed to initialize embeddings table: {e}")
+
+
+def create_rate_limits_table(conn: sqlite3.Connection):
+    """
+    Creates the rate_limits table in the database if it does not already exist
+
+    One row per provider holding the next time (unix seconds) a call is allowed.
+    Every process using the keyword cache shares it.
+    """
+
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    provider TEXT PRIMARY KEY,
+                    next_slot REAL NOT NULL DEFAULT 0
+                );
+            """)
+            logger.info("rate_limits table initialized successfully")
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Failed to initialize rate_limits table: {e}")
+
+
+def reserve_rate_limit_slot(provider: str, interval: float, burst: int = 1) -> float:
+    """
+    Reserves the next call slot for a provider and returns the time it starts
+
+    This is GCRA, the sequencing form of a token bucket: next_slot is pushed
+    forward by one interval per reservation, and up to `burst` calls can be
+    reserved before it runs ahead of the current time. BEGIN IMMEDIATE takes
+    the write lock up front so concurrent processes are serialized by SQLite
+    and get slots in the order they asked for them.
+    """
+
+    with db_manager.get_db("keyword_cache") as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE;")
+        cursor.execute(
+            "SELECT next_slot FROM rate_limits WHERE provider = ?;", (provider,)
+        )
+        row = cursor.fetchone()
+        now = time.time()
+        next_slot = max(row[0] if row else 0, now)
+        slot = max(now, next_slot - (burst - 1) * interval)
+        cursor.execute(
+            """
+            INSERT INTO rate_limits (provider, next_slot) VALUES (?, ?)
+            ON CONFLICT(provider) DO UPDATE SET next_slot = excluded.next_slot
+        """,
+            (provider, next_slot + interval),
+        )
+    return slot
+
+
 def drop_table(table_name):
     """
     Drops a table from the database
@@ -146,7 +231,7 @@ def get_keyword(keyword: str, location) -> Dict[str, Any]:
     """
 
     try:
-        with db_manager.get_db("keyword_cache") as conn:
+        with db_manager.get_db("keyword_cache", readonly=True) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT * FROM keywords WHERE keyword = ? AND location = ?;",
@@ -182,7 +267,7 @@ def get_similar_keyword_search(keyword: str, location: str) -> Dict[str, Any]:
     """
 
     try:
-        with db_manager.get_db("keyword_cache") as conn:
+        with db_manager.get_db("keyword_cache", readonly=True) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT * FROM similar_keyword_searches WHERE keyword = ? AND location = ?;",
@@ -198,7 +283,7 @@ def get_similar_keyword_search(keyword: str, location: str) -> Dict[str, Any]:
 
     if row:
         last_updated = datetime.fromisoformat(row[4]).replace(tzinfo=timezone.utc)
-        if datetime.now(timezone.utc) - last_updated < timedelta(days=90):
+        if datetime.now(timezone.utc) - last_updated < SIMILAR_SEARCH_TTL:
             return {
                 "keyword": row[1],
                 "location": row[2],
@@ -210,6 +295,28 @@ def get_similar_keyword_search(keyword: str, location: str) -> Dict[str, Any]:
     return None
 
 
+UPSERT_SIMILAR_KEYWORD_SEARCH_SQL = """
+    INSERT INTO similar_keyword_searches (keyword, location, response_json, last_updated, search_count)
+    VALUES (?, ?, ?, ?, 1)
+    ON CONFLICT(keyword, location) DO UPDATE SET
+        response_json = excluded.response_json,
+        last_updated = CURRENT_TIMESTAMP,
+        search_count = search_count + 1
+"""
+
+UPSERT_KEYWORD_SQL = """
+    INSERT INTO keywords (keyword, location, search_volume, cpc, has_cpc, competition, last_updated, appearance_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+    ON CONFLICT(keyword, location) DO UPDATE SET
+        search_volume = excluded.search_volume,
+        cpc = CASE WHEN excluded.has_cpc THEN excluded.cpc ELSE keywords.cpc END,
+        has_cpc = CASE WHEN excluded.has_cpc THEN 1 ELSE keywords.has_cpc END,
+        competition = excluded.competition,
+        last_updated = CURRENT_TIMESTAMP,
+        appearance_count = appearance_count + 1
+"""
+
+
 def insert_similar_keyword_search(
     keyword: str, data: Dict[str, Any], location: str
 ):  # FIXME: Handle location data
@@ -223,14 +330,7 @@ def insert_similar_keyword_search(
         with db_manager.get_db("keyword_cache") as conn:
             cursor = conn.cursor()
             cursor.execute(
-                """
-                INSERT INTO similar_keyword_searches (keyword, location, response_json, last_updated, search_count)
-                VALUES (?, ?, ?, ?, 1)
-                ON CONFLICT(keyword, location) DO UPDATE SET
-                    response_json = excluded.response_json,
-                    last_updated = CURRENT_TIMESTAMP,
-                    search_count = search_count + 1
-            """,
+                UPSERT_SIMILAR_KEYWORD_SEARCH_SQL,
                 (keyword, location, json.dumps(data), datetime.now(timezone.utc)),
             )
         return True
@@ -244,6 +344,39 @@ def insert_similar_keyword_search(
         return False
 
 
+def transform_keyword_data(keyword: str, keyword_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Converts a provider keyword entry into the keywords table's types and validates it
+
+    Raises ValueError if the converted data isn't valid
+    """
+
+    cpc_value = keyword_data.get("cpc")
+    has_cpc = cpc_value not in (None, "", "-1")
+    has_sv = keyword_data.get("search volume") not in (None, "", "-1")
+    transformed_data = {
+        "keyword": keyword,
+        "search_volume": int(keyword_data.get("search volume", 0)) if has_sv else 0,
+        "cpc": float(cpc_value) if has_cpc else -1,
+        "has_cpc": has_cpc,
+        "competition": float(keyword_data.get("paid competition", 0.0)),
+    }
+    validate_keyword_data(transformed_data)
+    return transformed_data
+
+
+def _keyword_row(data: Dict[str, Any], location: str, now: datetime) -> tuple:
+    return (
+        data["keyword"],
+        location,
+        data["search_volume"],
+        data["cpc"],
+        data["has_cpc"],
+        data["competition"],
+        now,
+    )
+
+
 def insert_keyword(keyword: str, keyword_data: Dict[str, Any], location: str):
     """
     Inserts a keyword and its data into the database
@@ -252,40 +385,12 @@ def insert_keyword(keyword: str, keyword_data: Dict[str, Any], location: str):
     """
 
     try:
-        cpc_value = keyword_data.get("cpc")
-        has_cpc = cpc_value not in (None, "", "-1")
-        has_sv = keyword_data.get("search volume") not in (None, "", "-1")
-        transformed_data = {
-            "keyword": keyword,
-            "search_volume": int(keyword_data.get("search volume", 0)) if has_sv else 0,
-            "cpc": float(cpc_value) if has_cpc else -1,
-            "has_cpc": has_cpc,
-            "competition": float(keyword_data.get("paid competition", 0.0)),
-        }
-        validate_keyword_data(transformed_data)
+        transformed_data = transform_keyword_data(keyword, keyword_data)
         with db_manager.get_db("keyword_cache") as conn:
             cursor = conn.cursor()
             cursor.execute(
-                """
-                INSERT INTO keywords (keyword, location, search_volume, cpc, has_cpc, competition, last_updated, appearance_count)
-                VALUES (?, ?, ?, ?, ?, ?, ?, 1)
-                ON CONFLICT(keyword, location) DO UPDATE SET
-                    search_volume = excluded.search_volume,
-                    cpc = CASE WHEN excluded.has_cpc THEN excluded.cpc ELSE keywords.cpc END,
-                    has_cpc = CASE WHEN excluded.has_cpc THEN 1 ELSE keywords.has_cpc END,
-                    competition = excluded.competition,
-                    last_updated = CURRENT_TIMESTAMP,
-                    appearance_count = appearance_count + 1
-            """,
-                (
-                    keyword,
-                    location,
-                    transformed_data["search_volume"],
-                    transformed_data["cpc"],
-                    transformed_data["has_cpc"],
-                    transformed_data["competition"],
-                    datetime.now(timezone.utc),
-                ),
+                UPSERT_KEYWORD_SQL,
+                _keyword_row(transformed_data, location, datetime.now(timezone.utc)),
             )
             # force_checkpoint()
     except sqlite3.Error as e:
@@ -302,6 +407,132 @@ def insert_keyword(keyword: str, keyword_data: Dict[str, Any], location: str):
         raise
 
 
+def insert_keywords(
+    keywords: Dict[str, Dict[str, Any]], location: str, search_keyword: str = None
+) -> Dict[str, str]:
+    """
+    Upserts a whole provider response in one transaction
+
+    keywords: Dict          - keyword -> provider data, as returned by get_similar
+    location: str           - The location the data was retrieved for
+    search_keyword: str     - If given, the similar_keyword_searches row for this
+                              search is written in the same transaction
+
+    Every entry is transformed and validated first. Entries that fail are
+    left out and returned as {keyword: error} instead of aborting the batch.
+    Database errors roll back everything and are raised.
+    """
+
+    now = datetime.now(timezone.utc)
+    rows = []
+    failures = {}
+    for keyword, keyword_data in keywords.items():
+        try:
+            rows.append(
+                _keyword_row(transform_keyword_data(keyword, keyword_data), location, now)
+            )
+        except (ValueError, TypeError, AttributeError) as e:
+            failures[keyword] = str(e)
+
+    try:
+        with db_manager.get_db("keyword_cache") as conn:
+            cursor = conn.cursor()
+            if search_keyword is not None:
+                cursor.execute(
+                    UPSERT_SIMILAR_KEYWORD_SEARCH_SQL,
+                    (search_keyword, location, json.dumps(keywords), now),
+                )
+            cursor.executemany(UPSERT_KEYWORD_SQL, rows)
+    except sqlite3.Error as e:
+        logger.error(f"Database error in insert_keywords for '{search_keyword}': {e}")
+        raise
+
+    return failures
+
+
+# Keeps the IN (...) lists under SQLite's bound parameter limit
+EMBEDDING_LOOKUP_CHUNK = 500
+
+
+def get_recent_keywords(limit: int) -> List[str]:
+    """
+    The limit most recently updated distinct keywords, newest first
+
+    Errors are logged and treated as an empty cache.
+    """
+
+    try:
+        with db_manager.get_db("keyword_cache", readonly=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT keyword FROM keywords
+                GROUP BY keyword
+                ORDER BY MAX(last_updated) DESC
+                LIMIT ?;
+            """,
+                (limit,),
+            )
+            return [row[0] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Database error in get_recent_keywords: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error in get_recent_keywords: {e}")
+    return []
+
+
+def get_embeddings(model_name: str, texts: List[str]) -> Dict[str, bytes]:
+    """
+    Fetches stored embedding vectors for the given texts
+
+    Returns a dict of text to raw float32 bytes for the texts that were found.
+    Errors are logged and treated as misses so callers can fall back to the model.
+    """
+
+    found = {}
+    try:
+        with db_manager.get_db("keyword_cache", readonly=True) as conn:
+            cursor = conn.cursor()
+            for i in range(0, len(texts), EMBEDDING_LOOKUP_CHUNK):
+                chunk = texts[i : i + EMBEDDING_LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(
+                    f"SELECT text, vector FROM embeddings WHERE model_name = ? AND text IN ({placeholders});",
+                    (model_name, *chunk),
+                )
+                found.update((row[0], row[1]) for row in cursor.fetchall())
+    except sqlite3.Error as e:
+        logger.error(f"Database error in get_embeddings: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error in get_embeddings: {e}")
+    return found
+
+
+def insert_embeddings(model_name: str, rows: List[Tuple[str, int, bytes]]) -> bool:
+    """
+    Stores (text, dim, vector bytes) rows for a model in a single transaction
+
+    Existing rows are left alone since a given model always produces the same vector
+    """
+
+    try:
+        with db_manager.get_db("keyword_cache") as conn:
+            conn.executemany(
+                """
+                INSERT OR IGNORE INTO embeddings (model_name, text, dim, vector)
+                VALUES (?, ?, ?, ?)
+            """,
+                [(model_name, text, dim, vector) for text, dim, vector in rows],
+            )
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Database error in insert_embeddings: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"Unexpected error in insert_embeddings: {e}")
+        return False
+
+
 def force_checkpoint():
     try:
         with db_manager.get_db("keyword_cache") as conn:
@@ -320,7 +551,7 @@ def manual_search(sql_string: str):
     """
 
     try:
-        with db_manager.get_db("keyword_cache") as conn:
+        with db_manager.get_db("keyword_cache", readonly=True) as conn:
             cursor = conn.cursor()
             cursor.execute(sql_string)
             rows = cursor.fetchall()
@@ -1,39 +1,163 @@
+"""
+Keyword embeddings and the similarity/clustering helpers built on them
+
+torch, sentence-transformers, scipy and networkx are only imported when
+they're first needed so that importing this module (and everything that
+imports it, like jobs and web.routes) stays cheap at startup.
+"""
+
 import logging
-from typing import Any, Dict, List
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
-import networkx as nx
 import numpy as np
-from networkx.algorithms import community
-from scipy.cluster.hierarchy import fcluster, linkage
-from sentence_transformers import SentenceTransformer
+from config import EMBEDDING_CACHE_BYTES, KEYWORD_INDEX_MAX_KEYWORDS
+
+import keywords.db as keyword_db
+
+from .cache import EmbeddingCache
+from .executors import hierarchical_labels
+from .index import KeywordIndex, normalize_rows
+
+
+def normalize_text(text: str) -> str:
+    """
+    Cache key for a keyword: trimmed, single-spaced and lowercased
+
+    The bge models use an uncased tokenizer, so this doesn't change the
+    vector, it just stops "Bin trailer" and "bin trailer" being stored twice.
+    """
+    return " ".join(text.split()).lower()
 
 
 class EmbeddingService:
     def __init__(
-        self, model_name: str = "TaylorAI/bge-micro-v2", cache_size: int = 10000
+        self,
+        model_name: str = "TaylorAI/bge-micro-v2",
+        cache_bytes: int = EMBEDDING_CACHE_BYTES,
+        batch_size: int = 256,
+        index_keywords: int = KEYWORD_INDEX_MAX_KEYWORDS,
     ):
         """
-        TODO: Figure out if the cache_size affects memory usage
+        cache_bytes - Memory budget for cached vectors (see EmbeddingCache)
+        index_keywords - Most keywords held in the similarity index (see KeywordIndex)
+
+        Lookups go memory cache -> embeddings table in keyword_cache.db -> model,
+        so keywords seen before a restart don't need to be encoded again.
         """
-        self.model = SentenceTransformer(model_name)
-        self.cache: Dict[str, np.ndarray] = {}
-        self.cache_size = cache_size
+        self.model_name = model_name
+        self._model = None
+        self._model_lock = threading.Lock()
+        # Why the startup warm-up failed, for /ready. The model is still
+        # loaded on first use, so a later request can succeed anyway.
+        self.warm_up_error: Optional[str] = None
+        self.cache = EmbeddingCache(cache_bytes)
+        self.batch_size = batch_size
+        self.index = KeywordIndex(self, index_keywords)
+        self.store_hits = 0
+        self.encoded = 0
         logging.info(f"Initialized EmbeddingService with model: {model_name}")
 
-    def get_embedding(self, text: str) -> np.ndarray:
-        if text in self.cache:
-            return self.cache[text]
+    @property
+    def model(self):
+        """The SentenceTransformer, loaded on first use"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    started = time.perf_counter()
+                    from sentence_transformers import SentenceTransformer
+
+                    imported = time.perf_counter()
+                    self._model = SentenceTransformer(self.model_name)
+                    logging.info(
+                        f"Loaded embedding model {self.model_name}: "
+                        f"import {imported - started:.2f}s, "
+                        f"load {time.perf_counter() - imported:.2f}s"
+                    )
+        return self._model
+
+    @property
+    def is_ready(self) -> bool:
+        return self._model is not None
+
+    def warm_up(self):
+        """
+        Loads the model and runs one encode so the first real request doesn't
+        pay for it. Meant to be run off the event loop during startup.
+        """
+        started = time.perf_counter()
+        self.model.encode("warm up", convert_to_numpy=True)
+        logging.info(f"Embedding model warm-up took {time.perf_counter() - started:.2f}s")
 
-        embedding = self.model.encode(text, convert_to_numpy=True)
+    def get_embedding(self, text: str, persist: bool = True) -> np.ndarray:
+        return self.get_embedding_matrix([text], persist=persist)[0]
 
-        if len(self.cache) >= self.cache_size:
-            self.cache.pop(next(iter(self.cache)))
+    def get_embeddings(self, texts: List[str], persist: bool = True) -> List[np.ndarray]:
+        return list(self.get_embedding_matrix(texts, persist=persist))
+
+    def get_embedding_matrix(self, texts: List[str], persist: bool = True) -> np.ndarray:
+        """
+        Embeds a list of texts as a single (len(texts), dim) float32 matrix
 
-        self.cache[text] = embedding
-        return embedding
+        Anything not in the memory cache is looked up in the persistent store
+        in one query, and whatever is left is encoded in one batched
+        model.encode call instead of one call per string.
 
-    def get_embeddings(self, texts: List[str]) -> List[np.ndarray]:
-        return [self.get_embedding(text) for text in texts]
+        persist - Whether to go through the persistent store at all. Pass
+            False for text that won't come up again, like page strings or a
+            cluster's keywords joined together, so only keywords fill the
+            embeddings table. Those still go in the memory cache.
+        """
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+
+        keys = [normalize_text(text) for text in texts]
+        found = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            embedding = self.cache.get(key)
+            if embedding is None:
+                missing.append(key)
+            else:
+                found[key] = embedding
+
+        if missing and persist:
+            stored = keyword_db.get_embeddings(self.model_name, missing)
+            for key, vector in stored.items():
+                embedding = np.frombuffer(vector, dtype=np.float32)
+                found[key] = embedding
+                self.cache.put(key, embedding)
+            self.store_hits += len(stored)
+            missing = [key for key in missing if key not in stored]
+
+        if missing:
+            encoded = self.model.encode(
+                missing, convert_to_numpy=True, batch_size=self.batch_size
+            ).astype(np.float32, copy=False)
+            for key, embedding in zip(missing, encoded):
+                found[key] = embedding
+                self.cache.put(key, embedding)
+            if persist:
+                keyword_db.insert_embeddings(
+                    self.model_name,
+                    [
+                        (key, embedding.shape[0], embedding.tobytes())
+                        for key, embedding in zip(missing, encoded)
+                    ],
+                )
+            self.encoded += len(missing)
+
+        return np.stack([found[key] for key in keys])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model_name": self.model_name,
+            "cache": self.cache.stats(),
+            "index": self.index.stats(),
+            "store_hits": self.store_hits,
+            "encoded": self.encoded,
+        }
 
     def cosine_similarity(self, text1: str, text2: str) -> float:
         emb1 = self.get_embedding(text1)
@@ -48,19 +172,39 @@ class EmbeddingService:
         emb2 = self.get_embedding(text2)
         return np.linalg.norm(emb1 - emb2)
 
+    def similarity_scores(
+        self, center: np.ndarray, keywords: List[str], persist: bool = True
+    ) -> np.ndarray:
+        """
+        Cosine similarity of every keyword to center, as one matrix-vector
+        product. persist is passed on to get_embedding_matrix.
+        """
+        if not keywords:
+            return np.empty(0, dtype=np.float32)
+        matrix = self.get_embedding_matrix(keywords, persist=persist)
+        return normalize_rows(matrix) @ normalize_rows(
+            np.asarray(center, dtype=np.float32)
+        )
+
     def find_similar_keywords(
-        self, seed_keyword: str, potential_keywords: List[str], threshold: float = 0.5
+        self,
+        seed_keyword: str,
+        potential_keywords: Optional[List[str]] = None,
+        threshold: float = 0.5,
     ) -> List[str]:
-        seed_emb = self.get_embedding(seed_keyword)
-        similar_keywords = []
-
-        for keyword in potential_keywords:
-            key_emb = self.get_embedding(keyword)
-            similarity = self.cosine_from_embedding(seed_emb, key_emb)
-            if similarity >= threshold:
-                similar_keywords.append(keyword)
-
-        return similar_keywords
+        """
+        The potential keywords with cosine similarity to seed_keyword of at
+        least threshold. Without potential_keywords, every keyword in the
+        keyword index is a candidate, most similar first.
+        """
+        if potential_keywords is None:
+            return [
+                kw for kw, _ in self.index.within(self.get_embedding(seed_keyword), threshold)
+            ]
+        scores = self.similarity_scores(
+            self.get_embedding(seed_keyword), potential_keywords
+        )
+        return [kw for kw, score in zip(potential_keywords, scores) if score >= threshold]
 
     def bucket_cosine(
         self, center: Any, keywords: List[str], center_type: str, buckets: int = 100
@@ -112,22 +256,62 @@ class EmbeddingService:
         else:
             raise ValueError("center_type must be 'keyword' or 'embedding'")
 
+        return self.bucket_cosine_many({"center": seed_emb}, keywords, buckets)[
+            "center"
+        ]
+
+    def bucket_cosine_many(
+        self, centers: Dict[str, np.ndarray], keywords: List[str], buckets: int = 100
+    ) -> Dict[str, Dict[str, List[str]]]:
+        """
+        Batched version of bucket_cosine for several centers at once
+
+        centers - Mapping of a name to the embedding to compare against
+        keywords - The list of keyword strings to compare to each center
+
+        The keyword list is encoded once as a matrix and normalized once, then
+        each center costs a single matrix-vector product. Returns one bucket
+        dict per center name, in the same shape bucket_cosine returns.
+        """
+
+        matrix = self.get_embedding_matrix(keywords)
+        if len(keywords):
+            matrix = normalize_rows(matrix)
+
+        results = {}
+        for name, center in centers.items():
+            if not len(keywords):
+                scores = np.empty(0, dtype=np.float32)
+            else:
+                scores = matrix @ normalize_rows(np.asarray(center, dtype=np.float32))
+            results[name] = self._bucket_scores(scores, keywords, buckets)
+
+        return results
+
+    @staticmethod
+    def _bucket_scores(
+        scores: np.ndarray, keywords: List[str], buckets: int
+    ) -> Dict[str, List[str]]:
+        """
+        Assigns each keyword to a bucket by its score with np.digitize
+
+        Buckets cover [-1, 1) in equal steps and are keyed by the string of
+        their lower edge. Scores outside that range (or NaN) are dropped,
+        same as the old per-bucket loop did.
+        """
+
         min = -1
         max = 1
         bucket_size = (max - min) / buckets
-        bucketed_keywords = {str(min + (i * bucket_size)): [] for i in range(buckets)}
+        edges = [min + (i * bucket_size) for i in range(buckets)]
+        bucketed_keywords = {str(edge): [] for edge in edges}
+        bucket_lists = list(bucketed_keywords.values())
 
-        for kw in keywords:
-            keyword_emb = self.get_embedding(kw)
-            similarity = self.cosine_from_embedding(seed_emb, keyword_emb)
-
-            for bucket in bucketed_keywords:
-                if (
-                    similarity >= float(bucket)
-                    and similarity < float(bucket) + bucket_size
-                ):
-                    bucketed_keywords[bucket].append(kw)
-                    break
+        indices = np.digitize(scores, edges) - 1
+        in_range = (scores >= edges[0]) & (scores < edges[-1] + bucket_size)
+        for kw, index, keep in zip(keywords, indices.tolist(), in_range.tolist()):
+            if keep:
+                bucket_lists[index].append(kw)
 
         return bucketed_keywords
 
@@ -188,11 +372,14 @@ class EmbeddingService:
         FIXME: Verify this works
         """
 
+        new_emb = self.get_embedding(new_keyword)
+        seed_embs = self.get_embedding_matrix(seed_keywords)
+        cos_sims = self.similarity_scores(new_emb, seed_keywords)
+        euc_dists = np.linalg.norm(seed_embs - new_emb, axis=1)
+
         max_similarity = -1
         assigned_cluster = None
-        for seed in seed_keywords:
-            cos_sim = self.cosine_similarity(new_keyword, seed)
-            euc_dist = self.euclidean_distance(new_keyword, seed)
+        for seed, cos_sim, euc_dist in zip(seed_keywords, cos_sims, euc_dists):
             combined_sim = self.combine_scores(
                 cos_sim, euc_dist
             )  # FIXME: implement this
@@ -201,17 +388,38 @@ class EmbeddingService:
                 assigned_cluster = seed
         return assigned_cluster
 
-    def categorize_keyword(self, new_keyword, seed_keywords, threshold=0.7):
+    def nearest_keywords(self, keyword: str, k: int = 10) -> List[Tuple[str, float]]:
+        """The k keywords in the keyword index most similar to keyword, with their scores"""
+        return self.index.top_k(self.get_embedding(keyword), k)
+
+    def discover_keywords(
+        self, seed_keywords: List[str], threshold: float, k: int
+    ) -> Dict[str, List[Tuple[str, float]]]:
+        """
+        For each seed, up to k keywords from the keyword index (other than the
+        seed itself) with cosine similarity of at least threshold, most
+        similar first
+        """
+        discovered = {seed: [] for seed in seed_keywords}
+        if not len(self.index):
+            return discovered
+        for seed, embedding in zip(seed_keywords, self.get_embedding_matrix(seed_keywords)):
+            key = normalize_text(seed)
+            discovered[seed] = [
+                (kw, score)
+                for kw, score in self.index.top_k(embedding, k + 1)
+                if score >= threshold and kw != key
+            ][:k]
+        return discovered
+
+    def categorize_keyword(self, new_keyword, seed_keywords=None, threshold=0.7):
         """
         FIXME: verify this works
+
+        Without seed_keywords, this looks through the keyword index
         """
 
-        categories = []
-        for seed in seed_keywords:
-            cos_sim = self.cosine_similarity(new_keyword, seed)
-            if cos_sim >= threshold:
-                categories.append(seed)
-        return categories
+        return self.find_similar_keywords(new_keyword, seed_keywords, threshold)
 
     def hierarchical_clustering(self, keywords, n_clusters):
         """
@@ -227,13 +435,17 @@ class EmbeddingService:
 
         """
 
-        embeddings = [self.get_embedding(kw) for kw in keywords]
-        linkage_matrix = linkage(embeddings, method="ward")
-        clusters = fcluster(linkage_matrix, n_clusters, criterion="maxclust")
-        return {
-            i: [kw for j, kw in enumerate(keywords) if clusters[j] == i]
-            for i in range(1, n_clusters + 1)
-        }
+        embeddings = self.get_embedding_matrix(keywords)
+        clusters = hierarchical_labels(embeddings, n_clusters)
+        return self.group_by_label(keywords, clusters, n_clusters)
+
+    @staticmethod
+    def group_by_label(keywords, labels, n_clusters) -> Dict[int, List[str]]:
+        """Turns fcluster's labels (1 to n_clusters) into {label: [keywords]}"""
+        clustered = {i: [] for i in range(1, n_clusters + 1)}
+        for kw, label in zip(keywords, labels):
+            clustered[int(label)].append(kw)
+        return clustered
 
     def combine_scores(self, cos_sim, euc_dist):
         """
@@ -247,23 +459,27 @@ class EmbeddingService:
         FIXME: Verify this works
         """
 
+        import networkx as nx
+
         G = nx.Graph()
-        for i, kw1 in enumerate(keywords):
-            for j, kw2 in enumerate(keywords[i + 1 :], i + 1):
-                sim = self.cosine_similarity(kw1, kw2)
-                if sim >= threshold:
-                    G.add_edge(kw1, kw2, weight=sim)
+        if not keywords:
+            return G
+        embeddings = normalize_rows(self.get_embedding_matrix(keywords))
+        sims = embeddings @ embeddings.T
+        for i, j in zip(*np.nonzero(np.triu(sims >= threshold, k=1))):
+            G.add_edge(keywords[i], keywords[j], weight=float(sims[i, j]))
         return G
 
     def detect_communities(G):
+        from networkx.algorithms import community
+
         return list(community.greedy_modularity_communities(G))
 
     def get_centroid(self, keywords):
         """
         Get the centroid of a group of keywords using the mean of their embeddings
         """
-        embeddings = [self.get_embedding(kw) for kw in keywords]
-        return np.mean(embeddings, axis=0)
+        return np.mean(self.get_embedding_matrix(keywords), axis=0)
 
 
 embedding_service = EmbeddingService()  # Global instance
@@ -0,0 +1,98 @@
+"""
+In-memory LRU cache for keyword embeddings
+
+Vectors live in one contiguous float32 array sized from a byte budget,
+rather than as one ndarray object per key, so the memory used is known up
+front and doesn't carry per-object overhead. Keys map to a row in that
+array and the least recently used row is reused when the array is full.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+
+class EmbeddingCache:
+    def __init__(self, max_bytes: int):
+        """
+        max_bytes - Budget for the vector storage itself. The row count is
+        worked out from this once the embedding dimension is known.
+
+        The array is allocated with np.empty, so pages are only actually
+        committed as rows get written.
+        """
+        self.max_bytes = max_bytes
+        self.slots: "OrderedDict[str, int]" = OrderedDict()
+        self.vectors: Optional[np.ndarray] = None
+        self.free_slots = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _allocate(self, dim: int):
+        capacity = max(1, self.max_bytes // (dim * np.dtype(np.float32).itemsize))
+        self.vectors = np.empty((capacity, dim), dtype=np.float32)
+        self.free_slots = list(range(capacity - 1, -1, -1))
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Returns a copy of the cached vector, or None on a miss"""
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                self.misses += 1
+                return None
+            self.slots.move_to_end(key)
+            self.hits += 1
+            return self.vectors[slot].copy()
+
+    def put(self, key: str, vector: np.ndarray):
+        with self.lock:
+            if self.vectors is None:
+                self._allocate(vector.shape[-1])
+            elif vector.shape[-1] != self.vectors.shape[1]:
+                raise ValueError(
+                    f"Embedding has dimension {vector.shape[-1]}, cache holds {self.vectors.shape[1]}"
+                )
+
+            slot = self.slots.get(key)
+            if slot is not None:
+                self.slots.move_to_end(key)
+            elif self.free_slots:
+                slot = self.free_slots.pop()
+                self.slots[key] = slot
+            else:
+                _, slot = self.slots.popitem(last=False)
+                self.evictions += 1
+                self.slots[key] = slot
+
+            self.vectors[slot] = vector
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.slots
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def clear(self):
+        with self.lock:
+            self.slots.clear()
+            if self.vectors is not None:
+                self.free_slots = list(range(len(self.vectors) - 1, -1, -1))
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            row_bytes = 0 if self.vectors is None else self.vectors[0].nbytes
+            return {
+                "entries": len(self.slots),
+                "capacity": 0 if self.vectors is None else len(self.vectors),
+                "bytes_used": len(self.slots) * row_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
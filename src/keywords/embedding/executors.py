@@ -0,0 +1,111 @@
+"""
+Executors for the CPU-heavy embedding and clustering work
+
+Job handlers are async and run on the same event loop as every HTTP
+request, so anything that takes real CPU time goes through here:
+
+    - Model inference and the NumPy work around it runs on a single
+      dedicated thread. torch releases the GIL while it computes, and one
+      thread keeps the (already warm) model from being used concurrently.
+    - scipy's linkage holds the GIL for its whole run, so it goes to a
+      separate process. The embedding matrix is handed over in shared
+      memory as float32 and the cluster labels come back the same way, so
+      nothing large gets pickled.
+
+The clustering workers only ever see vectors, so they don't need a copy of
+the model. They import scipy when they start so the first job doesn't pay
+for it.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CLUSTER_PROCESSES = 1
+
+embedding_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+_cluster_executor: ProcessPoolExecutor = None
+
+
+def _warm_cluster_worker():
+    import scipy.cluster.hierarchy  # noqa: F401
+
+
+def get_cluster_executor() -> ProcessPoolExecutor:
+    global _cluster_executor
+    if _cluster_executor is None:
+        _cluster_executor = ProcessPoolExecutor(
+            max_workers=CLUSTER_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm_cluster_worker,
+        )
+    return _cluster_executor
+
+
+async def run_embedding_task(fn, *args, **kwargs):
+    """Runs fn on the embedding thread and waits for it without blocking the loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(embedding_executor, partial(fn, *args, **kwargs))
+
+
+def hierarchical_labels(embeddings: np.ndarray, n_clusters: int) -> np.ndarray:
+    """Ward linkage cut into at most n_clusters clusters, labelled from 1"""
+    from scipy.cluster.hierarchy import fcluster, linkage
+
+    linkage_matrix = linkage(embeddings, method="ward")
+    return fcluster(linkage_matrix, n_clusters, criterion="maxclust")
+
+
+def _cluster_shared(shm_name: str, rows: int, dim: int, n_clusters: int):
+    """
+    Worker side of cluster_in_process. The block holds the (rows, dim)
+    float32 embeddings followed by room for rows int32 labels.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        embeddings = np.ndarray((rows, dim), dtype=np.float32, buffer=shm.buf)
+        labels = np.ndarray(
+            (rows,), dtype=np.int32, buffer=shm.buf, offset=embeddings.nbytes
+        )
+        labels[:] = hierarchical_labels(embeddings, n_clusters)
+        del embeddings, labels
+    finally:
+        shm.close()
+
+
+async def cluster_in_process(embeddings: np.ndarray, n_clusters: int) -> np.ndarray:
+    """
+    Runs hierarchical_labels in the clustering process pool and returns the labels
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    rows, dim = embeddings.shape
+    shm = shared_memory.SharedMemory(
+        create=True, size=embeddings.nbytes + rows * np.dtype(np.int32).itemsize
+    )
+    try:
+        np.ndarray(embeddings.shape, dtype=np.float32, buffer=shm.buf)[:] = embeddings
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            get_cluster_executor(), _cluster_shared, shm.name, rows, dim, n_clusters
+        )
+        return np.ndarray(
+            (rows,), dtype=np.int32, buffer=shm.buf, offset=embeddings.nbytes
+        ).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def shutdown_executors():
+    global _cluster_executor
+    embedding_executor.shutdown(wait=False, cancel_futures=True)
+    if _cluster_executor is not None:
+        _cluster_executor.shutdown(wait=False, cancel_futures=True)
+        _cluster_executor = None
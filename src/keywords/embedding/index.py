@@ -0,0 +1,273 @@
+"""
+Bounded vector index over the keywords in the keyword cache
+
+Holds unit-length float32 vectors for at most max_keywords keywords. When
+it's full the keyword added longest ago gives up its row, so the index keeps
+the most recently cached keywords and its memory never grows past
+max_keywords rows.
+
+Small indexes are searched exactly with one matrix-vector product. Once the
+index passes IVF_MIN_SIZE it also trains a coarse k-means quantizer (an IVF
+index, all in NumPy) and queries only score the rows in the few lists
+closest to the query. Passing exact=True always does the full scan.
+
+Keywords are queued with add_pending as they're written to the cache.
+maintain runs for the life of the app: it queues the most recently updated
+max_keywords keywords already in the keywords table, then embeds whatever
+is pending one batch at a time on the embedding thread. Queries only search
+what's already been embedded, so neither writes to the cache nor queries
+ever wait on the model for the index.
+"""
+
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from config import KEYWORD_INDEX_FLUSH_SECONDS
+
+from .executors import run_embedding_task
+
+logger = logging.getLogger(__name__)
+
+# Below this many vectors a full scan is cheap enough that IVF isn't worth it
+IVF_MIN_SIZE = 20000
+# Lists probed per query. More is slower but closer to the exact result.
+IVF_PROBES = 8
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_SIZE = 50000
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scales each row to unit length so a dot product is the cosine similarity"""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+class KeywordIndex:
+    def __init__(self, embedding_service, max_keywords: int, ivf_min_size: int = IVF_MIN_SIZE):
+        """
+        max_keywords - Most keywords held at once, and also the most queued
+            with add_pending, since any past that would be evicted anyway
+        """
+        self.embedding_service = embedding_service
+        self.max_keywords = max_keywords
+        self.ivf_min_size = ivf_min_size
+        # Keyword to row, oldest first
+        self.rows: "OrderedDict[str, int]" = OrderedDict()
+        self.keys: List[str] = []
+        self.vectors: Optional[np.ndarray] = None
+        self.pending: "OrderedDict[str, None]" = OrderedDict()
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+        # IVF state, only populated once the index is big enough
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments: Optional[np.ndarray] = None
+        self.trained_size = 0
+        self.added_since_training = 0
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.rows
+
+    def load_from_db(self):
+        """Queues the most recently updated keywords already in the keywords table"""
+        from keywords import db as keyword_db
+
+        self.add_pending(reversed(keyword_db.get_recent_keywords(self.max_keywords)))
+        logger.info(f"Queued {len(self.pending)} cached keywords for the keyword index")
+
+    def add_pending(self, keywords: Iterable[str]):
+        """Queues keywords to be embedded and added by maintain"""
+        from keywords.embedding import normalize_text
+
+        with self.lock:
+            for keyword in keywords:
+                key = normalize_text(keyword)
+                if key in self.rows:
+                    self.rows.move_to_end(key)
+                    continue
+                self.pending[key] = None
+                self.pending.move_to_end(key)
+                if len(self.pending) > self.max_keywords:
+                    self.pending.popitem(last=False)
+
+    def add(self, keys: List[str], vectors: np.ndarray):
+        """
+        Adds already-embedded keywords, evicting the oldest once full.
+        Keywords already indexed count as added again but keep their row.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self.lock:
+            new = {}
+            for i, key in enumerate(keys):
+                if key in self.rows:
+                    self.rows.move_to_end(key)
+                else:
+                    new.setdefault(key, i)
+            # Only the newest max_keywords of a big batch would survive it
+            new = list(new.values())[-self.max_keywords :]
+            if not new:
+                return
+
+            vectors = normalize_rows(vectors[new])
+            rows = []
+            for i in new:
+                if len(self.rows) < self.max_keywords:
+                    row = len(self.rows)
+                    self._reserve(row + 1, vectors.shape[1])
+                    self.keys.append(keys[i])
+                else:
+                    _, row = self.rows.popitem(last=False)
+                    self.evictions += 1
+                    self.keys[row] = keys[i]
+                self.rows[keys[i]] = row
+                rows.append(row)
+            rows = np.asarray(rows)
+            self.vectors[rows] = vectors
+
+            self.added_since_training += len(rows)
+            if self.centroids is not None:
+                self.assignments[rows] = self._nearest_list(vectors)
+            # Retrain as the index doubles, or turns over as much as it was trained on
+            if len(self.rows) >= self.ivf_min_size and self.added_since_training >= self.trained_size:
+                self._train()
+
+    def _reserve(self, size: int, dim: int):
+        """Grows the vector (and list assignment) arrays by doubling, up to max_keywords"""
+        if self.vectors is None:
+            capacity = min(max(size, 1024), self.max_keywords)
+            self.vectors = np.empty((capacity, dim), dtype=np.float32)
+            self.assignments = np.zeros(capacity, dtype=np.int32)
+        elif size > len(self.vectors):
+            capacity = min(max(size, 2 * len(self.vectors)), self.max_keywords)
+            vectors = np.empty((capacity, dim), dtype=np.float32)
+            vectors[: len(self.keys)] = self.vectors[: len(self.keys)]
+            self.vectors = vectors
+            assignments = np.zeros(capacity, dtype=np.int32)
+            assignments[: len(self.keys)] = self.assignments[: len(self.keys)]
+            self.assignments = assignments
+        elif dim != self.vectors.shape[1]:
+            raise ValueError(
+                f"Embedding has dimension {dim}, index holds {self.vectors.shape[1]}"
+            )
+
+    def flush_batch(self) -> int:
+        """Embeds and adds up to one batch of pending keywords, returning how many"""
+        with self.lock:
+            keys = list(islice(self.pending, self.embedding_service.batch_size))
+            for key in keys:
+                del self.pending[key]
+        if keys:
+            self.add(keys, self.embedding_service.get_embedding_matrix(keys))
+        return len(keys)
+
+    async def maintain(self, interval: float = KEYWORD_INDEX_FLUSH_SECONDS):
+        """
+        Loads the index from the keywords table, then keeps adding newly
+        cached keywords every interval seconds until cancelled
+
+        Each batch is its own embedding task, so a query submitted while the
+        initial load is running only waits for the batch in progress.
+        """
+        loaded = False
+        while True:
+            try:
+                if not loaded:
+                    await run_embedding_task(self.load_from_db)
+                    loaded = True
+                while await run_embedding_task(self.flush_batch):
+                    pass
+            except Exception:
+                logger.exception("Adding keywords to the keyword index failed")
+            await asyncio.sleep(interval)
+
+    def _train(self):
+        """
+        Runs a few rounds of k-means (spherical, since vectors are unit length)
+        to pick sqrt(n) list centroids, then assigns every vector to a list
+        """
+        size = len(self.keys)
+        data = self.vectors[:size]
+        n_lists = int(np.sqrt(size))
+        rng = np.random.default_rng(0)
+        sample = data[rng.choice(size, min(size, KMEANS_SAMPLE_SIZE), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+
+        for _ in range(KMEANS_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            # Empty lists keep their old centroid
+            sums[counts == 0] = centroids[counts == 0]
+            centroids = normalize_rows(sums)
+
+        self.centroids = centroids
+        self.assignments[:size] = self._nearest_list(data)
+        self.trained_size = size
+        self.added_since_training = 0
+        logger.info(f"Trained keyword index: {size} vectors in {n_lists} lists")
+
+    def _nearest_list(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def _search(self, vector: np.ndarray, exact: bool, pick) -> List[Tuple[str, float]]:
+        """
+        Scores the query against every row (or the probed IVF lists) and
+        returns (keyword, score) for the positions pick(scores) chooses
+        """
+        query = normalize_rows(np.asarray(vector, dtype=np.float32))
+        with self.lock:
+            size = len(self.keys)
+            if not size:
+                return []
+            if exact or self.centroids is None:
+                rows = np.arange(size)
+            else:
+                probes = np.argsort(-(self.centroids @ query))[:IVF_PROBES]
+                rows = np.flatnonzero(np.isin(self.assignments[:size], probes))
+            scores = self.vectors[rows] @ query
+            return [(self.keys[rows[i]], float(scores[i])) for i in pick(scores)]
+
+    def top_k(
+        self, vector: np.ndarray, k: int = 10, exact: bool = False
+    ) -> List[Tuple[str, float]]:
+        """The k most similar keywords, most similar first"""
+
+        def best(scores):
+            candidates = np.arange(len(scores))
+            if len(scores) > k:
+                candidates = np.argpartition(-scores, k)[:k]
+            return candidates[np.argsort(-scores[candidates])]
+
+        return self._search(vector, exact, best)
+
+    def within(
+        self, vector: np.ndarray, threshold: float, exact: bool = False
+    ) -> List[Tuple[str, float]]:
+        """Every keyword with cosine similarity >= threshold, most similar first"""
+
+        def close(scores):
+            keep = np.flatnonzero(scores >= threshold)
+            return keep[np.argsort(-scores[keep])]
+
+        return self._search(vector, exact, close)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "size": len(self.rows),
+                "max_keywords": self.max_keywords,
+                "pending": len(self.pending),
+                "evictions": self.evictions,
+                "lists": 0 if self.centroids is None else len(self.centroids),
+                "trained_size": self.trained_size,
+            }
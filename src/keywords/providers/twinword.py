@@ -2,11 +2,16 @@
 Generates similar keywords for a given keyword using the Twinword API
 
 Includes the ability to pass multiple keywords at once
+
+get_similar_async shares one pooled httpx.AsyncClient so requests made from
+the job runner don't block the event loop or pay for a new TLS handshake
+every time. Call close_client on shutdown.
 """
 
 import logging
 import os
 
+import httpx
 import requests
 
 logger = logging.getLogger(__name__)
@@ -14,7 +19,12 @@ logger = logging.getLogger(__name__)
 TWINWORD_API_KEY = os.getenv("TWINWORD_API_KEY")
 
 # 9 requests per minute. Limit is supposedly 12, but had rate limit errors at 12 and then at 10.
-TWINWORD_RATE_LIMIT = 9
+TWINWORD_RATE_LIMIT = int(os.getenv("TWINWORD_RATE_LIMIT", "9"))
+
+TWINWORD_URL = "https://twinword-keyword-suggestion-v1.p.rapidapi.com/suggest/"
+TWINWORD_HOST = "twinword-keyword-suggestion-v1.p.rapidapi.com"
+
+_client: httpx.AsyncClient = None
 
 
 def get_similar(keyword, location="CA"):
@@ -46,3 +56,51 @@ def get_similar(keyword, location="CA"):
         return None
 
     return response.json()["keywords"]
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            headers={
+                "x-rapidapi-key": TWINWORD_API_KEY or "",
+                "x-rapidapi-host": TWINWORD_HOST,
+            },
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def get_similar_async(keyword, location="CA"):
+    """
+    Same as get_similar, but on the shared async client
+    """
+
+    querystring = {"phrase": keyword, "lang": "en", "loc": location}
+
+    try:
+        response = await get_client().get(TWINWORD_URL, params=querystring)
+    except httpx.HTTPError as e:
+        logger.error(f"Error getting similar keywords for '{keyword}': {e}")
+        return None
+
+    if response.status_code != 200:
+        logger.error(f"Error getting similar keywords for '{keyword}': {response.text}")
+        return None
+
+    body = response.json()
+    if body["result_code"] != "200":
+        logger.error(
+            f"Error getting similar keywords for '{keyword}': {body['result_msg']}"
+        )
+        return None
+
+    return body["keywords"]
@@ -3,6 +3,7 @@ import asyncio
 import logging
 import os
 import sqlite3
+import time
 from contextlib import asynccontextmanager
 
 import uvicorn
@@ -12,6 +13,10 @@ from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from jobs import job_manager
+from jobs.db import check_query_plans
+from keywords.embedding import embedding_service
+from keywords.embedding.executors import run_embedding_task, shutdown_executors
+from keywords.providers import twinword
 from starlette.middleware.sessions import SessionMiddleware
 from web.routes import router as api_router
 
@@ -37,12 +42,41 @@ def table_exists(conn, table_name):
     return cursor.fetchone() is not None
 
 
+def has_legacy_jobs_schema(conn) -> bool:
+    """
+    True if the jobs tables still have the layout the old reinitialize-on-boot
+    code created (task_versions.id was TEXT, so version ids were never set)
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(task_versions)")
+    return any(column[1] == "version_number" for column in cursor.fetchall())
+
+
 def initialize_database(db_manager):
+    """
+    Drops the jobs tables so initialize_tables recreates them empty
+
+    Only runs when REINITIALIZE_DB is set, or once to clear out the legacy
+    schema. Jobs otherwise persist across restarts so unfinished ones can resume.
+    """
     with db_manager.get_db("jobs") as conn:
+        if not REINITIALIZE_DB and not has_legacy_jobs_schema(conn):
+            logger.info("Keeping existing jobs database")
+            return
+
         try:
             conn.execute("BEGIN TRANSACTION")
 
-            tables_to_drop = ["jobs", "job_tasks", "task_versions"]
+            # Referencing tables first, result_blobs after everything that points at it
+            tables_to_drop = [
+                "task_memo",
+                "task_dependencies",
+                "current_task_versions",
+                "task_versions",
+                "result_blobs",
+                "job_tasks",
+                "jobs",
+            ]
             for table in tables_to_drop:
                 if table_exists(conn, table):
                     logger.info(f"Dropping table: {table}")
@@ -51,41 +85,6 @@ def initialize_database(db_manager):
                     logger.info(f"Table {table} does not exist, skipping drop")
             logger.info("Tables dropped successfully")
 
-            logger.info("Creating new tables")
-            create_tables_sql = """
-                CREATE TABLE jobs (
-                    id TEXT PRIMARY KEY,
-                    status TEXT,
-                    data JSON,
-                    created_at TIMESTAMP,
-                    updated_at TIMESTAMP
-                );
-                
-                CREATE TABLE job_tasks (
-                    id TEXT PRIMARY KEY,
-                    job_id TEXT,
-                    task_id TEXT,
-                    task_type TEXT,
-                    task_order INTEGER,
-                    status TEXT,
-                    created_at TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    selected_version_id TEXT,
-                    FOREIGN KEY (job_id) REFERENCES jobs(id)
-                );
-                
-                CREATE TABLE task_versions (
-                    id TEXT PRIMARY KEY,
-                    task_id TEXT,
-                    version_number INTEGER,
-                    result TEXT,
-                    created_at TIMESTAMP,
-                    FOREIGN KEY (task_id) REFERENCES job_tasks(id)
-                );
-            """
-            conn.executescript(create_tables_sql)
-            logger.info("New tables created successfully")
-
             conn.commit()
             logger.info("Transaction committed")
 
@@ -94,27 +93,59 @@ def initialize_database(db_manager):
             logger.error(f"An error occurred: {e}")
             raise
 
-        finally:
-            logger.info("Verifying 'jobs' table schema:")
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA table_info(jobs)")
-            columns = cursor.fetchall()
-            for column in columns:
-                logger.info(f"- {column[1]} ({column[2]})")
-
         logger.info("Database initialization complete")
 
 
+def log_warm_up_failure(warm_up: asyncio.Task):
+    """
+    Done-callback for the model warm-up. Nothing awaits it, so without this
+    a failed download or load would go unlogged and /ready would look like
+    it's still starting.
+    """
+    if warm_up.cancelled():
+        return
+    error = warm_up.exception()
+    if error is not None:
+        embedding_service.warm_up_error = f"{type(error).__name__}: {error}"
+        logger.error("Embedding model warm-up failed", exc_info=error)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    timings = {}
+    started = time.perf_counter()
+
     db_manager.initialize_connections()
+    timings["db connections"] = time.perf_counter() - started
+
+    step = time.perf_counter()
     initialize_database(db_manager)
     db_manager.initialize_tables()
     check_schema(db_manager)
+    # On the writer, since the readers can still have the schema from
+    # before initialize_tables cached, and EXPLAIN doesn't reload it
+    with db_manager.get_db("jobs") as conn:
+        check_query_plans(conn)
+    timings["db schema"] = time.perf_counter() - step
+
+    # The model loads in the background so the port is bound and /health
+    # answers straight away. /ready reports when it's done. It goes on the
+    # embedding thread like every other use of the model.
+    warm_up = asyncio.create_task(run_embedding_task(embedding_service.warm_up))
+    warm_up.add_done_callback(log_warm_up_failure)
+    # Queued behind the warm-up, so the keyword index starts filling once the
+    # model is loaded rather than on the first job that queries it
+    keyword_index = asyncio.create_task(embedding_service.index.maintain())
 
     task = asyncio.create_task(job_manager.process_tasks())
     logger.info("Job processing task created")
 
+    timings["total"] = time.perf_counter() - started
+    logger.info(
+        "Startup complete: "
+        + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timings.items())
+    )
+
     yield
 
     logger.info("Server shutdown")
@@ -123,6 +154,11 @@ async def lifespan(app: FastAPI):
         await task  # Wait for the task to be cancelled
     except asyncio.CancelledError:
         logger.info("Job processing task cancelled")
+    if not warm_up.done():
+        warm_up.cancel()
+    keyword_index.cancel()
+    await twinword.close_client()
+    shutdown_executors()
     db_manager.close_all_db()
 
 
@@ -38,9 +38,7 @@ oauth2_scheme = OAuth2AuthorizationCodeBearer(
 
 # add a /heartbeat route for the frontend to poll the backend for
 # data with a submission id number
-
-
-job_progress = {}
+# (/progress/{job_id} in routes.py streams the same updates instead)
 
 
 if __name__ == "__main__":
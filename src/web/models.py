@@ -19,6 +19,16 @@ class JobStatus(BaseModel):
     tasks: List[Dict[str, Any]]
 
 
+class PageSubmission(BaseModel):
+    """A page past the first one in a multi-page job"""
+
+    pageUrl: HttpUrl
+    pageTitle: str
+    pageInfo: str
+    pageUsp: str
+    isNewPage: bool
+
+
 class JobSubmission(BaseModel):
     pageType: str
     companyName: str
@@ -31,6 +41,27 @@ class JobSubmission(BaseModel):
     pageInfo: str
     pageUsp: str
     isNewPage: bool
+    # Each additional page gets its own cluster selection and HTML
+    additionalPages: List[PageSubmission] = []
+
+
+class JobEdit(BaseModel):
+    """Any of the JobSubmission fields, for changing a job before rerunning it"""
+
+    pageType: Optional[str] = None
+    companyName: Optional[str] = None
+    companyUrl: Optional[HttpUrl] = None
+    companyDescription: Optional[str] = None
+    seedKeywords: Optional[Union[str, List[str]]] = None
+    locations: Optional[Union[str, List[str]]] = None
+    pageUrl: Optional[HttpUrl] = None
+    pageTitle: Optional[str] = None
+    pageInfo: Optional[str] = None
+    pageUsp: Optional[str] = None
+    isNewPage: Optional[bool] = None
+    # Replaces every page past the first. The job keeps the pages it was
+    # submitted with, so this has to have as many as it already does.
+    additionalPages: Optional[List[PageSubmission]] = None
 
 
 class KeywordData(BaseModel):
@@ -2,22 +2,51 @@
 All of the routes for the FastAPI application will be defined here.
 """
 
+import asyncio
 import json
 import logging
 import secrets
 
+import keywords
+from db import db_manager
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import FileResponse, RedirectResponse
-from jobs import job_manager, serialize_job_data
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
+from jobs import (
+    JobEditError,
+    JobInProgressError,
+    JobLimitError,
+    job_manager,
+    serialize_job_data,
+)
+from jobs.events import FINAL_EVENTS, job_progress
+from keywords.embedding import embedding_service
 from pydantic import ValidationError
 from starlette.status import HTTP_302_FOUND, HTTP_303_SEE_OTHER
 
 from web.auth import authenticate_user, get_current_user, oauth
-from web.models import JobSubmission, User
+from web.models import JobEdit, JobSubmission, User
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+# Proxies drop idle connections, so /progress sends a comment this often
+PROGRESS_KEEPALIVE_SECONDS = 15
+
+# Submission fields that make up the job's current_page, and their names there
+PAGE_FIELDS = {
+    "pageUrl": "url",
+    "pageTitle": "title",
+    "pageInfo": "info",
+    "pageUsp": "usp",
+    "isNewPage": "is_new",
+}
+
 
 @router.get("/")
 async def read_root(request: Request):
@@ -56,43 +85,51 @@ async def protected_route(user: User = Depends(get_current_user)):
     return {"message": f"Hello, {user.email}! This is a protected route."}
 
 
+def form_to_job_data(fields: dict) -> dict:
+    """
+    Turns submission form fields into the job data the tasks read: locations
+    and seedKeywords become lists and the page fields move into current_page.
+    Fields that aren't given are left out, so this works on edits too.
+    """
+    job_dict = dict(fields)
+
+    # Convert locations back to a list if it's a JSON string
+    if isinstance(job_dict.get("locations"), str):
+        job_dict["locations"] = json.loads(job_dict["locations"])
+
+    # Ensure seedKeywords is a list
+    if isinstance(job_dict.get("seedKeywords"), str):
+        job_dict["seedKeywords"] = [kw.strip() for kw in job_dict["seedKeywords"].split(",")]
+
+    current_page = {
+        name: job_dict.pop(field) for field, name in PAGE_FIELDS.items() if field in job_dict
+    }
+    if current_page:
+        job_dict["current_page"] = current_page
+
+    # An edit that sets additionalPages to [] keeps it, so start_rerun sees the pages go
+    additional_pages = job_dict.pop("additionalPages", None)
+    if additional_pages is not None:
+        job_dict["additional_pages"] = [
+            {name: page[field] for field, name in PAGE_FIELDS.items()}
+            for page in additional_pages
+        ]
+
+    return serialize_job_data(job_dict)
+
+
 @router.post("/submission")
 async def submission(job_data: JobSubmission, user: User = Depends(get_current_user)):
     logger.info(f"Received job submission: {job_data.dict()}")
     try:
-        # Convert locations back to a list if it's a JSON string
-        if isinstance(job_data.locations, str):
-            job_data.locations = json.loads(job_data.locations)
-
-        # Ensure seedKeywords is a list
-        if isinstance(job_data.seedKeywords, str):
-            job_data.seedKeywords = [
-                kw.strip() for kw in job_data.seedKeywords.split(",")
-            ]
-
-        # Create a dictionary with the current page data
-        current_page = {
-            "url": job_data.pageUrl,
-            "title": job_data.pageTitle,
-            "info": job_data.pageInfo,
-            "usp": job_data.pageUsp,
-            "is_new": job_data.isNewPage,
-        }
-
-        # Prepare the job data
-        job_dict = job_data.dict()
-        job_dict["current_page"] = current_page
-
-        # Remove the individual page fields from the top level
-        for field in ["pageUrl", "pageTitle", "pageInfo", "pageUsp", "isNewPage"]:
-            job_dict.pop(field, None)
-
-        # Serialize the job data
-        serialized_job_dict = serialize_job_data(job_dict)
+        # Unset, additionalPages stays out of the job data like it did before multi-page jobs
+        serialized_job_dict = form_to_job_data(job_data.dict(exclude_unset=True))
 
         logger.info(f"Submitting job with data: {serialized_job_dict}")
-        job_id = await job_manager.create_job(serialized_job_dict)
+        job_id = await job_manager.create_job(serialized_job_dict, user_email=user.email)
         return {"job_id": job_id}
+    except JobLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
     except ValidationError as ve:
         logger.error(f"Validation error: {ve.json()}")
         raise HTTPException(status_code=422, detail=ve.errors())
@@ -101,13 +138,150 @@ async def submission(job_data: JobSubmission, user: User = Depends(get_current_u
         raise HTTPException(status_code=500, detail=f"Failed to create job: {str(e)}")
 
 
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
 @router.get("/heartbeat/{job_id}")
-async def heartbeat(job_id: str, user: User = Depends(get_current_user)):
-    job_status = await job_manager.get_detailed_job_status(job_id)
-    if job_status is None:
+async def heartbeat(
+    job_id: str,
+    request: Request,
+    include_data: bool = False,
+    user: User = Depends(get_current_user),
+):
+    """
+    Job and task statuses, plus each task's current result if include_data
+    is set. Send the ETag back in If-None-Match to get a 304 while nothing
+    has changed.
+
+    The ETag is checked against a statuses-only snapshot, so results are
+    only read when a 200 is going out with them.
+    """
+    suffix = "-data" if include_data else ""
+    snapshot = await job_manager.get_job_snapshot(job_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    etag = f'"{snapshot.etag}{suffix}"'
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    if include_data:
+        snapshot = await job_manager.get_job_snapshot(job_id, results=True)
+        if snapshot is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        # The job may have moved on since the check, tag what's being sent
+        etag = f'"{snapshot.etag}{suffix}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    logger.debug(f"Heartbeat for job {job_id}: {snapshot.status}")
+    return JSONResponse(snapshot.status_dict(include_data=include_data), headers=headers)
+
+
+def sse_message(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@router.get("/progress/{job_id}")
+async def progress(job_id: str, request: Request, user: User = Depends(get_current_user)):
+    """
+    Server-Sent Events stream of a job's progress
+
+    Starts with a "snapshot" event holding the job and task statuses, then
+    sends each job event (task_started, task_completed with a summary of
+    the result and the page of a per-page task, task_failed, job_completed,
+    job_failed) as it happens. The stream ends once the job has finished.
+    Full results are fetched from /job/{job_id}/result/{task_type}?page=.
+    """
+    # Subscribe before reading the snapshot so nothing falls in between.
+    # An event can show up in both, which is harmless.
+    queue = job_progress.subscribe(job_id)
+    snapshot = await job_manager.get_job_progress(job_id)
+    if snapshot is None:
+        job_progress.unsubscribe(job_id, queue)
         raise HTTPException(status_code=404, detail="Job not found")
-    logger.debug(f"Heartbeat for job {job_id}: {job_status}")
-    return job_status
+
+    async def stream():
+        try:
+            yield sse_message("snapshot", snapshot)
+            if snapshot["status"] in ("completed", "failed"):
+                return
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), PROGRESS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_message(event["event"], event)
+                if event["event"] in FINAL_EVENTS:
+                    return
+        finally:
+            job_progress.unsubscribe(job_id, queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/job/{job_id}/result/{task_type}")
+async def get_task_result(
+    job_id: str, task_type: str, page: int = None, user: User = Depends(get_current_user)
+):
+    """The task's current result. Pass page for a per-page task of a multi-page job."""
+    result = await job_manager.get_previous_task_data(job_id, task_type.upper(), page)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Result not found")
+    return result
+
+
+@router.post("/job/{job_id}/rerun", status_code=202)
+async def rerun_job(
+    job_id: str, edits: JobEdit = None, user: User = Depends(get_current_user)
+):
+    """
+    Applies any edits to a finished job's input and runs it again. Tasks
+    whose inputs come out the same keep their results, so changing one seed
+    keyword only re-executes what that seed feeds into. Follow it on
+    /progress/{job_id} like a new job.
+    """
+    changes = form_to_job_data(edits.dict(exclude_unset=True)) if edits else {}
+    logger.info(f"Rerunning job {job_id} with changes: {changes}")
+    try:
+        tasks = await job_manager.edit_job(job_id, changes)
+    except JobInProgressError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except JobEditError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"job_id": job_id, "tasks": [task["task_type"] for task in tasks]}
+
+
+@router.post("/job/{job_id}/rerun/{task_type}", status_code=202)
+async def rerun_task(
+    job_id: str, task_type: str, page: int = None, user: User = Depends(get_current_user)
+):
+    """
+    Executes one of a finished job's tasks again, then whatever depends on
+    it if its result changed. Pass page for a per-page task.
+    """
+    snapshot = await job_manager.get_job_snapshot(job_id)
+    task = snapshot.task(task_type.upper(), page) if snapshot else None
+    if task is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    try:
+        tasks = await job_manager.rerun_task(task.id)
+    except JobInProgressError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"job_id": job_id, "tasks": [task["task_type"] for task in tasks]}
 
 
 @router.get("/health")
@@ -115,6 +289,36 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@router.get("/ready")
+async def readiness_check():
+    """
+    Separate from /health so Fly can keep routing health checks while the
+    embedding model is still loading in the background. Reports "failed"
+    with the error if loading it at startup failed.
+    """
+    checks = {
+        "database": db_manager.is_initialized("jobs"),
+        "embedding_model": embedding_service.is_ready,
+    }
+    if all(checks.values()):
+        return JSONResponse(status_code=200, content={"status": "ready", "checks": checks})
+    content = {"status": "starting", "checks": checks}
+    if not embedding_service.is_ready and embedding_service.warm_up_error:
+        content.update(status="failed", error=embedding_service.warm_up_error)
+    return JSONResponse(status_code=503, content=content)
+
+
+@router.get("/metrics")
+async def metrics():
+    return {
+        "embeddings": embedding_service.stats(),
+        "similar_search_cache": keywords.search_cache.stats(),
+        "job_progress": job_progress.stats(),
+        "task_memo": job_manager.memo_stats(),
+        "db": db_manager.stats(),
+    }
+
+
 @router.get("/auth-error")
 async def auth_error(request: Request):
     error = request.query_params.get("error", "unknown_error")
@@ -127,3 +331,12 @@ async def get_job_details(job_id: str, user: User = Depends(get_current_user)):
     if job_details is None:
         raise HTTPException(status_code=404, detail="Job not found")
     return job_details
+
+
+@router.get("/debug/job/{job_id}")
+async def debug_job_state(job_id: str, user: User = Depends(get_current_user)):
+    """Logs the full state of a job, every version of every task included"""
+    job_state = await job_manager.log_job_state(job_id)
+    if job_state is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_state
@@ -0,0 +1,41 @@
+"""
+Shared fixtures
+
+support puts the app's modules from src/ on the path, and each test gets
+its own empty databases.
+"""
+
+import pytest
+from support import sample_job_data
+
+
+@pytest.fixture
+def databases(tmp_path):
+    """db_manager with fresh jobs and keyword_cache databases under tmp_path"""
+    from db import db_manager
+
+    db_manager.init_db(str(tmp_path / "jobs.db"), "jobs")
+    db_manager.init_db(str(tmp_path / "keyword_cache.db"), "keyword_cache")
+    db_manager.initialize_tables()
+    yield db_manager
+    db_manager.close_all_db()
+
+
+@pytest.fixture
+def job_data():
+    return sample_job_data()
+
+
+@pytest.fixture
+def client():
+    """A TestClient for the app's routes, signed in"""
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from web.auth import User, get_current_user
+    from web.routes import router
+
+    app = FastAPI()
+    app.include_router(router)
+    app.dependency_overrides[get_current_user] = lambda: User(email="user@acme.test")
+    return TestClient(app)
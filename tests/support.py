@@ -0,0 +1,41 @@
+"""
+Setup shared by the tests and the benchmarks
+
+Importing this puts src/ on the path, so the app's modules import the way
+src/main.py runs them, and sets the settings config needs to import.
+"""
+
+import os
+import sys
+from pathlib import Path
+from typing import Any, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+# config.validate_config runs on import and insists on these
+for var in (
+    "GOOGLE_OAUTH_CLIENT_ID",
+    "GOOGLE_OAUTH_CLIENT_SECRET",
+    "OAUTH_SESSION_KEY",
+    "TWINWORD_API_KEY",
+):
+    os.environ.setdefault(var, "test")
+
+
+def sample_job_data(seeds: List[str] = None, locations: List[str] = None) -> Dict[str, Any]:
+    """A submission as form_to_job_data leaves it"""
+    return {
+        "pageType": "service",
+        "companyName": "Acme",
+        "companyUrl": "https://acme.test/",
+        "companyDescription": "Bin rentals",
+        "seedKeywords": seeds or ["bin rental", "dumpster"],
+        "locations": locations or ["CA"],
+        "current_page": {
+            "url": "https://acme.test/bins",
+            "title": "Bins",
+            "info": "bin rental",
+            "usp": "cheap",
+            "is_new": "True",
+        },
+    }
@@ -0,0 +1,36 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import jobs
+from jobs import JobManager
+
+
+class DependenciesFailed(Exception):
+    pass
+
+
+def test_failed_task_creation_leaves_no_job(databases, job_data, monkeypatch):
+    """
+    The job row commits with its tasks or not at all, so a failure creating
+    them can't leave a pending job that never runs and counts against the
+    user's job limit
+    """
+
+    def add_job_task_dependencies(conn, job_id):
+        raise DependenciesFailed()
+
+    monkeypatch.setattr(jobs, "add_job_task_dependencies", add_job_task_dependencies)
+    manager = JobManager(databases)
+
+    with pytest.raises(DependenciesFailed):
+        asyncio.run(manager.create_job(job_data, user_email="user@acme.test"))
+
+    conn = sqlite3.connect(databases.pools["jobs"].db_path)
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM jobs").fetchone() == (0,)
+        assert conn.execute("SELECT COUNT(*) FROM job_tasks").fetchone() == (0,)
+    finally:
+        conn.close()
+    assert manager.ready_tasks.empty()
@@ -0,0 +1,55 @@
+import numpy as np
+
+from keywords.embedding import EmbeddingService
+
+VECTORS = {
+    "bin rental": [1.0, 0.0, 0.0],
+    "dumpster": [0.6, 0.8, 0.0],
+    # Some models give an all-zero vector for text they can't tokenize
+    "": [0.0, 0.0, 0.0],
+}
+
+
+class FixedModel:
+    def encode(self, texts, convert_to_numpy=True, batch_size=None):
+        return np.array([VECTORS[text] for text in texts], dtype=np.float32)
+
+
+def test_bucket_cosine_many_scores_zero_vectors_like_similarity_scores(databases):
+    service = EmbeddingService()
+    service._model = FixedModel()
+    keywords = list(VECTORS)
+    center = np.array([0.8, 0.6, 0.0], dtype=np.float32)
+
+    buckets = service.bucket_cosine_many({"seed": center}, keywords, buckets=10)["seed"]
+
+    bucketed = {kw: float(edge) for edge, kws in buckets.items() for kw in kws}
+    assert set(bucketed) == set(keywords)
+    scores = service.similarity_scores(center, keywords)
+    for kw, score in zip(keywords, scores):
+        assert bucketed[kw] <= score < bucketed[kw] + 0.2
+    assert scores[keywords.index("")] == 0
+
+
+def test_get_and_filter_similar_filters_on_the_embedding_thread(monkeypatch):
+    import asyncio
+    import threading
+
+    import keywords
+
+    threads = []
+
+    async def get_similar_multi(seeds, location):
+        return {seed: {"bin rentals": {}, "skip bins": {}} for seed in seeds}
+
+    def filter_similar_keywords(seeds, potential_keywords, threshold):
+        threads.append(threading.current_thread().name)
+        return potential_keywords[:1]
+
+    monkeypatch.setattr(keywords, "get_similar_multi", get_similar_multi)
+    monkeypatch.setattr(keywords, "filter_similar_keywords", filter_similar_keywords)
+
+    filtered = asyncio.run(keywords.get_and_filter_similar(["bin rental"]))
+
+    assert filtered == {"bin rental": {"bin rentals": {}}}
+    assert threads and all(name.startswith("embedding") for name in threads)
@@ -0,0 +1,31 @@
+import asyncio
+
+from jobs import JobManager
+
+
+def test_not_modified_heartbeat_reads_no_results(databases, job_data, client, monkeypatch):
+    """A 304 is decided from statuses alone, results are only read for a 200"""
+    from web import routes
+
+    manager = JobManager(databases)
+    job_id = asyncio.run(manager.create_job(job_data))
+    loads = []
+    get_job_snapshot = manager.get_job_snapshot
+
+    async def recording_get_job_snapshot(job_id, results=False, with_versions=False):
+        loads.append(results)
+        return await get_job_snapshot(job_id, results=results, with_versions=with_versions)
+
+    monkeypatch.setattr(manager, "get_job_snapshot", recording_get_job_snapshot)
+    monkeypatch.setattr(routes, "job_manager", manager)
+    url = f"/heartbeat/{job_id}?include_data=true"
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert all("data" in task for task in response.json()["tasks"])
+    assert loads == [False, True]
+
+    loads.clear()
+    response = client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert loads == [False]
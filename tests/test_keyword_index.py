@@ -0,0 +1,156 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+import jobs
+import keywords
+from jobs import JobManager
+from keywords.embedding import EmbeddingService
+from keywords.embedding.index import KeywordIndex
+
+# Keywords spread around a circle, so the neighbours of each are known
+ANGLES = {f"keyword {i}": i * np.pi / 18 for i in range(36)}
+
+
+class CircleModel:
+    """Stands in for the SentenceTransformer, putting ANGLES keywords on a circle"""
+
+    def encode(self, texts, convert_to_numpy=True, batch_size=None):
+        vectors = [[np.cos(ANGLES[text]), np.sin(ANGLES[text]), 0.0] for text in texts]
+        return np.array(vectors, dtype=np.float32)
+
+
+@pytest.fixture
+def service(databases):
+    service = EmbeddingService(index_keywords=len(ANGLES))
+    service._model = CircleModel()
+    return service
+
+
+def vector(angle):
+    return np.array([np.cos(angle), np.sin(angle), 0.0], dtype=np.float32)
+
+
+@pytest.mark.parametrize("ivf_min_size", [10**6, 10])
+def test_top_k_and_radius_queries(service, ivf_min_size):
+    index = KeywordIndex(service, max_keywords=100, ivf_min_size=ivf_min_size)
+    index.add(list(ANGLES), CircleModel().encode(list(ANGLES)))
+    assert (index.centroids is not None) == (len(ANGLES) >= ivf_min_size)
+
+    nearest = index.top_k(vector(ANGLES["keyword 5"]), k=3, exact=True)
+    assert nearest[0][0] == "keyword 5"
+    assert nearest[0][1] == pytest.approx(1.0)
+    assert {kw for kw, _ in nearest} == {"keyword 4", "keyword 5", "keyword 6"}
+
+    # Within 10 degrees either side
+    close = index.within(vector(ANGLES["keyword 5"]), np.cos(np.pi / 18) - 1e-6)
+    assert {kw for kw, _ in close} == {"keyword 4", "keyword 5", "keyword 6"}
+    assert close[0][0] == "keyword 5"
+
+
+def test_index_is_bounded(service):
+    index = KeywordIndex(service, max_keywords=4)
+    names = list(ANGLES)
+
+    index.add(names[:4], CircleModel().encode(names[:4]))
+    index.add(names[4:6], CircleModel().encode(names[4:6]))
+
+    assert len(index) == 4
+    assert index.vectors.shape[0] == 4
+    assert set(index.rows) == set(names[2:6])
+    assert index.stats()["evictions"] == 2
+    # The oldest keyword's row went to the newest one
+    assert index.top_k(vector(ANGLES["keyword 0"]), k=1, exact=True)[0][0] == "keyword 2"
+
+    # Queued keywords past max_keywords would only be evicted again
+    index.add_pending(names[10:20])
+    assert list(index.pending) == names[16:20]
+
+
+def maintain_until(index, done):
+    """Runs index.maintain until done() is true"""
+
+    async def run():
+        maintain = asyncio.create_task(index.maintain(interval=0.01))
+        while not done():
+            await asyncio.sleep(0.01)
+        maintain.cancel()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+
+
+def cache_angles(service, monkeypatch):
+    monkeypatch.setattr(keywords, "embedding_service", service)
+    keywords.cache_data(
+        "keyword 0",
+        {kw: {"search volume": 10, "cpc": 1.0, "competition": 0.1} for kw in ANGLES},
+    )
+
+
+def test_cached_keywords_are_searchable(service, monkeypatch):
+    """Keywords written by cache_data end up in the index and in find_similar_keywords"""
+    cache_angles(service, monkeypatch)
+    # Queries don't embed queued keywords themselves, maintain does
+    assert service.find_similar_keywords("keyword 9", threshold=0.9) == []
+
+    maintain_until(service.index, lambda: len(service.index) == len(ANGLES))
+
+    similar = service.find_similar_keywords("keyword 9", threshold=np.cos(np.pi / 18) - 1e-6)
+    assert similar[0] == "keyword 9"
+    assert set(similar) == {"keyword 8", "keyword 9", "keyword 10"}
+    assert service.categorize_keyword("keyword 0", threshold=0.99) == ["keyword 0"]
+    assert [kw for kw, _ in service.nearest_keywords("keyword 18", k=1)] == ["keyword 18"]
+    assert service.index.stats()["pending"] == 0
+    # A candidate list still limits the search to those keywords
+    assert service.find_similar_keywords("keyword 9", ["keyword 0", "keyword 10"], 0.9) == [
+        "keyword 10"
+    ]
+
+
+def test_index_loads_the_keywords_table_on_the_embedding_thread(service, monkeypatch):
+    cache_angles(service, monkeypatch)
+    restarted = EmbeddingService(index_keywords=len(ANGLES))
+    restarted._model = CircleModel()
+    threads = []
+    get_embedding_matrix = restarted.get_embedding_matrix
+
+    def record_thread(keys):
+        threads.append(threading.current_thread().name)
+        return get_embedding_matrix(keys)
+
+    monkeypatch.setattr(restarted, "get_embedding_matrix", record_thread)
+
+    maintain_until(restarted.index, lambda: len(restarted.index) == len(ANGLES))
+
+    assert set(restarted.index.rows) == set(ANGLES)
+    assert threads and all(name.startswith("embedding") for name in threads)
+
+
+def test_similar_keywords_include_indexed_neighbours(databases, service, monkeypatch):
+    """GENERATE_SIMILAR_KEYWORDS adds cached keywords close to each seed to the provider's"""
+    service.index.add(list(ANGLES), CircleModel().encode(list(ANGLES)))
+    provider_results = {"keyword 9": {"Keyword 10": {"similarity": 1}}}
+
+    async def get_similar_multi(seeds, location):
+        return provider_results
+
+    async def get_previous_task_data(job_id, task_type):
+        return {"locations": ["CA"], "seed_keywords": ["keyword 9"]}
+
+    monkeypatch.setattr(keywords, "get_similar_multi", get_similar_multi)
+    monkeypatch.setattr(jobs, "embedding_service", service)
+    manager = JobManager(databases)
+    monkeypatch.setattr(manager, "get_previous_task_data", get_previous_task_data)
+
+    result = asyncio.run(manager.handle_generate_similar_keywords("job", "task"))
+
+    similar = result["similar_kw_dict"]["CA"]["keyword 9"]
+    # Everything within the 0.69 cutoff (40 degrees) but the seed, and
+    # "keyword 10" only once
+    assert set(similar) == {"Keyword 10"} | {f"keyword {i}" for i in (5, 6, 7, 8, 11, 12, 13)}
+    assert similar["Keyword 10"] == {"similarity": 1}
+    assert similar["keyword 8"]["index similarity"] == pytest.approx(np.cos(np.pi / 18), abs=1e-4)
+    # The provider's (possibly cached) results aren't changed
+    assert provider_results == {"keyword 9": {"Keyword 10": {"similarity": 1}}}
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+from datetime import datetime, timedelta, timezone
+
+from jobs import JobManager, TASK_MAX_ATTEMPTS
+from jobs.db import reclaim_expired_leases
+
+
+def test_only_leases_of_exited_processes_are_reclaimed_early(databases, job_data):
+    manager = JobManager(databases)
+    job_id = asyncio.run(manager.create_job(job_data))
+
+    host = socket.gethostname()
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    later = (datetime.now(timezone.utc) + timedelta(minutes=5)).isoformat()
+    earlier = (datetime.now(timezone.utc) - timedelta(minutes=5)).isoformat()
+    leases = {
+        "PROCESS_INITIAL_INPUT": (f"{host}:{exited.pid}:dead", later),
+        # A live worker on this machine
+        "GENERATE_SIMILAR_KEYWORDS": (f"{host}:{os.getppid()}:live", later),
+        # An earlier process this one reused the pid of
+        "SELECT_BEST_KEYWORDS": (f"{host}:{os.getpid()}:earlier", later),
+        "GENERATE_CLUSTERS": (manager.lease_owner, later),
+        # A live worker whose lease ran out anyway
+        "GENERATE_HTML": (f"{host}:{os.getppid()}:stuck", earlier),
+    }
+    for task_type, (owner, expires_at) in leases.items():
+        databases.execute_query(
+            "jobs",
+            """
+            UPDATE job_tasks SET status = 'running', lease_owner = ?, lease_expires_at = ?
+            WHERE job_id = ? AND task_type = ?
+            """,
+            (owner, expires_at, job_id, task_type),
+        )
+
+    with databases.get_db("jobs") as conn:
+        requeued, exhausted = reclaim_expired_leases(
+            conn, TASK_MAX_ATTEMPTS, f"{host}:*", manager.lease_owner_gone
+        )
+
+    assert exhausted == []
+    assert {row["task_type"] for row in requeued} == {
+        "PROCESS_INITIAL_INPUT",
+        "SELECT_BEST_KEYWORDS",
+        "GENERATE_HTML",
+    }
@@ -0,0 +1,62 @@
+import re
+import sqlite3
+
+import pytest
+
+from jobs.db import HOT_QUERIES, check_query_plans
+
+# The indexes each of HOT_QUERIES is meant to use. check_query_plans only
+# catches full table scans, and most of these queries fall back to another
+# index on the same table when theirs goes missing, so the names matter.
+EXPECTED_INDEXES = {
+    "recover_pending_tasks": {"idx_job_tasks_waiting"},
+    "ready_tasks": {"idx_job_tasks_job_order"},
+    "expired_leases": {"idx_job_tasks_running"},
+    "incomplete_task_count": {"idx_job_tasks_job_status"},
+    "active_user_jobs": {"idx_jobs_user_status"},
+    "task_inputs": {
+        "sqlite_autoindex_task_dependencies_1",
+        "sqlite_autoindex_current_task_versions_1",
+    },
+    "stored_version": {"idx_task_versions_task_input"},
+    "job_snapshot": {"idx_job_tasks_job_order"},
+    "job_versions": {"idx_job_tasks_job_status", "idx_task_versions_task_input"},
+}
+
+
+def plan_indexes(conn: sqlite3.Connection, name: str) -> set:
+    sql, params = HOT_QUERIES[name]
+    plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+    return set(re.findall(r" USING (?:COVERING )?INDEX (\w+)", "\n".join(plan)))
+
+
+@pytest.fixture
+def jobs_db(databases):
+    # A connection of its own, since EXPLAIN on a pooled one can still plan
+    # against a schema it cached before an index was dropped
+    conn = sqlite3.connect(databases.pools["jobs"].db_path)
+    yield conn
+    conn.close()
+
+
+def test_every_hot_query_has_expected_indexes():
+    assert set(EXPECTED_INDEXES) == set(HOT_QUERIES)
+
+
+@pytest.mark.parametrize("name", sorted(EXPECTED_INDEXES))
+def test_hot_query_uses_its_index(jobs_db, name):
+    assert EXPECTED_INDEXES[name] <= plan_indexes(jobs_db, name)
+
+
+def test_no_hot_query_scans_a_table(jobs_db):
+    assert check_query_plans(jobs_db) == {}
+
+
+def test_dropped_index_is_noticed(jobs_db):
+    jobs_db.execute("DROP INDEX idx_job_tasks_job_status")
+
+    # The count falls back to idx_job_tasks_job_order, so it isn't a full scan
+    assert "incomplete_task_count" not in check_query_plans(jobs_db)
+    assert not EXPECTED_INDEXES["incomplete_task_count"] <= plan_indexes(
+        jobs_db, "incomplete_task_count"
+    )
@@ -0,0 +1,250 @@
+import asyncio
+import sqlite3
+
+import pytest
+from tenacity import wait_none
+
+from jobs import JobEditError, JobManager, job_pages
+
+
+class ClusteringFailed(Exception):
+    pass
+
+
+@pytest.fixture
+def manager(databases, monkeypatch):
+    """A JobManager whose handlers return straight away, without the model or Twinword"""
+    monkeypatch.setattr(JobManager.execute_task.retry, "wait", wait_none())
+    manager = JobManager(databases)
+    manager.fail_clusters = False
+    # (task type, page) of every per-page task the handlers executed
+    manager.pages_executed = []
+
+    async def process_initial_input(job_id, task_id):
+        data = await manager.get_job_data(job_id)
+        return {
+            "company_string": data["companyName"],
+            "page_strings": [page["info"] for page in job_pages(data)],
+            "locations": data["locations"],
+            "seed_keywords": data["seedKeywords"],
+            "page_type": data["pageType"],
+        }
+
+    async def generate_similar_keywords(job_id, task_id):
+        return {"similar_kw_dict": {"CA": {"bin rental": {"bin rentals": {}}}}}
+
+    async def select_best_keywords(job_id, task_id):
+        return {"bin rental": ["bin rentals"]}
+
+    async def generate_clusters(job_id, task_id):
+        if manager.fail_clusters:
+            raise ClusteringFailed()
+        return [{"cluster_id": 1, "keywords": ["bin rentals"]}]
+
+    async def select_best_cluster(job_id, task_id, page_index):
+        manager.pages_executed.append(("SELECT_BEST_CLUSTER", page_index))
+        return {"best_cluster": {"cluster_id": 1, "keywords": ["bin rentals"]}}
+
+    async def generate_html(job_id, task_id, page_index):
+        manager.pages_executed.append(("GENERATE_HTML", page_index))
+        return {"generated_html": f"<p>Page {page_index}</p>"}
+
+    manager.handle_process_initial_input = process_initial_input
+    manager.handle_generate_similar_keywords = generate_similar_keywords
+    manager.handle_select_best_keywords = select_best_keywords
+    manager.handle_generate_clusters = generate_clusters
+    manager.handle_select_best_cluster = select_best_cluster
+    manager.handle_generate_html = generate_html
+    return manager
+
+
+async def run_queued(manager):
+    while not manager.ready_tasks.empty():
+        await manager.run_task(manager.ready_tasks.get_nowait())
+
+
+def statuses(databases, job_id):
+    conn = sqlite3.connect(databases.pools["jobs"].db_path)
+    try:
+        job = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+        tasks = dict(
+            conn.execute("SELECT task_type, status FROM job_tasks WHERE job_id = ?", (job_id,))
+        )
+        return job, tasks
+    finally:
+        conn.close()
+
+
+def test_rerun_after_failed_edit_finishes_the_job(databases, manager, job_data):
+    """
+    A rerun from a task with nothing downstream of it still runs the tasks
+    a failed run left behind, instead of leaving the job pending
+    """
+
+    async def scenario():
+        job_id = await manager.create_job(job_data)
+        await run_queued(manager)
+        assert statuses(databases, job_id)[0] == "completed"
+
+        manager.fail_clusters = True
+        await manager.edit_job(job_id, {"seedKeywords": ["skip bin"]})
+        await run_queued(manager)
+        job, tasks = statuses(databases, job_id)
+        assert job == "failed"
+        assert tasks["GENERATE_CLUSTERS"] == "failed"
+        assert tasks["SELECT_BEST_CLUSTER"] == tasks["GENERATE_HTML"] == "pending"
+
+        manager.fail_clusters = False
+        conn = sqlite3.connect(databases.pools["jobs"].db_path)
+        (best_keywords,) = conn.execute(
+            "SELECT id FROM job_tasks WHERE job_id = ? AND task_type = 'SELECT_BEST_KEYWORDS'",
+            (job_id,),
+        ).fetchone()
+        conn.close()
+        reset = await manager.rerun_task(best_keywords)
+        await run_queued(manager)
+        return job_id, reset
+
+    job_id, reset = asyncio.run(scenario())
+
+    assert {task["task_type"] for task in reset} == {
+        "SELECT_BEST_KEYWORDS",
+        "GENERATE_CLUSTERS",
+        "SELECT_BEST_CLUSTER",
+        "GENERATE_HTML",
+    }
+    job, tasks = statuses(databases, job_id)
+    assert job == "completed"
+    assert set(tasks.values()) == {"completed"}
+
+
+def test_rerun_task_waiting_on_a_failed_one_still_executes(databases, manager, job_data):
+    """
+    The task a rerun is asked for runs even when it only becomes ready after
+    the tasks the failed run left behind, and its inputs haven't changed
+    """
+
+    async def scenario():
+        job_id = await manager.create_job(job_data)
+        await run_queued(manager)
+        manager.fail_clusters = True
+        await manager.edit_job(job_id, {"seedKeywords": ["skip bin"]})
+        await run_queued(manager)
+        manager.fail_clusters = False
+        manager.pages_executed.clear()
+
+        conn = sqlite3.connect(databases.pools["jobs"].db_path)
+        (html,) = conn.execute(
+            "SELECT id FROM job_tasks WHERE job_id = ? AND task_type = 'GENERATE_HTML'",
+            (job_id,),
+        ).fetchone()
+        conn.close()
+        await manager.rerun_task(html)
+        await run_queued(manager)
+        return job_id
+
+    job_id = asyncio.run(scenario())
+
+    assert statuses(databases, job_id)[0] == "completed"
+    # The cluster comes out the same, so only the forced task executes
+    assert manager.pages_executed == [("GENERATE_HTML", 0)]
+
+
+def test_job_with_nothing_left_to_run_fails(databases, manager, job_data):
+    async def scenario():
+        job_id = await manager.create_job(job_data)
+        await run_queued(manager)
+        # A task waiting on one that will never complete, with nothing running
+        databases.execute_query(
+            "jobs",
+            """
+            UPDATE job_tasks SET status = CASE task_type
+                WHEN 'GENERATE_CLUSTERS' THEN 'failed' ELSE 'pending' END
+            WHERE job_id = ? AND task_type IN ('GENERATE_CLUSTERS', 'SELECT_BEST_CLUSTER')
+            """,
+            (job_id,),
+        )
+        databases.execute_query(
+            "jobs", "UPDATE jobs SET status = 'pending' WHERE id = ?", (job_id,)
+        )
+        await manager.check_job_completion(job_id)
+        return job_id
+
+    job_id = asyncio.run(scenario())
+
+    assert statuses(databases, job_id)[0] == "failed"
+
+
+def test_editing_one_page_reuses_the_others(databases, manager, job_data):
+    job_data["additional_pages"] = [
+        {**job_data["current_page"], "url": "https://acme.test/dumpsters", "info": "dumpsters"}
+    ]
+
+    async def scenario():
+        job_id = await manager.create_job(job_data)
+        await run_queued(manager)
+        assert statuses(databases, job_id)[0] == "completed"
+        manager.pages_executed.clear()
+
+        edited = {**job_data["additional_pages"][0], "info": "roll off dumpsters"}
+        await manager.edit_job(job_id, {"additional_pages": [edited]})
+        await run_queued(manager)
+        return job_id
+
+    job_id = asyncio.run(scenario())
+
+    assert statuses(databases, job_id)[0] == "completed"
+    assert sorted(manager.pages_executed) == [
+        ("GENERATE_HTML", 1),
+        ("SELECT_BEST_CLUSTER", 1),
+    ]
+
+
+@pytest.mark.parametrize("pages", [0, 2])
+def test_edit_cannot_change_the_page_count(databases, manager, job_data, pages):
+    job_data["additional_pages"] = [job_data["current_page"]]
+
+    async def scenario():
+        job_id = await manager.create_job(job_data)
+        await run_queued(manager)
+        with pytest.raises(JobEditError):
+            await manager.edit_job(
+                job_id, {"additional_pages": [job_data["current_page"]] * pages}
+            )
+        return job_id
+
+    job_id = asyncio.run(scenario())
+
+    job, tasks = statuses(databases, job_id)
+    assert job == "completed"
+    assert set(tasks.values()) == {"completed"}
+    assert manager.ready_tasks.empty()
+
+
+@pytest.mark.parametrize("pages", [0, 2])
+def test_rerun_route_rejects_a_page_count_edit(
+    databases, manager, job_data, client, monkeypatch, pages
+):
+    from web import routes
+
+    job_data["additional_pages"] = [job_data["current_page"]]
+    job_id = asyncio.run(manager.create_job(job_data))
+    asyncio.run(run_queued(manager))
+
+    monkeypatch.setattr(routes, "job_manager", manager)
+    page = {
+        "pageUrl": "https://acme.test/dumpsters",
+        "pageTitle": "Dumpsters",
+        "pageInfo": "dumpsters",
+        "pageUsp": "cheap",
+        "isNewPage": True,
+    }
+
+    response = client.post(
+        f"/job/{job_id}/rerun", json={"additionalPages": [page] * pages}
+    )
+
+    assert response.status_code == 422
+    assert "pages" in response.json()["detail"]
+    assert statuses(databases, job_id)[0] == "completed"
+    assert manager.ready_tasks.empty()
@@ -0,0 +1,31 @@
+import asyncio
+import logging
+
+from jobs import JobManager
+
+
+def test_timeout_from_a_task_is_not_the_job_timeout(databases, job_data, caplog):
+    """
+    A TimeoutError from inside a task fails it like any other error,
+    instead of being reported as the job running out of time
+    """
+    manager = JobManager(databases)
+
+    async def execute_task(task):
+        raise TimeoutError("timed out reading from the provider")
+
+    manager.execute_task = execute_task
+
+    async def scenario():
+        job_id = await manager.create_job(job_data)
+        await manager.run_task(manager.ready_tasks.get_nowait())
+        return job_id
+
+    with caplog.at_level(logging.ERROR):
+        job_id = asyncio.run(scenario())
+
+    assert "timed out reading from the provider" in caplog.text
+    assert "exceeded JOB_TIMEOUT_SECONDS" not in caplog.text
+    assert databases.execute_query(
+        "jobs", "SELECT status FROM jobs WHERE id = ?", (job_id,)
+    )[0]["status"] == "failed"
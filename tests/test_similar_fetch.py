@@ -0,0 +1,43 @@
+import asyncio
+import gc
+import logging
+
+import keywords
+
+
+class ProviderDown(Exception):
+    pass
+
+
+def test_failed_fetch_with_cancelled_callers_is_logged(databases, monkeypatch, caplog):
+    """
+    When everyone waiting on a fetch is cancelled, its error is still
+    logged, rather than left for asyncio to report as never retrieved
+    """
+
+    async def fetch_similar(keyword, location):
+        await asyncio.sleep(0.01)
+        raise ProviderDown("503 from the provider")
+
+    monkeypatch.setattr(keywords, "_fetch_similar", fetch_similar)
+    unhandled = []
+
+    async def scenario():
+        asyncio.get_running_loop().set_exception_handler(
+            lambda loop, context: unhandled.append(context)
+        )
+        caller = asyncio.create_task(keywords.get_similar("bin rental", "CA"))
+        await asyncio.sleep(0.001)
+        fetch = keywords._in_flight[("bin rental", "CA")]
+        caller.cancel()
+        await asyncio.wait([fetch])
+        await asyncio.sleep(0)
+        del fetch, caller
+        gc.collect()
+
+    with caplog.at_level(logging.ERROR):
+        asyncio.run(scenario())
+
+    assert "503 from the provider" in caplog.text
+    assert ("bin rental", "CA") not in keywords._in_flight
+    assert unhandled == []
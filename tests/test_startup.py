@@ -0,0 +1,35 @@
+import asyncio
+import logging
+
+from keywords.embedding import embedding_service
+
+
+class ModelDownloadFailed(Exception):
+    pass
+
+
+def test_failed_warm_up_is_logged_and_reported(databases, client, monkeypatch, caplog):
+    from main import log_warm_up_failure
+
+    monkeypatch.setattr(embedding_service, "warm_up_error", None)
+
+    async def warm_up():
+        raise ModelDownloadFailed("no route to huggingface.co")
+
+    async def start():
+        task = asyncio.create_task(warm_up())
+        task.add_done_callback(log_warm_up_failure)
+        await asyncio.wait([task])
+        # Done-callbacks run on the loop's next pass
+        await asyncio.sleep(0)
+
+    with caplog.at_level(logging.ERROR):
+        asyncio.run(start())
+
+    assert "Embedding model warm-up failed" in caplog.text
+    assert "no route to huggingface.co" in caplog.text
+
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["status"] == "failed"
+    assert response.json()["error"] == "ModelDownloadFailed: no route to huggingface.co"
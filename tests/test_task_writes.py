@@ -0,0 +1,39 @@
+import asyncio
+import sqlite3
+
+from jobs import JobManager
+from jobs.db import lease_task
+
+
+def test_completing_a_task_is_one_transaction(databases, job_data):
+    """
+    A completed task writes its result once: the blob, one version, the
+    current version pointer, the memo entry and the status, in one commit
+    """
+    pool = databases.pools["jobs"]
+
+    async def complete_first_task():
+        manager = JobManager(databases)
+        await manager.create_job(job_data)
+        task = manager.ready_tasks.get_nowait()
+        attempt = await databases.run(lease_task, task["id"], "test", 60)
+        task.update(lease=("test", attempt), input_hash="inputs")
+
+        before = pool.stats()["queries"]
+        await manager.complete_task(task, {"keywords": [f"kw {i}" for i in range(1000)]})
+        return task, pool.stats()["queries"] - before
+
+    task, queries = asyncio.run(complete_first_task())
+
+    # BEGIN, the status update, result_blobs, task_versions,
+    # current_task_versions, task_memo and COMMIT
+    assert queries == 7
+
+    conn = sqlite3.connect(pool.db_path)
+    assert conn.execute(
+        "SELECT COUNT(*) FROM task_versions WHERE task_id = ?", (task["id"],)
+    ).fetchone() == (1,)
+    assert conn.execute("SELECT COUNT(*) FROM result_blobs").fetchone() == (1,)
+    assert conn.execute(
+        "SELECT status FROM job_tasks WHERE id = ?", (task["id"],)
+    ).fetchone() == ("completed",)